@@ -0,0 +1,96 @@
+# bot/backfill_rates.py
+"""
+Загрузка архива курсов в currency_rates.
+
+    python -m bot.backfill_rates archive/ 2023.csv daily_2024-01-09.js ...
+
+Понимает файлы cbr-xml-daily (daily_json.js с «Valute» и latest.js с «rates»),
+а также CSV «date,code,value» (рублей за единицу валюты). Директории
+обходятся рекурсивно. Всё загружается одним COPY, повторная загрузка
+перезаписывает значения за те же даты.
+"""
+
+import asyncio
+import csv
+import json
+import os
+import sys
+from datetime import date
+
+root_path = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+if root_path not in sys.path:
+    sys.path.insert(0, root_path)
+
+from loguru import logger
+
+from database import create_db_pool, init_db, copy_currency_rates
+
+
+def read_json(path: str) -> list:
+    with open(path, "r", encoding="utf-8") as f:
+        data = json.load(f)
+    if "Valute" in data:
+        day = date.fromisoformat(data["Date"][:10])
+        return [
+            (code, day, item["Value"] / item.get("Nominal", 1))
+            for code, item in data["Valute"].items()
+        ]
+    if "rates" in data:
+        day = date.fromisoformat(data["date"][:10])
+        return [(code, day, 1 / value) for code, value in data["rates"].items() if value]
+    raise ValueError("неизвестный формат JSON")
+
+
+def read_csv(path: str) -> list:
+    records = []
+    with open(path, "r", encoding="utf-8", newline="") as f:
+        for row in csv.reader(f):
+            if not row or row[0].strip().lower() == "date":
+                continue
+            day, code, value = row[:3]
+            records.append((code.strip().upper(), date.fromisoformat(day.strip()), float(value.replace(",", "."))))
+    return records
+
+
+def iter_files(paths: list):
+    for path in paths:
+        if os.path.isdir(path):
+            for dirpath, _, filenames in os.walk(path):
+                for filename in sorted(filenames):
+                    yield os.path.join(dirpath, filename)
+        else:
+            yield path
+
+
+def read_archive(paths: list) -> list:
+    records = []
+    for path in iter_files(paths):
+        try:
+            if path.endswith(".csv"):
+                records.extend(read_csv(path))
+            elif path.endswith((".json", ".js")):
+                records.extend(read_json(path))
+        except Exception as e:
+            logger.warning(f"⚠️ Пропущен {path}: {e}")
+    return records
+
+
+async def main(paths: list):
+    records = await asyncio.to_thread(read_archive, paths)
+    if not records:
+        logger.error("❌ В архиве нет курсов")
+        return
+    pool = await create_db_pool()
+    try:
+        await init_db(pool)
+        loaded = await copy_currency_rates(pool, records)
+        logger.info(f"✅ Загружено курсов: {loaded} (прочитано записей: {len(records)})")
+    finally:
+        await pool.close()
+
+
+if __name__ == "__main__":
+    if len(sys.argv) < 2:
+        print(__doc__)
+        sys.exit(1)
+    asyncio.run(main(sys.argv[1:]))
@@ -0,0 +1,113 @@
+# bot/breaker.py
+"""
+Автоматический выключатель (circuit breaker) для внешних API.
+
+По последним BREAKER_WINDOW вызовам считается доля неудачных: ошибки,
+таймауты и вызовы дольше BREAKER_SLOW_CALL секунд. Когда доля превышает
+порог, выключатель размыкается и BREAKER_OPEN_SECONDS сразу отказывает
+(CircuitOpenError), не дожидаясь таймаута. Потом пропускает один пробный
+вызов: удачный замыкает цепь, неудачный снова размыкает.
+"""
+
+import asyncio
+import os
+import time
+from collections import deque
+
+from loguru import logger
+
+BREAKER_WINDOW = int(os.getenv("BREAKER_WINDOW", 20))
+BREAKER_MIN_CALLS = int(os.getenv("BREAKER_MIN_CALLS", 5))
+BREAKER_FAILURE_RATE = float(os.getenv("BREAKER_FAILURE_RATE", 0.5))
+BREAKER_OPEN_SECONDS = float(os.getenv("BREAKER_OPEN_SECONDS", 30))
+BREAKER_CALL_TIMEOUT = float(os.getenv("BREAKER_CALL_TIMEOUT", 5))
+BREAKER_SLOW_CALL = float(os.getenv("BREAKER_SLOW_CALL", 3))
+
+CLOSED = "closed"
+OPEN = "open"
+HALF_OPEN = "half_open"
+
+
+class CircuitOpenError(Exception):
+    """Выключатель разомкнут — вызов не выполнялся."""
+
+
+class CircuitBreaker:
+    def __init__(self, name: str, timeout: float = BREAKER_CALL_TIMEOUT):
+        self.name = name
+        self.timeout = timeout
+        self.state = CLOSED
+        self._outcomes = deque(maxlen=BREAKER_WINDOW)  # (успех, задержка)
+        self._opened_at = 0.0
+        self._probe_in_flight = False
+        self._metrics = {"calls": 0, "failures": 0, "rejected": 0, "opened": 0}
+
+    def _allow(self) -> bool:
+        if self.state == CLOSED:
+            return True
+        if self.state == OPEN and time.monotonic() - self._opened_at >= BREAKER_OPEN_SECONDS:
+            self.state = HALF_OPEN
+        if self.state == HALF_OPEN and not self._probe_in_flight:
+            self._probe_in_flight = True
+            return True
+        return False
+
+    async def call(self, func, *args, **kwargs):
+        """
+        Выполняет await func(*args, **kwargs) не дольше self.timeout секунд.
+        """
+        if not self._allow():
+            self._metrics["rejected"] += 1
+            raise CircuitOpenError(f"{self.name}: выключатель разомкнут")
+
+        self._metrics["calls"] += 1
+        started = time.monotonic()
+        try:
+            result = await asyncio.wait_for(func(*args, **kwargs), self.timeout)
+        except asyncio.CancelledError:
+            self._probe_in_flight = False
+            raise
+        except Exception:
+            self._record(False, time.monotonic() - started)
+            raise
+        elapsed = time.monotonic() - started
+        self._record(elapsed < BREAKER_SLOW_CALL, elapsed)
+        return result
+
+    def _record(self, ok: bool, elapsed: float):
+        self._outcomes.append((ok, elapsed))
+        if not ok:
+            self._metrics["failures"] += 1
+
+        if self.state == HALF_OPEN:
+            self._probe_in_flight = False
+            if ok:
+                self.state = CLOSED
+                self._outcomes.clear()
+                logger.info(f"🟢 {self.name}: выключатель замкнут")
+            else:
+                self._open()
+            return
+
+        if self.state == CLOSED and len(self._outcomes) >= BREAKER_MIN_CALLS and self.failure_rate() >= BREAKER_FAILURE_RATE:
+            self._open()
+
+    def _open(self):
+        self.state = OPEN
+        self._opened_at = time.monotonic()
+        self._metrics["opened"] += 1
+        logger.warning(f"🔴 {self.name}: выключатель разомкнут на {BREAKER_OPEN_SECONDS:.0f} с")
+
+    def failure_rate(self) -> float:
+        if not self._outcomes:
+            return 0.0
+        return sum(1 for ok, _ in self._outcomes if not ok) / len(self._outcomes)
+
+    def stats(self) -> dict:
+        latencies = [elapsed for _, elapsed in self._outcomes]
+        return {
+            "state": self.state,
+            "failure_rate": round(self.failure_rate(), 3),
+            "avg_ms": round(sum(latencies) / len(latencies) * 1000, 1) if latencies else 0.0,
+            **self._metrics,
+        }
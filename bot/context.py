@@ -0,0 +1,25 @@
+# bot/context.py
+"""
+Собственный CallbackContext: к каждому апдейту привязан ленивый UserContext.
+Подключается в bot/main.py через Application.builder().context_types(...).
+"""
+
+from typing import Optional
+from telegram.ext import CallbackContext, ExtBot
+
+from database import UserContext
+
+
+class BotContext(CallbackContext[ExtBot, dict, dict, dict]):
+    def __init__(self, application, chat_id: Optional[int] = None, user_id: Optional[int] = None):
+        super().__init__(application=application, chat_id=chat_id, user_id=user_id)
+        self._user_context: Optional[UserContext] = None
+
+    def user_context(self) -> Optional[UserContext]:
+        """
+        UserContext текущего пользователя. Создаётся при первом обращении,
+        в БД идёт только при вызове load().
+        """
+        if self._user_context is None and self._user_id is not None:
+            self._user_context = UserContext(self.bot_data['db_pool'], self._user_id)
+        return self._user_context
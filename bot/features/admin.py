@@ -1,4 +1,5 @@
 # bot/features/admin.py
+import asyncio
 
 from telegram import Update, InlineKeyboardMarkup, InlineKeyboardButton
 from telegram.ext import ContextTypes, CommandHandler, CallbackQueryHandler, MessageHandler, filters
@@ -10,8 +11,15 @@ from database import (
     is_admin,
     get_referral_stats,
     log_command_usage,
+    get_usage_sink_stats,
+    get_profile_cache_stats,
+    get_pool_stats,
+    get_admin_stats_snapshot,
 )
 
+from features.broadcast import show_broadcasts
+from bot.outbox import INTERACTIVE
+
 # Состояние: кто в режиме поиска
 user_search_state = {}
 
@@ -69,11 +77,21 @@ async def admin_callback_handler(update: Update, context: ContextTypes.DEFAULT_T
     data = query.data
 
     if data == "admin_stats":
-        total_users = await pool.fetchval("SELECT COUNT(*) FROM users")
-        active_24h = await pool.fetchval("SELECT COUNT(*) FROM users WHERE last_seen > NOW() - INTERVAL '24 hours'")
-        premium_users = await pool.fetchval("SELECT COUNT(*) FROM users WHERE role = 'premium'")
-
-        text = f"📊 <b>Статистика</b>\n\n👥 Всего: <b>{total_users}</b>\n🟢 Активны: <b>{active_24h}</b>\n💎 Премиум: <b>{premium_users}</b>"
+        stats = (await get_admin_stats_snapshot(pool))["stats"]
+
+        text = f"📊 <b>Статистика</b>\n\n👥 Всего: <b>{stats['total_users']}</b>\n🟢 Активны: <b>{stats['active_24h']}</b>\n💎 Премиум: <b>{stats['premium_users']}</b>"
+        sink = get_usage_sink_stats()
+        text += f"\n\n📥 Очередь статистики: <b>{sink['queue_depth']}</b> (сброс: {sink['last_flush_ms']} мс)"
+        cache = get_profile_cache_stats()
+        text += f"\n🧠 Кэш профилей: <b>{cache['size']}</b> (попаданий: {cache['hit_ratio']:.0%})"
+        db = get_pool_stats(pool)
+        text += f"\n🗄 Пул БД: <b>{db['in_use']}/{db['size']}</b> (ждут: {db['waiting']}, ожидание: {db['acquire_wait_avg_ms']} мс)"
+        out = context.application.bot_data['outbox'].stats()
+        text += f"\n📤 Очередь отправки: <b>{sum(out['depth'].values()) + out['delayed']}</b> (p95: {out['latency_p95_ms']} мс, 429: {out['retried']})"
+        weather = context.application.bot_data['weather'].stats()
+        text += f"\n🌤 Кэш погоды: <b>{weather['size']}</b> (попаданий: {weather['hit_ratio']:.0%}, запросов к API: {weather['upstream_calls']})"
+        for host, http in context.application.bot_data['http'].stats().items():
+            text += f"\n🌐 {host}: {http['requests']} запросов, {http['avg_ms']} мс в среднем, ошибок: {http['errors']}"
         await query.edit_message_text(text, parse_mode='HTML')
 
     elif data == "admin_users":
@@ -93,6 +111,9 @@ async def admin_callback_handler(update: Update, context: ContextTypes.DEFAULT_T
     elif data == "admin_support_tickets":
         await admin_support_tickets_with_buttons(update, context)
 
+    elif data == "admin_broadcast":
+        await show_broadcasts(update, context)
+
 
 async def admin_support_tickets_with_buttons(update: Update, context: ContextTypes.DEFAULT_TYPE):
     query = update.callback_query
@@ -111,6 +132,8 @@ async def admin_support_tickets_with_buttons(update: Update, context: ContextTyp
         await query.edit_message_text("📭 Нет открытых тикетов")
         return
 
+    outbox = context.application.bot_data['outbox']
+    sends = []
     for t in tickets:
         username = f"@{t['username']}" if t['username'] else t['first_name']
         created = t['created_at'].strftime('%d.%m %H:%M')
@@ -124,16 +147,18 @@ async def admin_support_tickets_with_buttons(update: Update, context: ContextTyp
         ]
         reply_markup = InlineKeyboardMarkup(keyboard)
 
-        await context.bot.send_message(
-            chat_id=query.message.chat_id,
-            text=text,
+        sends.append(outbox.send_message(
+            query.message.chat_id,
+            text,
             reply_markup=reply_markup,
             parse_mode='HTML'
-        )
+        ))
 
-    await context.bot.send_message(
-        chat_id=query.message.chat_id,
-        text="👆 Используйте кнопки под каждым тикетом",
+    # Тикеты уходят через общую очередь с темпом на чат, подсказка — последней
+    await asyncio.gather(*sends, return_exceptions=True)
+    await outbox.send_message(
+        query.message.chat_id,
+        "👆 Используйте кнопки под каждым тикетом",
         reply_markup=InlineKeyboardMarkup([[
             InlineKeyboardButton("⬅️ Назад", callback_data="admin_back")
         ]])
@@ -175,9 +200,9 @@ async def admin_ticket_action(update: Update, context: ContextTypes.DEFAULT_TYPE
         await pool.execute("UPDATE support_tickets SET status = 'closed' WHERE ticket_id = $1", ticket_id)
         username = f"@{row['username']}" if row['username'] else "Пользователь"
         try:
-            await context.bot.send_message(
-                chat_id=row['user_id'],
-                text=f"🎫 Ваш тикет <code>{ticket_id}</code> закрыт.\n\nСпасибо за обращение!",
+            await context.application.bot_data['outbox'].send_message(
+                row['user_id'],
+                f"🎫 Ваш тикет <code>{ticket_id}</code> закрыт.\n\nСпасибо за обращение!",
                 parse_mode='HTML'
             )
         except Exception as e:
@@ -205,26 +230,27 @@ async def forward_admin_reply(update: Update, context: ContextTypes.DEFAULT_TYPE
 
     user_id = row['user_id']
     username = f"@{row['username']}" if row['username'] else "Пользователь"
+    outbox = context.application.bot_data['outbox']
 
     try:
         if update.message.text:
-            await context.bot.send_message(
-                chat_id=user_id,
-                text=f"💬 Администратор:\n\n{update.message.text_html}",
+            await outbox.send_message(
+                user_id,
+                f"💬 Администратор:\n\n{update.message.text_html}",
                 parse_mode='HTML'
             )
         elif update.message.photo:
             caption = update.message.caption_html or ""
-            await context.bot.send_photo(
-                chat_id=user_id,
+            await outbox.submit(
+                "send_photo", user_id, INTERACTIVE,
                 photo=update.message.photo[-1].file_id,
                 caption=f"🖼️ Администратор:\n\n{caption}",
                 parse_mode='HTML'
             )
         elif update.message.document:
             caption = update.message.caption_html or ""
-            await context.bot.send_document(
-                chat_id=user_id,
+            await outbox.submit(
+                "send_document", user_id, INTERACTIVE,
                 document=update.message.document.file_id,
                 caption=f"📎 Администратор:\n\n{caption}",
                 parse_mode='HTML'
@@ -0,0 +1,307 @@
+# bot/features/alerts.py
+import asyncio
+import os
+import re
+from array import array
+from bisect import bisect_left, bisect_right
+
+from telegram import Update, InlineKeyboardMarkup, InlineKeyboardButton
+from telegram.ext import ContextTypes, CommandHandler, CallbackQueryHandler
+from loguru import logger
+
+from database import get_user_lang
+from bot.outbox import NOTIFY
+from bot.rates import RateTable
+
+ALERTS_PER_USER = 20
+# Индекс живёт в памяти каждой реплики: /alert и удаление меняют только ту,
+# что обработала команду, поэтому остальные перечитывают правила из БД
+ALERTS_RELOAD_INTERVAL = int(os.getenv("ALERTS_RELOAD_INTERVAL", 300))
+
+TEXTS = {
+    "ru": {
+        "usage": "📌 Использование:\n<code>/alert USD &gt; 100</code> — курс выше\n<code>/alert EUR &lt; 90</code> — курс ниже\n<code>/alert CNY 2%</code> — изменение больше чем на 2%\n\nСписок: /alerts",
+        "unknown": "❌ Неизвестная валюта: {code}",
+        "no_rates": "❌ Курсы сейчас недоступны. Повторите позже.",
+        "limit": "❌ Не больше {limit} уведомлений.",
+        "already": "ℹ️ Условие уже выполнено: курс {code} сейчас {rate} ₽.",
+        "added": "✅ Уведомлю, когда {rule} (сейчас {rate} ₽)",
+        "none": "📭 У вас нет активных уведомлений о курсах.",
+        "list_title": "🔔 Уведомления о курсах:\n\n",
+        "deleted": "🗑 Уведомление удалено.",
+        "triggered": "🔔 <b>{code}</b>: {rule}\n\nКурс ЦБ РФ: <b>{rate} ₽</b>",
+        "rule": {">": "{code} выше {threshold} ₽", "<": "{code} ниже {threshold} ₽", "%": "{code} изменится больше чем на {threshold}% (от {base} ₽)"},
+    },
+    "en": {
+        "usage": "📌 Usage:\n<code>/alert USD &gt; 100</code> — rate above\n<code>/alert EUR &lt; 90</code> — rate below\n<code>/alert CNY 2%</code> — moves more than 2%\n\nList: /alerts",
+        "unknown": "❌ Unknown currency: {code}",
+        "no_rates": "❌ Rates are unavailable right now. Try again later.",
+        "limit": "❌ No more than {limit} alerts.",
+        "already": "ℹ️ The condition is already met: {code} is {rate} RUB now.",
+        "added": "✅ I'll notify you when {rule} (now {rate} RUB)",
+        "none": "📭 You have no active rate alerts.",
+        "list_title": "🔔 Rate alerts:\n\n",
+        "deleted": "🗑 Alert deleted.",
+        "triggered": "🔔 <b>{code}</b>: {rule}\n\nCBR rate: <b>{rate} RUB</b>",
+        "rule": {">": "{code} goes above {threshold} RUB", "<": "{code} goes below {threshold} RUB", "%": "{code} moves more than {threshold}% (from {base} RUB)"},
+    }
+}
+
+
+# --- Индекс правил в памяти ---
+class AlertIndex:
+    """
+    Активные правила по валютам: для каждой валюты два отсортированных массива
+    порогов — «сработать, когда курс выше» и «когда ниже» — с параллельными
+    массивами id. Правило «изменение на N%» превращается в пару порогов от
+    базового курса. Проверка всех правил валюты — два bisect, сработавшие
+    правила — непрерывный срез массива.
+    """
+
+    def __init__(self):
+        self._above = {}  # код -> (array пороги, array id)
+        self._below = {}
+        self._count = 0
+
+    def __len__(self) -> int:
+        return self._count
+
+    async def load(self, pool):
+        rows = await pool.fetch("SELECT id, code, op, threshold, base FROM currency_alerts WHERE active")
+        above, below = {}, {}
+        for row in rows:
+            for side, limit in self._limits(row["op"], row["threshold"], row["base"]):
+                (above if side == ">" else below).setdefault(row["code"], []).append((limit, row["id"]))
+        self._above = {code: self._pack(items) for code, items in above.items()}
+        self._below = {code: self._pack(items) for code, items in below.items()}
+        self._count = len(rows)
+        logger.info(f"🔔 Загружено уведомлений о курсах: {self._count}")
+
+    @staticmethod
+    def _pack(items: list) -> tuple:
+        items.sort()
+        return array("d", (limit for limit, _ in items)), array("q", (alert_id for _, alert_id in items))
+
+    @staticmethod
+    def _limits(op: str, threshold: float, base: float) -> list:
+        if op == "%":
+            return [(">", base * (1 + threshold / 100)), ("<", base * (1 - threshold / 100))]
+        return [(op, threshold)]
+
+    def add(self, alert_id: int, code: str, op: str, threshold: float, base: float):
+        for side, limit in self._limits(op, threshold, base):
+            index = self._above if side == ">" else self._below
+            limits, ids = index.setdefault(code, (array("d"), array("q")))
+            position = bisect_right(limits, limit)
+            limits.insert(position, limit)
+            ids.insert(position, alert_id)
+        self._count += 1
+
+    def remove(self, alert_id: int, code: str):
+        found = False
+        for index in (self._above, self._below):
+            if code not in index:
+                continue
+            limits, ids = index[code]
+            try:
+                position = ids.index(alert_id)
+            except ValueError:
+                continue
+            del limits[position], ids[position]
+            found = True
+        if found:
+            self._count -= 1
+
+    def evaluate(self, table: RateTable) -> set:
+        """
+        Снимает с индекса и возвращает id сработавших правил.
+        """
+        triggered, codes = set(), set()
+        for code, (limits, ids) in self._above.items():
+            if code in table:
+                cut = bisect_left(limits, table.rate(code))
+                if cut:
+                    triggered.update(ids[:cut])
+                    codes.add(code)
+                    del limits[:cut], ids[:cut]
+        for code, (limits, ids) in self._below.items():
+            if code in table:
+                cut = bisect_right(limits, table.rate(code))
+                if cut < len(limits):
+                    triggered.update(ids[cut:])
+                    codes.add(code)
+                    del limits[cut:], ids[cut:]
+
+        # Вторая граница правил «на N%» остаётся в другом массиве той же валюты
+        for code in codes:
+            for index in (self._above, self._below):
+                if code not in index:
+                    continue
+                limits, ids = index[code]
+                for position in reversed([i for i, alert_id in enumerate(ids) if alert_id in triggered]):
+                    del limits[position], ids[position]
+        self._count -= len(triggered)
+        return triggered
+
+
+def format_rule(texts: dict, code: str, op: str, threshold: float, base: float) -> str:
+    return texts["rule"][op].format(code=code, threshold=f"{threshold:g}", base=f"{base:.2f}" if base else "")
+
+
+def parse_alert(args: list):
+    """
+    «USD > 100», «USD>100», «EUR 2%» → (код, оператор, порог) или None.
+    """
+    match = re.fullmatch(r"([A-Za-z]{3})\s*(?:([<>])\s*(\d+(?:[.,]\d+)?)|(\d+(?:[.,]\d+)?)\s*%)", " ".join(args).strip())
+    if not match:
+        return None
+    code = match.group(1).upper()
+    if match.group(2):
+        return code, match.group(2), float(match.group(3).replace(",", "."))
+    percent = float(match.group(4).replace(",", "."))
+    return (code, "%", percent) if percent > 0 else None
+
+
+# --- Команды ---
+async def cmd_alert(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    user = update.effective_user
+    pool = context.application.bot_data['db_pool']
+    lang = await get_user_lang(pool, user.id)
+    texts = TEXTS[lang]
+
+    parsed = parse_alert(context.args or [])
+    if not parsed:
+        await update.message.reply_html(texts["usage"])
+        return
+    code, op, threshold = parsed
+
+    table = await context.application.bot_data['rates'].get_table()
+    if not table:
+        await update.message.reply_text(texts["no_rates"])
+        return
+    if code not in table or code == "RUB":
+        await update.message.reply_text(texts["unknown"].format(code=code))
+        return
+
+    base = table.rate(code)
+    # Правила срабатывают по уровню: уже выполненное сработало бы при первом же обновлении
+    if (op == ">" and base > threshold) or (op == "<" and base < threshold):
+        await update.message.reply_text(texts["already"].format(code=code, rate=f"{base:.2f}"))
+        return
+
+    alert_id = await pool.fetchval('''
+        INSERT INTO currency_alerts (user_id, code, op, threshold, base)
+        SELECT $1, $2, $3, $4, $5
+        WHERE (SELECT COUNT(*) FROM currency_alerts WHERE user_id = $1 AND active) < $6
+        RETURNING id
+    ''', user.id, code, op, threshold, base, ALERTS_PER_USER)
+    if alert_id is None:
+        await update.message.reply_text(texts["limit"].format(limit=ALERTS_PER_USER))
+        return
+
+    context.application.bot_data['alerts'].add(alert_id, code, op, threshold, base)
+    await update.message.reply_html(texts["added"].format(
+        rule=format_rule(texts, code, op, threshold, base), rate=f"{base:.2f}"
+    ))
+
+
+async def cmd_alerts(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    user = update.effective_user
+    pool = context.application.bot_data['db_pool']
+    lang = await get_user_lang(pool, user.id)
+    texts = TEXTS[lang]
+
+    rows = await pool.fetch('''
+        SELECT id, code, op, threshold, base FROM currency_alerts
+        WHERE user_id = $1 AND active ORDER BY id
+    ''', user.id)
+    if not rows:
+        await update.message.reply_text(texts["none"])
+        return
+
+    message = texts["list_title"]
+    keyboard = []
+    for row in rows:
+        message += f"#{row['id']} — {format_rule(texts, row['code'], row['op'], row['threshold'], row['base'])}\n"
+        keyboard.append([InlineKeyboardButton(f"🗑 #{row['id']}", callback_data=f"alert_del_{row['id']}")])
+    await update.message.reply_html(message, reply_markup=InlineKeyboardMarkup(keyboard))
+
+
+async def alert_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    query = update.callback_query
+    await query.answer()
+    pool = context.application.bot_data['db_pool']
+    texts = TEXTS[await get_user_lang(pool, query.from_user.id)]
+
+    alert_id = int(query.data.rsplit("_", 1)[1])
+    code = await pool.fetchval('''
+        UPDATE currency_alerts SET active = FALSE
+        WHERE id = $1 AND user_id = $2 AND active
+        RETURNING code
+    ''', alert_id, query.from_user.id)
+    if code:
+        context.application.bot_data['alerts'].remove(alert_id, code)
+    await query.edit_message_text(texts["deleted"])
+
+
+# --- Проверка при обновлении курсов ---
+def make_rates_listener(application):
+    async def on_rates_refresh(table: RateTable):
+        index = application.bot_data['alerts']
+        triggered = index.evaluate(table)
+        if not triggered:
+            return
+
+        pool = application.bot_data['db_pool']
+        rows = await pool.fetch('''
+            UPDATE currency_alerts SET active = FALSE, triggered_at = NOW()
+            WHERE id = ANY($1::int[]) AND active
+            RETURNING id, user_id, code, op, threshold, base
+        ''', list(triggered))
+
+        outbox = application.bot_data['outbox']
+
+        async def notify(row):
+            texts = TEXTS[await get_user_lang(pool, row["user_id"])]
+            try:
+                await outbox.send_message(
+                    row["user_id"],
+                    texts["triggered"].format(
+                        code=row["code"],
+                        rule=format_rule(texts, row["code"], row["op"], row["threshold"], row["base"]),
+                        rate=f"{table.rate(row['code']):.2f}",
+                    ),
+                    priority=NOTIFY,
+                    parse_mode='HTML'
+                )
+            except Exception as e:
+                logger.warning(f"⚠️ Уведомление о курсе {row['id']} не доставлено: {e}")
+
+        await asyncio.gather(*(notify(row) for row in rows))
+        logger.info(f"🔔 Сработало уведомлений о курсах: {len(rows)} (осталось {len(index)})")
+
+    return on_rates_refresh
+
+
+async def reload_alerts(context: ContextTypes.DEFAULT_TYPE):
+    # Повторная загрузка безопасна: сработавшее правило гасится UPDATE ... WHERE active
+    try:
+        await context.application.bot_data['alerts'].load(context.application.bot_data['db_pool'])
+    except Exception as e:
+        logger.warning(f"⚠️ Не удалось перечитать уведомления о курсах: {e}")
+
+
+async def start_alerts(context: ContextTypes.DEFAULT_TYPE):
+    application = context.application
+    index = application.bot_data['alerts']
+    await index.load(application.bot_data['db_pool'])
+    application.bot_data['rates'].add_listener(make_rates_listener(application))
+
+
+def setup_alert_handlers(app):
+    app.bot_data['alerts'] = AlertIndex()
+    app.add_handler(CommandHandler("alert", cmd_alert))
+    app.add_handler(CommandHandler("alerts", cmd_alerts))
+    app.add_handler(CallbackQueryHandler(alert_callback, pattern="^alert_del_"))
+    app.job_queue.run_once(start_alerts, when=0)
+    app.job_queue.run_repeating(reload_alerts, interval=ALERTS_RELOAD_INTERVAL, first=ALERTS_RELOAD_INTERVAL)
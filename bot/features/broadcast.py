@@ -0,0 +1,244 @@
+# bot/features/broadcast.py
+import asyncio
+import os
+import uuid
+
+from telegram import Update, InlineKeyboardMarkup, InlineKeyboardButton
+from telegram.error import BadRequest, Forbidden, TimedOut, NetworkError
+from telegram.ext import (
+    ApplicationHandlerStop,
+    ContextTypes,
+    CallbackQueryHandler,
+    MessageHandler,
+    filters,
+)
+from loguru import logger
+
+from database import is_admin
+from bot.outbox import BULK, Outbox
+
+# --- Рассылка ---
+# Получатели читаются порциями (keyset по users.id), отправка идёт через общую
+# очередь с самым низким приоритетом (общий лимит и RetryAfter учитывает она),
+# прогресс после каждой порции сохраняется в broadcasts. После перезапуска
+# рассылка продолжается с last_user_id; сообщения текущей (незавершённой)
+# порции могут уйти повторно.
+# Рассылку ведёт одна реплика: она берёт аренду строки broadcasts
+# (claim_token, claimed_until) и продлевает её с каждой порцией. Соединение
+# из пула занимается только на время отдельных запросов. Если реплика упала,
+# через BROADCAST_LEASE секунд рассылку подхватит другая.
+# BROADCAST_CONCURRENCY ограничивает, сколько сообщений рассылки стоит в очереди.
+BROADCAST_CHUNK = int(os.getenv("BROADCAST_CHUNK", 200))
+BROADCAST_CONCURRENCY = int(os.getenv("BROADCAST_CONCURRENCY", 30))
+BROADCAST_LEASE = int(os.getenv("BROADCAST_LEASE", 300))
+
+STATUS_TEXT = {"running": "⏳ идёт", "done": "✅ завершена", "cancelled": "⏹ остановлена"}
+
+
+async def send_broadcast_message(outbox: Outbox, user_id: int, text: str):
+    """
+    Отправляет одно сообщение рассылки. Возвращает None при успехе или причину сбоя.
+    """
+    for _ in range(3):
+        try:
+            await outbox.send_message(user_id, text, priority=BULK, parse_mode='HTML')
+            return None
+        except Forbidden:
+            return "blocked"
+        except BadRequest as e:
+            return "not_found" if "chat not found" in str(e).lower() else "bad_request"
+        except (TimedOut, NetworkError):
+            await asyncio.sleep(1)
+        except Exception:
+            break
+    return "error"
+
+
+async def run_broadcast(application, broadcast_id: int):
+    pool = application.bot_data['db_pool']
+    outbox = application.bot_data['outbox']
+    semaphore = asyncio.Semaphore(BROADCAST_CONCURRENCY)
+    token = uuid.uuid4().hex
+
+    row = await pool.fetchrow("""
+        UPDATE broadcasts
+        SET claim_token = $2, claimed_until = NOW() + $3 * INTERVAL '1 second'
+        WHERE id = $1 AND status = 'running'
+          AND (claimed_until IS NULL OR claimed_until < NOW())
+        RETURNING text, last_user_id
+    """, broadcast_id, token, BROADCAST_LEASE)
+    if not row:
+        return  # завершена или её ведёт другая реплика
+
+    text, last_user_id = row["text"], row["last_user_id"]
+    logger.info(f"📣 Рассылка #{broadcast_id}: старт с user_id > {last_user_id}")
+
+    async def deliver(user_id):
+        async with semaphore:
+            return user_id, await send_broadcast_message(outbox, user_id, text)
+
+    try:
+        while True:
+            recipients = [
+                record["id"] for record in await pool.fetch(
+                    "SELECT id FROM users WHERE id > $1 ORDER BY id LIMIT $2",
+                    last_user_id, BROADCAST_CHUNK
+                )
+            ]
+            if not recipients:
+                await pool.execute("""
+                    UPDATE broadcasts SET status = 'done', updated_at = NOW(), finished_at = NOW()
+                    WHERE id = $1 AND status = 'running' AND claim_token = $2
+                """, broadcast_id, token)
+                logger.info(f"✅ Рассылка #{broadcast_id} завершена")
+                return
+
+            results = await asyncio.gather(*(deliver(user_id) for user_id in recipients))
+            failures = [(user_id, reason) for user_id, reason in results if reason]
+            if failures:
+                await pool.execute("""
+                    INSERT INTO broadcast_failures (broadcast_id, user_id, reason)
+                    SELECT $1, f.user_id, f.reason
+                    FROM UNNEST($2::bigint[], $3::text[]) AS f(user_id, reason)
+                    ON CONFLICT DO NOTHING
+                """, broadcast_id, [f[0] for f in failures], [f[1] for f in failures])
+
+            last_user_id = recipients[-1]
+            # Прогресс пишется и аренда продлевается, только пока она наша
+            status = await pool.fetchval("""
+                UPDATE broadcasts
+                SET last_user_id = $2, sent = sent + $3, failed = failed + $4, updated_at = NOW(),
+                    claimed_until = NOW() + $6 * INTERVAL '1 second'
+                WHERE id = $1 AND claim_token = $5
+                RETURNING status
+            """, broadcast_id, last_user_id, len(recipients) - len(failures), len(failures),
+                token, BROADCAST_LEASE)
+            if status is None:
+                logger.warning(f"⚠️ Рассылка #{broadcast_id}: аренда перешла к другой реплике")
+                return
+            if status != "running":
+                logger.info(f"⏹ Рассылка #{broadcast_id} остановлена")
+                return
+    except Exception as e:
+        logger.exception(f"❌ Рассылка #{broadcast_id} прервана: {e}")
+    finally:
+        try:
+            await pool.execute("""
+                UPDATE broadcasts SET claim_token = NULL, claimed_until = NULL
+                WHERE id = $1 AND claim_token = $2
+            """, broadcast_id, token)
+        except Exception as e:
+            logger.warning(f"⚠️ Рассылка #{broadcast_id}: не удалось снять аренду: {e}")
+
+
+async def resume_broadcasts(context: ContextTypes.DEFAULT_TYPE):
+    pool = context.application.bot_data.get('db_pool')
+    if not pool:
+        return
+    # Запускается периодически: так подхватываются и рассылки упавших реплик
+    rows = await pool.fetch("""
+        SELECT id FROM broadcasts
+        WHERE status = 'running' AND (claimed_until IS NULL OR claimed_until < NOW())
+        ORDER BY id
+    """)
+    for row in rows:
+        context.application.create_task(run_broadcast(context.application, row["id"]))
+    if rows:
+        logger.info(f"📣 Возобновлено рассылок: {len(rows)}")
+
+
+# --- Интерфейс администратора ---
+async def show_broadcasts(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    query = update.callback_query
+    pool = context.application.bot_data['db_pool']
+    rows = await pool.fetch("""
+        SELECT id, status, total, sent, failed, created_at
+        FROM broadcasts ORDER BY id DESC LIMIT 5
+    """)
+
+    text = "📣 <b>Рассылки</b>\n\n"
+    keyboard = [[InlineKeyboardButton("✏️ Новая рассылка", callback_data="bcast_new")]]
+    if not rows:
+        text += "Пока не было ни одной рассылки."
+    for r in rows:
+        done = r["sent"] + r["failed"]
+        percent = min(100, done * 100 // r["total"]) if r["total"] else 100
+        text += (
+            f"#{r['id']} {STATUS_TEXT.get(r['status'], r['status'])} — {percent}%\n"
+            f"📬 {r['sent']} / {r['total']}, ❌ {r['failed']} · {r['created_at'].strftime('%d.%m %H:%M')}\n\n"
+        )
+        if r["status"] == "running":
+            keyboard.append([InlineKeyboardButton(f"⏹ Остановить #{r['id']}", callback_data=f"bcast_stop_{r['id']}")])
+    keyboard.append([
+        InlineKeyboardButton("🔄 Обновить", callback_data="bcast_list"),
+        InlineKeyboardButton("⬅️ Назад", callback_data="admin_back")
+    ])
+
+    try:
+        await query.edit_message_text(text, reply_markup=InlineKeyboardMarkup(keyboard), parse_mode='HTML')
+    except BadRequest:
+        pass  # Сообщение не изменилось
+
+
+async def broadcast_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    query = update.callback_query
+    await query.answer()
+    pool = context.application.bot_data['db_pool']
+    if not await is_admin(pool, query.from_user.id):
+        return
+
+    data = query.data
+    if data == "bcast_list":
+        await show_broadcasts(update, context)
+
+    elif data == "bcast_new":
+        context.user_data['awaiting_broadcast'] = True
+        await query.edit_message_text(
+            "✏️ Отправьте текст рассылки (HTML-разметка сохранится).",
+            reply_markup=InlineKeyboardMarkup([[
+                InlineKeyboardButton("❌ Отмена", callback_data="bcast_cancel_input")
+            ]])
+        )
+
+    elif data == "bcast_cancel_input":
+        context.user_data.pop('awaiting_broadcast', None)
+        await show_broadcasts(update, context)
+
+    elif data.startswith("bcast_stop_"):
+        broadcast_id = int(data.rsplit("_", 1)[1])
+        await pool.execute("""
+            UPDATE broadcasts SET status = 'cancelled', updated_at = NOW(), finished_at = NOW()
+            WHERE id = $1 AND status = 'running'
+        """, broadcast_id)
+        await show_broadcasts(update, context)
+
+
+async def handle_broadcast_text(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    if not context.user_data.get('awaiting_broadcast') or not update.message:
+        return
+    pool = context.application.bot_data['db_pool']
+    admin_id = update.effective_user.id
+    if not await is_admin(pool, admin_id):
+        return
+    context.user_data.pop('awaiting_broadcast', None)
+
+    total = await pool.fetchval("SELECT COUNT(*) FROM users")
+    broadcast_id = await pool.fetchval(
+        "INSERT INTO broadcasts (admin_id, text, total) VALUES ($1, $2, $3) RETURNING id",
+        admin_id, update.message.text_html, total
+    )
+    context.application.create_task(run_broadcast(context.application, broadcast_id))
+    await update.message.reply_text(
+        f"🚀 Рассылка #{broadcast_id} запущена: {total} получателей",
+        reply_markup=InlineKeyboardMarkup([[
+            InlineKeyboardButton("📊 Прогресс", callback_data="bcast_list")
+        ]])
+    )
+    # Текст рассылки не должен попасть в другие обработчики (город, поддержка, FAQ)
+    raise ApplicationHandlerStop
+
+
+def setup_broadcast_handlers(app):
+    app.add_handler(CallbackQueryHandler(broadcast_callback, pattern="^bcast_"), group=40)
+    app.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, handle_broadcast_text), group=1)
+    app.job_queue.run_repeating(resume_broadcasts, interval=BROADCAST_LEASE, first=10)
@@ -1,14 +1,16 @@
 # bot/features/currency.py
 
-import httpx
-from telegram import Update
-from telegram.ext import ContextTypes, CommandHandler
-from loguru import logger
+import re
+from datetime import date
+from typing import Optional
+from uuid import uuid4
 
-from database import get_db_pool
+from telegram import Update, InlineQueryResultArticle, InputTextMessageContent
+from telegram.ext import ContextTypes, CommandHandler, InlineQueryHandler
+from loguru import logger
 
-# Официальный API ЦБ РФ
-CURRENCY_API = "https://www.cbr-xml-daily.ru/latest.js"
+from database import get_db_pool, get_user_lang, save_currency_rates, get_currency_series
+from bot.rates import RATES_TTL, RateTable
 
 # Коды валют
 CURRENCIES = {
@@ -16,26 +18,116 @@ CURRENCIES = {
     "EUR": {"name": {"ru": "Евро", "en": "Euro"}, "symbol": "€"},
     "GBP": {"name": {"ru": "Фунт стерлингов", "en": "British Pound"}, "symbol": "£"},
     "CNY": {"name": {"ru": "Китайский юань", "en": "Chinese Yuan"}, "symbol": "¥"},
+    "JPY": {"name": {"ru": "Японская иена", "en": "Japanese Yen"}, "symbol": "¥"},
+    "RUB": {"name": {"ru": "Российский рубль", "en": "Russian Ruble"}, "symbol": "₽"},
 }
 
+# Валюты в ответе на /currency без аргументов
+DEFAULT_CODES = ["USD", "EUR", "GBP", "CNY", "JPY"]
+
 # Тексты
 TEXTS = {
     "ru": {
         "title": "💱 Курсы валют на {date}:\n\n",
+        "title_all": "💱 Все курсы ЦБ РФ на {date}:\n\n",
         "rate": "<b>{name}</b> ({code} {symbol}): {value} ₽\n",
+        "rate_short": "{code}: {value} ₽\n",
+        "conversion": "💱 {amount} {from_code} = <b>{result} {to_code}</b>\n\n1 {from_code} = {rate} {to_code}\n📅 Курс ЦБ РФ на {date}",
+        "usage": "\n📌 <code>/currency 100 USD EUR</code> — конвертация\n<code>/currency all</code> — все валюты",
+        "unknown": "❌ Неизвестная валюта: {code}\n\nДоступно: {codes}",
+        "history_usage": "📌 Использование: <code>/history USD</code> или <code>/history EUR month</code>",
+        "history_title": "📈 <b>{code}</b> по {period}:\n\n",
+        "history_period": {"week": "неделям", "month": "месяцам"},
+        "history_row": "{period}: {min} – {max} ₽, в среднем {avg} ₽\n",
+        "history_empty": "📭 Истории по {code} пока нет.",
         "error": "❌ Не удалось получить курсы. Повторите позже.",
+        "stale": "\n⚠️ Сервис ЦБ недоступен, показаны последние полученные курсы.",
     },
     "en": {
         "title": "💱 Exchange rates for {date}:\n\n",
+        "title_all": "💱 All CBR rates for {date}:\n\n",
         "rate": "<b>{name}</b> ({code} {symbol}): {value} RUB\n",
+        "rate_short": "{code}: {value} RUB\n",
+        "conversion": "💱 {amount} {from_code} = <b>{result} {to_code}</b>\n\n1 {from_code} = {rate} {to_code}\n📅 CBR rate for {date}",
+        "usage": "\n📌 <code>/currency 100 USD EUR</code> — convert\n<code>/currency all</code> — all currencies",
+        "unknown": "❌ Unknown currency: {code}\n\nAvailable: {codes}",
+        "history_usage": "📌 Usage: <code>/history USD</code> or <code>/history EUR month</code>",
+        "history_title": "📈 <b>{code}</b> by {period}:\n\n",
+        "history_period": {"week": "week", "month": "month"},
+        "history_row": "{period}: {min} – {max} RUB, avg {avg} RUB\n",
+        "history_empty": "📭 No history for {code} yet.",
         "error": "❌ Failed to fetch rates. Try again later.",
+        "stale": "\n⚠️ The CBR service is unavailable, showing the last known rates.",
     }
 }
 
-
-async def get_user_lang(pool, user_id: int) -> str:
-    lang = await pool.fetchval("SELECT language FROM users WHERE id = $1", user_id)
-    return lang or "ru"
+# Слова-связки, которые можно писать между валютами: «100 usd в eur»
+CONNECTORS = {"to", "in", "в", "во", "->", "="}
+
+# Код валюты — три латинские буквы; остальное не попадает в HTML-ответ
+CODE_RE = re.compile(r"[A-Za-z]{3}")
+
+
+def format_amount(value: float) -> str:
+    if abs(value) >= 1:
+        return f"{value:,.2f}".replace(",", " ")
+    return f"{value:.4g}"
+
+
+def parse_conversion(tokens: list) -> Optional[tuple]:
+    """
+    Разбирает «[сумма] FROM [TO]» → (amount, FROM, TO). TO по умолчанию — RUB.
+    None, если это не запрос конвертации (в том числе коды не из трёх букв).
+    """
+    tokens = [t for t in tokens if t.lower() not in CONNECTORS]
+    if not tokens:
+        return None
+    amount = 1.0
+    if re.fullmatch(r"\d+(?:[.,]\d+)?", tokens[0]):
+        amount = float(tokens[0].replace(",", "."))
+        tokens = tokens[1:]
+    if not tokens or len(tokens) > 2:
+        return None
+    if not all(CODE_RE.fullmatch(token) for token in tokens):
+        return None
+    from_code = tokens[0].upper()
+    to_code = tokens[1].upper() if len(tokens) > 1 else "RUB"
+    return amount, from_code, to_code
+
+
+def render_conversion(table: RateTable, texts: dict, amount: float, from_code: str, to_code: str) -> str:
+    for code in (from_code, to_code):
+        if code not in table:
+            return texts["unknown"].format(code=code, codes=", ".join(table.codes))
+    return texts["conversion"].format(
+        amount=format_amount(amount),
+        from_code=from_code,
+        to_code=to_code,
+        result=format_amount(table.convert(amount, from_code, to_code)),
+        rate=format_amount(table.rate(from_code, to_code)),
+        date=table.date[:10],
+    )
+
+
+def render_rates(table: RateTable, texts: dict, lang: str, show_all: bool) -> str:
+    if show_all:
+        message = texts["title_all"].format(date=table.date[:10])
+        for code in table.codes:
+            if code != "RUB":
+                message += texts["rate_short"].format(code=code, value=format_amount(table.rate(code)))
+        return message
+
+    message = texts["title"].format(date=table.date[:10])
+    for code in DEFAULT_CODES:
+        if code in table:
+            currency_info = CURRENCIES[code]
+            message += texts["rate"].format(
+                name=currency_info["name"][lang],
+                code=code,
+                symbol=currency_info["symbol"],
+                value=format_amount(table.rate(code))
+            )
+    return message + texts["usage"]
 
 
 async def cmd_currency(update: Update, context: ContextTypes.DEFAULT_TYPE):
@@ -44,39 +136,114 @@ async def cmd_currency(update: Update, context: ContextTypes.DEFAULT_TYPE):
     lang = await get_user_lang(pool, user.id)
     texts = TEXTS[lang]
 
-    try:
-        async with httpx.AsyncClient() as client:
-            response = await client.get(CURRENCY_API, timeout=10.0)
-        if response.status_code != 200:
-            await update.message.reply_text(texts["error"])
-            return
-
-        data = response.json()
-        rates = data["rates"]
-        date = data["date"]
-
-        message = texts["title"].format(date=date)
-
-        # Формируем сообщение
-        for code in ["USD", "EUR", "GBP", "CNY"]:
-            if code in rates:
-                value = round(rates[code], 2)
-                currency_info = CURRENCIES[code]
-                name = currency_info["name"][lang]
-                symbol = currency_info["symbol"]
-                message += texts["rate"].format(
-                    name=name,
-                    code=code,
-                    symbol=symbol,
-                    value=value
-                )
-
-        await update.message.reply_html(message)
+    rates_service = context.application.bot_data['rates']
+    table = await rates_service.get_table()
+    if not table:
+        await update.message.reply_text(texts["error"])
+        return
+
+    args = context.args or []
+    show_all = bool(args) and args[0].lower() == "all"
+    parsed = parse_conversion(args) if not show_all else None
+    if parsed:
+        message = render_conversion(table, texts, *parsed)
+    else:
+        message = render_rates(table, texts, lang, show_all)
+    if rates_service.serving_stale():
+        message += texts["stale"]
+
+    await update.message.reply_html(message)
+
+
+# --- Инлайн-режим: «@bot 100 usd eur» ---
+async def inline_currency(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    inline_query = update.inline_query
+    parsed = parse_conversion(inline_query.query.split())
+    if not parsed:
+        await inline_query.answer([], cache_time=60)
+        return
+
+    table = await context.application.bot_data['rates'].get_table()
+    amount, from_code, to_code = parsed
+    if not table or from_code not in table or to_code not in table:
+        await inline_query.answer([], cache_time=60)
+        return
+
+    pool = context.application.bot_data['db_pool']
+    texts = TEXTS[await get_user_lang(pool, inline_query.from_user.id)]
+    result = format_amount(table.convert(amount, from_code, to_code))
+    await inline_query.answer([
+        InlineQueryResultArticle(
+            id=str(uuid4()),
+            title=f"{format_amount(amount)} {from_code} = {result} {to_code}",
+            description=f"1 {from_code} = {format_amount(table.rate(from_code, to_code))} {to_code}",
+            input_message_content=InputTextMessageContent(
+                render_conversion(table, texts, amount, from_code, to_code),
+                parse_mode='HTML'
+            ),
+        )
+    ], cache_time=60)
+
+
+# --- История курсов ---
+async def cmd_history(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    user = update.effective_user
+    pool = context.application.bot_data['db_pool']
+    lang = await get_user_lang(pool, user.id)
+    texts = TEXTS[lang]
 
+    args = context.args or []
+    if not args or len(args) > 2:
+        await update.message.reply_html(texts["history_usage"])
+        return
+    code = args[0].upper()
+    period = args[1].lower() if len(args) > 1 else "week"
+    if not CODE_RE.fullmatch(code) or period not in ("week", "month"):
+        await update.message.reply_html(texts["history_usage"])
+        return
+
+    rows = await get_currency_series(pool, code, period, days=90 if period == "week" else 365)
+    if not rows:
+        await update.message.reply_text(texts["history_empty"].format(code=code))
+        return
+
+    message = texts["history_title"].format(code=code, period=texts["history_period"][period])
+    for row in rows:
+        message += texts["history_row"].format(
+            period=row["period"].strftime("%d.%m.%Y" if period == "week" else "%m.%Y"),
+            min=format_amount(row["min"]),
+            max=format_amount(row["max"]),
+            avg=format_amount(row["avg"]),
+        )
+    await update.message.reply_html(message)
+
+
+def make_history_listener(application):
+    async def store_rates(table: RateTable):
+        values = {code: table.rate(code) for code in table.codes if code != "RUB"}
+        await save_currency_rates(application.bot_data['db_pool'], date.fromisoformat(table.date[:10]), values)
+
+    return store_rates
+
+
+async def start_rate_history(context: ContextTypes.DEFAULT_TYPE):
+    context.application.bot_data['rates'].add_listener(make_history_listener(context.application))
+
+
+# --- Плановое обновление курсов ---
+async def refresh_rates_job(context: ContextTypes.DEFAULT_TYPE):
+    rates = context.application.bot_data.get('rates')
+    if not rates:
+        return
+    try:
+        await rates.refresh()
     except Exception as e:
-        logger.error(f"❌ Ошибка при получении курсов: {e}")
-        await update.message.reply_text(texts["error"])
+        logger.warning(f"⚠️ Плановое обновление курсов не удалось: {e}")
 
 
 def setup_currency_handlers(app):
-    app.add_handler(CommandHandler("currency", cmd_currency))
\ No newline at end of file
+    app.add_handler(CommandHandler("currency", cmd_currency))
+    app.add_handler(CommandHandler("history", cmd_history))
+    app.add_handler(InlineQueryHandler(inline_currency))
+    app.job_queue.run_once(start_rate_history, when=0)
+    app.job_queue.run_repeating(refresh_rates_job, interval=RATES_TTL, first=5)
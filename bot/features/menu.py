@@ -4,8 +4,7 @@ from telegram import Update, InlineKeyboardMarkup, InlineKeyboardButton
 from telegram.ext import ContextTypes, CommandHandler, CallbackQueryHandler
 from database import (
     get_db_pool,
-    get_referral_stats,
-    get_user_settings,
+    get_user_lang,
     update_user_theme
 )
 from utils import generate_cabinet_link  # ✅ Импорт вынесен наверх
@@ -101,9 +100,7 @@ def get_settings_menu():
 async def menu_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user = update.effective_user
     pool = await get_db_pool()
-    async with pool.acquire() as conn:
-        row = await conn.fetchrow("SELECT language FROM users WHERE id = $1", user.id)
-        lang = row["language"] if row and row["language"] else "ru"
+    lang = await get_user_lang(pool, user.id)
 
     await update.message.reply_text(
         TEXTS[lang]["menu_title"],
@@ -121,13 +118,9 @@ async def handle_menu_callbacks(update: Update, context: ContextTypes.DEFAULT_TY
 
     pool = await get_db_pool()
 
-    # Получаем настройки и статистику
-    settings = await get_user_settings(pool, user.id)
-    lang = settings["language"]
-    theme = settings["theme"]
-    referrals = await get_referral_stats(pool, user.id)
-    premium = "✅ есть" if settings.get("premium_expires") else "❌ нет"  # ⚠️ 'premium_expires' нужно получать отдельно
-    link = generate_cabinet_link(user.id)
+    # Язык — из кэша профилей; рефералы и прочее — из UserContext,
+    # который грузится одним запросом и только на экранах, где нужен
+    lang = await get_user_lang(pool, user.id)
 
     # --- Главное меню ---
     if data == "menu_main":
@@ -139,6 +132,7 @@ async def handle_menu_callbacks(update: Update, context: ContextTypes.DEFAULT_TY
 
     # --- Личный кабинет ---
     elif data == "menu_profile":
+        link = generate_cabinet_link(user.id)
         await query.edit_message_text(
             f"{TEXTS[lang]['profile_title']}\n\n"
             f"{TEXTS[lang]['profile_intro']}\n"
@@ -164,6 +158,8 @@ async def handle_menu_callbacks(update: Update, context: ContextTypes.DEFAULT_TY
 
     elif data == "profile_referral":
         await query.answer("🤝 Рефералы — скоро!", show_alert=True)
+        user_ctx = await context.user_context().load()
+        referrals = user_ctx["referrals"] if user_ctx else 0
         await query.edit_message_text(
             f"🔗 *Реферальная система*\n\n"
             "Приглашай друзей и получай бонусы!\n\n"
@@ -188,6 +184,10 @@ async def handle_menu_callbacks(update: Update, context: ContextTypes.DEFAULT_TY
 
     elif data == "profile_info":
         await query.answer("ℹ️ Данные загружаются...", show_alert=False)
+        user_ctx = await context.user_context().load() or {}
+        referrals = user_ctx.get("referrals", 0)
+        theme = user_ctx.get("theme", "light")
+        premium = "✅ есть" if user_ctx.get("premium_expires") else "❌ нет"
         await query.edit_message_text(
             "📋 *Информация об аккаунте*\n\n"
             f"• ID: `{user.id}`\n"
@@ -212,7 +212,8 @@ async def handle_menu_callbacks(update: Update, context: ContextTypes.DEFAULT_TY
         await query.edit_message_text(
             "🌤 *Погода*\n\n"
             "Используй: `/weather Москва` — получи прогноз\n\n"
-            "📍 Автоопределение по кнопке: `/weather`",
+            "📍 Автоопределение по кнопке: `/weather`\n"
+            "☀️ Утренняя сводка: `/digest` (выключить: `/digest off`)",
             reply_markup=get_features_menu(),
             parse_mode='Markdown'
         )
@@ -221,8 +222,10 @@ async def handle_menu_callbacks(update: Update, context: ContextTypes.DEFAULT_TY
         await query.answer("💱 Курсы валют", show_alert=False)
         await query.edit_message_text(
             "💱 *Курсы валют*\n\n"
-            "Доступно: USD, EUR, CNY, GBP, JPY\n\n"
-            "Используй: `/currency USD`",
+            "Доступно: все валюты ЦБ РФ\n\n"
+            "Используй: `/currency USD`, `/currency 100 USD EUR`\n"
+            "Или в любом чате: `@бот 100 usd eur`\n"
+            "🔔 Уведомления: `/alert USD > 100`, `/alerts`",
             reply_markup=get_features_menu(),
             parse_mode='Markdown'
         )
@@ -1,12 +1,17 @@
 # bot/features/reminders.py
+import asyncio
+import heapq
+import os
 import re
-from datetime import datetime, timedelta
+from datetime import datetime, timedelta, timezone
 from typing import Optional
 
 from telegram import Update
+from telegram.error import BadRequest, Forbidden
 from telegram.ext import ContextTypes, CommandHandler, MessageHandler, filters
 
 from database import get_db_pool, get_user_lang  # ✅ импорт из database
+from bot.outbox import NOTIFY
 from loguru import logger
 
 TEXTS = {
@@ -32,6 +37,105 @@ TEXTS = {
     }
 }
 
+# --- Диспетчер напоминаний ---
+# Источник истины — таблица reminders. Раз в REMINDER_POLL_INTERVAL секунд реплика
+# забирает (FOR UPDATE SKIP LOCKED + аренда claimed_until) напоминания на ближайшие
+# REMINDER_LOOKAHEAD секунд и держит в памяти только их — в min-куче по времени.
+# Если реплика упала, аренда истекает и напоминания забирает другая.
+REMINDER_POLL_INTERVAL = int(os.getenv("REMINDER_POLL_INTERVAL", 30))
+REMINDER_LOOKAHEAD = int(os.getenv("REMINDER_LOOKAHEAD", 60))
+REMINDER_LEASE = REMINDER_LOOKAHEAD + int(os.getenv("REMINDER_LEASE_EXTRA", 240))
+REMINDER_BATCH = int(os.getenv("REMINDER_BATCH", 500))
+
+_due_heap = []  # (time, id, user_id, text)
+_queued_ids = set()
+
+
+def _push_reminder(remind_at: datetime, reminder_id: int, user_id: int, text: str):
+    if reminder_id in _queued_ids:
+        return
+    _queued_ids.add(reminder_id)
+    heapq.heappush(_due_heap, (remind_at, reminder_id, user_id, text))
+
+
+async def claim_due_reminders(pool) -> int:
+    """
+    Забирает в локальную кучу напоминания, срок которых наступит в пределах окна.
+    """
+    claimed = 0
+    while True:
+        rows = await pool.fetch("""
+            UPDATE reminders r
+            SET claimed_until = NOW() + $1 * INTERVAL '1 second'
+            FROM (
+                SELECT id FROM reminders
+                WHERE time <= NOW() + $2 * INTERVAL '1 second'
+                  AND (claimed_until IS NULL OR claimed_until < NOW())
+                ORDER BY time
+                LIMIT $3
+                FOR UPDATE SKIP LOCKED
+            ) due
+            WHERE r.id = due.id
+            RETURNING r.id, r.user_id, r.text, r.time
+        """, REMINDER_LEASE, REMINDER_LOOKAHEAD, REMINDER_BATCH)
+        for row in rows:
+            _push_reminder(row["time"], row["id"], row["user_id"], row["text"])
+        claimed += len(rows)
+        if len(rows) < REMINDER_BATCH:
+            return claimed
+
+
+async def poll_reminders(context: ContextTypes.DEFAULT_TYPE):
+    pool = context.application.bot_data.get('db_pool')
+    if not pool:
+        return
+    claimed = await claim_due_reminders(pool)
+    if claimed:
+        logger.debug(f"🔔 Взято напоминаний: {claimed} (в очереди: {len(_due_heap)})")
+
+
+async def dispatch_reminders(context: ContextTypes.DEFAULT_TYPE):
+    """
+    Раз в секунду снимает с кучи наступившие напоминания и отправляет их в фоне.
+    """
+    now = datetime.now(timezone.utc)
+    due = []
+    while _due_heap and _due_heap[0][0] <= now:
+        due.append(heapq.heappop(_due_heap))
+    if due:
+        context.application.create_task(send_reminders(context.application, due))
+
+
+async def send_reminders(application, due: list):
+    pool = application.bot_data['db_pool']
+    outbox = application.bot_data['outbox']
+
+    async def deliver(reminder_id, user_id, text):
+        lang = await get_user_lang(pool, user_id)
+        try:
+            await outbox.send_message(
+                user_id,
+                TEXTS[lang]["alert"].format(text=text),
+                priority=NOTIFY,
+                parse_mode='HTML'
+            )
+            return reminder_id
+        except (Forbidden, BadRequest) as e:
+            # Бот заблокирован или чат не найден — повторять бессмысленно
+            logger.warning(f"⚠️ Напоминание {reminder_id} не доставлено: {e}")
+            return reminder_id
+        except Exception as e:
+            # Строка остаётся в БД: по истечении аренды её заберут снова
+            logger.error(f"❌ Ошибка отправки напоминания {reminder_id}: {e}")
+        finally:
+            _queued_ids.discard(reminder_id)
+
+    results = await asyncio.gather(*(deliver(reminder_id, user_id, text) for _, reminder_id, user_id, text in due))
+    done = [reminder_id for reminder_id in results if reminder_id is not None]
+    if done:
+        await pool.execute("DELETE FROM reminders WHERE id = ANY($1::int[])", done)
+
+
 def parse_time_string(time_str: str) -> Optional[timedelta]:
     pattern = r'(\d+)([hms])'
     matches = re.findall(pattern, time_str.lower())
@@ -56,23 +160,17 @@ async def cmd_remind(update: Update, context: ContextTypes.DEFAULT_TYPE):
     if not reminder_text: return await update.message.reply_text(texts["error_text"])
     delta = parse_time_string(time_str)
     if not delta: return await update.message.reply_text(texts["error_time"], parse_mode='HTML')
-    remind_at = datetime.now() + delta
-    await pool.execute("INSERT INTO reminders (user_id, text, time) VALUES ($1, $2, $3)", user.id, reminder_text, remind_at)
+    remind_at = datetime.now(timezone.utc) + delta
+    # Близкие напоминания сразу берём в свою кучу, не дожидаясь следующего опроса
+    claim = delta.total_seconds() <= REMINDER_LOOKAHEAD
+    claimed_until = remind_at + timedelta(seconds=REMINDER_LEASE) if claim else None
+    reminder_id = await pool.fetchval(
+        "INSERT INTO reminders (user_id, text, time, claimed_until) VALUES ($1, $2, $3, $4) RETURNING id",
+        user.id, reminder_text, remind_at, claimed_until
+    )
+    if claim: _push_reminder(remind_at, reminder_id, user.id, reminder_text)
     when = format_when(delta, lang)
     await update.message.reply_html(texts["set"].format(when=when, text=reminder_text))
-    context.job_queue.run_once(send_reminder, when=delta, chat_id=user.id, user_id=user.id, data={"text": reminder_text})
-
-async def send_reminder(context: ContextTypes.DEFAULT_TYPE):
-    job = context.job
-    pool = context.application.bot_data['db_pool']
-    lang = await get_user_lang(pool, job.user_id)
-    texts = TEXTS[lang]
-    await context.bot.send_message(
-        chat_id=job.chat_id,
-        text=texts["alert"].format(text=job.data["text"]),
-        parse_mode='HTML'
-    )
-    await pool.execute("DELETE FROM reminders WHERE user_id = $1 AND text = $2", job.user_id, job.data["text"])
 
 def format_when(delta: timedelta, lang: str) -> str:
     total_seconds = int(delta.total_seconds())
@@ -98,4 +196,6 @@ async def cmd_reminders(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
 def setup_reminder_handlers(app):
     app.add_handler(CommandHandler("remind", cmd_remind))
-    app.add_handler(CommandHandler("reminders", cmd_reminders))
\ No newline at end of file
+    app.add_handler(CommandHandler("reminders", cmd_reminders))
+    app.job_queue.run_repeating(poll_reminders, interval=REMINDER_POLL_INTERVAL, first=5)
+    app.job_queue.run_repeating(dispatch_reminders, interval=1, first=5)
\ No newline at end of file
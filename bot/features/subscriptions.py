@@ -1,12 +1,16 @@
 # bot/features/subscriptions.py
+import asyncio
+import os
+import re
 from typing import Optional
-from datetime import timedelta
+from datetime import datetime, timedelta, timezone
 from decimal import Decimal
 
 from telegram import Update
 from telegram.ext import ContextTypes, CommandHandler
 
 from database import get_db_pool, get_user_lang
+from bot.outbox import NOTIFY
 from loguru import logger
 
 TEXTS = {
@@ -36,10 +40,67 @@ TEXTS = {
     }
 }
 
+# --- Фоновый обход подписок ---
+# Раз в SUBSCRIPTION_SWEEP_INTERVAL секунд находим подписки с платежом в ближайшие
+# 24 часа (по idx_subscriptions_next), одним UPDATE ... RETURNING сдвигаем next_payment
+# на нужное число периодов и ставим напоминания в общую очередь отправки.
+# Очередь ограничивает только отправку — запросы к БД при подготовке текста
+# ограничены SUBSCRIPTION_SEND_CONCURRENCY, чтобы не занять весь пул.
+SUBSCRIPTION_SWEEP_INTERVAL = int(os.getenv("SUBSCRIPTION_SWEEP_INTERVAL", 3600))
+SUBSCRIPTION_BATCH = int(os.getenv("SUBSCRIPTION_BATCH", 500))
+SUBSCRIPTION_SEND_CONCURRENCY = int(os.getenv("SUBSCRIPTION_SEND_CONCURRENCY", 10))
+
+
+async def advance_due_subscriptions(pool) -> list:
+    """
+    Сдвигает next_payment у подписок, платёж по которым наступит в течение суток,
+    так, чтобы он оказался дальше суток от текущего момента. Возвращает сдвинутые строки.
+    """
+    return await pool.fetch("""
+        UPDATE subscriptions s
+        SET next_payment = s.next_payment + s.billing_cycle * (FLOOR(
+            EXTRACT(EPOCH FROM (NOW() + INTERVAL '24 hours' - s.next_payment))
+            / EXTRACT(EPOCH FROM s.billing_cycle)
+        )::int + 1)
+        FROM (
+            SELECT id FROM subscriptions
+            WHERE next_payment <= NOW() + INTERVAL '24 hours'
+              AND billing_cycle > INTERVAL '0'
+            ORDER BY next_payment
+            LIMIT $1
+            FOR UPDATE SKIP LOCKED
+        ) due
+        WHERE s.id = due.id
+        RETURNING s.id, s.user_id, s.name, s.amount, s.currency
+    """, SUBSCRIPTION_BATCH)
+
+
+async def sweep_subscriptions(context: ContextTypes.DEFAULT_TYPE):
+    pool = context.application.bot_data.get('db_pool')
+    if not pool:
+        return
+    semaphore = asyncio.Semaphore(SUBSCRIPTION_SEND_CONCURRENCY)
+
+    async def remind(row):
+        async with semaphore:
+            await send_subscription_reminder(context.application, row)
+
+    total = 0
+    while True:
+        rows = await advance_due_subscriptions(pool)
+        await asyncio.gather(*(remind(row) for row in rows))
+        total += len(rows)
+        if len(rows) < SUBSCRIPTION_BATCH:
+            break
+    if total:
+        logger.info(f"🔔 Напоминаний об оплате подписок: {total}")
+
+
 def parse_cycle(cycle_str: str) -> tuple[Optional[timedelta], str]:
     match = re.match(r'^(\d+)([dwmy])$', cycle_str.strip().lower())
     if not match: return None, ""
     value, unit = int(match.group(1)), match.group(2)
+    if value <= 0: return None, ""
     if unit == 'd': return timedelta(days=value), f"{value} day(s)"
     elif unit == 'w': return timedelta(weeks=value), f"{value} week(s)"
     elif unit == 'm': return timedelta(days=value * 30), f"{value} month(s)"
@@ -65,16 +126,8 @@ async def cmd_subscribe(update: Update, context: ContextTypes.DEFAULT_TYPE):
         currency = "₽" if lang == "ru" else "$"
         delta, _ = parse_cycle(cycle_str)
         if not delta: return await update.message.reply_text(texts["error_cycle"])
-        next_payment = datetime.now() + delta
+        next_payment = datetime.now(timezone.utc) + delta
         await pool.execute("INSERT INTO subscriptions (user_id, name, amount, currency, billing_cycle, next_payment) VALUES ($1, $2, $3, $4, $5, $6)", user.id, name, amount, currency, delta, next_payment)
-        remind_time = next_payment - datetime.now()
-        if remind_time.total_seconds() > 0:
-            context.job_queue.run_once(
-                send_subscription_reminder,
-                when=remind_time - timedelta(days=1),
-                chat_id=user.id,
-                data={"name": name, "amount": amount, "currency": currency, "user_id": user.id}
-            )
         cycle_text = format_cycle_for_user(cycle_str, lang)
         next_str = next_payment.strftime("%d.%m.%Y")
         await update.message.reply_html(texts["added"].format(name=name, amount=amount, currency=currency, next=next_str, cycle=cycle_text))
@@ -96,17 +149,21 @@ async def cmd_subscriptions(update: Update, context: ContextTypes.DEFAULT_TYPE):
         message += texts["sub_item"].format(name=row["name"], amount=row["amount"], currency=row["currency"], next=next_str, cycle_text=cycle_text)
     await update.message.reply_html(message)
 
-async def send_subscription_reminder(context: ContextTypes.DEFAULT_TYPE):
-    job = context.job
-    pool = context.application.bot_data['db_pool']
-    lang = await get_user_lang(pool, job.data["user_id"])
+async def send_subscription_reminder(application, row):
+    pool = application.bot_data['db_pool']
+    lang = await get_user_lang(pool, row["user_id"])
     texts = TEXTS[lang]
-    await context.bot.send_message(
-        chat_id=job.chat_id,
-        text=texts["reminder"].format(name=job.data["name"], amount=job.data["amount"], currency=job.data["currency"]),
-        parse_mode='HTML'
-    )
+    try:
+        await application.bot_data['outbox'].send_message(
+            row["user_id"],
+            texts["reminder"].format(name=row["name"], amount=row["amount"], currency=row["currency"]),
+            priority=NOTIFY,
+            parse_mode='HTML'
+        )
+    except Exception as e:
+        logger.warning(f"⚠️ Не удалось напомнить о подписке {row['id']}: {e}")
 
 def setup_subscription_handlers(app):
     app.add_handler(CommandHandler("subscribe", cmd_subscribe))
-    app.add_handler(CommandHandler("subscriptions", cmd_subscriptions))
\ No newline at end of file
+    app.add_handler(CommandHandler("subscriptions", cmd_subscriptions))
+    app.job_queue.run_repeating(sweep_subscriptions, interval=SUBSCRIPTION_SWEEP_INTERVAL, first=30)
\ No newline at end of file
@@ -1,14 +1,18 @@
 # bot/features/weather.py
+import asyncio
 import os
-import httpx
+import time
+from datetime import datetime, time as dt_time
+from zoneinfo import ZoneInfo
+
 from telegram import Update
 from telegram.ext import ContextTypes, CommandHandler, MessageHandler, filters
 
-from database import get_db_pool, get_user_lang
+from database import get_db_pool, get_user_lang, get_user_city, set_user_city, set_weather_digest, claim_daily_run
 from loguru import logger
 
-WEATHER_API_KEY = os.getenv("WEATHER_API_KEY")
-WEATHER_URL = "http://api.openweathermap.org/data/2.5/weather"
+from bot.outbox import BULK
+from bot.weather_service import WEATHER_TTL, normalize_city
 
 TEXTS = {
     "ru": {
@@ -22,6 +26,11 @@ TEXTS = {
         "clouds": "☁️ Облачность: {clouds}%\n",
         "error_city": "❌ Не удалось найти город. Попробуйте ещё раз.",
         "error_api": "❌ Ошибка сервиса погоды. Повторите позже.",
+        "stale": "\n⚠️ Сервис погоды недоступен, показаны последние полученные данные.",
+        "digest_title": "☀️ <b>Доброе утро!</b>\n\n",
+        "digest_on": "✅ Утренняя сводка погоды включена ({time}).\n🏙 Город: <b>{city}</b>",
+        "digest_off": "🔕 Утренняя сводка погоды отключена.",
+        "digest_no_city": "🏙 Сначала сохраните город: <code>/weather Москва</code>",
     },
     "en": {
         "enter_city": "🏙 Enter city name:",
@@ -34,6 +43,11 @@ TEXTS = {
         "clouds": "☁️ Clouds: {clouds}%\n",
         "error_city": "❌ City not found. Try again.",
         "error_api": "❌ Weather API error. Try later.",
+        "stale": "\n⚠️ Weather service is unavailable, showing the last known data.",
+        "digest_title": "☀️ <b>Good morning!</b>\n\n",
+        "digest_on": "✅ Morning weather digest enabled ({time}).\n🏙 City: <b>{city}</b>",
+        "digest_off": "🔕 Morning weather digest disabled.",
+        "digest_no_city": "🏙 Save your city first: <code>/weather London</code>",
     }
 }
 
@@ -45,10 +59,10 @@ async def cmd_weather(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
     if context.args:
         city = " ".join(context.args)
-        await pool.execute("UPDATE users SET city = $1 WHERE id = $2", city, user.id)
+        await set_user_city(pool, user.id, city)
         await update.message.reply_html(texts["saved_city"].format(city=city))
     else:
-        city = await pool.fetchval("SELECT city FROM users WHERE id = $1", user.id)
+        city = await get_user_city(pool, user.id)
         if not city:
             await update.message.reply_text(texts["enter_city"])
             return
@@ -56,45 +70,38 @@ async def cmd_weather(update: Update, context: ContextTypes.DEFAULT_TYPE):
     await fetch_and_send_weather(update, context, city, texts)
 
 
+def render_weather(data: dict, city: str, texts: dict) -> str:
+    main = data["main"]
+    wind = data.get("wind", {})
+    clouds = data.get("clouds", {})
+
+    temp = int(main["temp"])
+    feels_like = int(main["feels_like"])
+    humidity = main["humidity"]
+    wind_speed = wind.get("speed", "нет данных")
+    cloudiness = clouds.get("all", "нет данных")
+
+    message = (
+        texts["weather_in"].format(city=city) +
+        texts["temp"].format(temp=temp) +
+        texts["feels_like"].format(feels_like=feels_like) +
+        texts["humidity"].format(humidity=humidity) +
+        texts["wind"].format(speed=wind_speed) +
+        texts["clouds"].format(clouds=cloudiness)
+    )
+    if data.get("stale"):
+        message += texts["stale"]
+    return message
+
+
 async def fetch_and_send_weather(update: Update, context: ContextTypes.DEFAULT_TYPE, city: str, texts: dict):
     try:
-        async with httpx.AsyncClient() as client:
-            response = await client.get(
-                WEATHER_URL,
-                params={
-                    "q": city,
-                    "appid": WEATHER_API_KEY,
-                    "lang": "ru",
-                    "units": "metric"
-                },
-                timeout=10.0
-            )
-
-        if response.status_code == 404:
+        data = await context.application.bot_data['weather'].get(city)
+        if data is None:
             await update.message.reply_text(texts["error_city"])
             return
 
-        data = response.json()
-        main = data["main"]
-        wind = data.get("wind", {})
-        clouds = data.get("clouds", {})
-
-        temp = int(main["temp"])
-        feels_like = int(main["feels_like"])
-        humidity = main["humidity"]
-        wind_speed = wind.get("speed", "нет данных")
-        cloudiness = clouds.get("all", "нет данных")
-
-        message = (
-            texts["weather_in"].format(city=city) +
-            texts["temp"].format(temp=temp) +
-            texts["feels_like"].format(feels_like=feels_like) +
-            texts["humidity"].format(humidity=humidity) +
-            texts["wind"].format(speed=wind_speed) +
-            texts["clouds"].format(clouds=cloudiness)
-        )
-
-        await update.message.reply_html(message)
+        await update.message.reply_html(render_weather(data, city, texts))
 
     except Exception as e:
         logger.error(f"❌ Ошибка обработки погоды: {e}")
@@ -117,10 +124,163 @@ async def handle_city_input(update: Update, context: ContextTypes.DEFAULT_TYPE):
     lang = await get_user_lang(pool, user.id)
     texts = TEXTS[lang]
 
-    await pool.execute("UPDATE users SET city = $1 WHERE id = $2", text, user.id)
+    await set_user_city(pool, user.id, text)
     await update.message.reply_html(texts["saved_city"].format(city=text))
 
 
+# --- Прогрев кэша для популярных городов ---
+# Раз в WEATHER_WARMUP_INTERVAL секунд (по умолчанию — TTL кэша) берём самые
+# частые сохранённые города и обновляем их погоду заранее, не больше
+# WEATHER_WARMUP_BUDGET запросов за цикл. Запросы разнесены по циклу отдельными
+# задачами, чтобы не было всплеска. Список городов пересчитывается раз в час.
+WEATHER_WARMUP_INTERVAL = int(os.getenv("WEATHER_WARMUP_INTERVAL", WEATHER_TTL))
+WEATHER_WARMUP_TOP = int(os.getenv("WEATHER_WARMUP_TOP", 50))
+WEATHER_WARMUP_BUDGET = int(os.getenv("WEATHER_WARMUP_BUDGET", 50))
+WEATHER_TOP_CITIES_REFRESH = 3600
+
+_top_cities = {"cities": [], "updated": 0.0}
+
+
+async def get_top_cities(pool) -> list:
+    if _top_cities["cities"] and time.monotonic() - _top_cities["updated"] < WEATHER_TOP_CITIES_REFRESH:
+        return _top_cities["cities"]
+
+    rows = await pool.fetch("""
+        SELECT city, COUNT(*) AS users
+        FROM users
+        WHERE city IS NOT NULL AND city <> ''
+        GROUP BY city
+        ORDER BY users DESC
+        LIMIT $1
+    """, WEATHER_WARMUP_TOP * 2)
+    # Одинаковые города с разным написанием складываем по нормализованному ключу
+    counts = {}
+    for row in rows:
+        key = normalize_city(row["city"])
+        counts[key] = counts.get(key, 0) + row["users"]
+    _top_cities["cities"] = sorted(counts, key=counts.get, reverse=True)[:WEATHER_WARMUP_TOP]
+    _top_cities["updated"] = time.monotonic()
+    return _top_cities["cities"]
+
+
+async def warm_up_weather(context: ContextTypes.DEFAULT_TYPE):
+    pool = context.application.bot_data.get('db_pool')
+    if not pool:
+        return
+    cities = (await get_top_cities(pool))[:WEATHER_WARMUP_BUDGET]
+    if not cities:
+        return
+    step = WEATHER_WARMUP_INTERVAL / len(cities)
+    for i, city in enumerate(cities):
+        context.job_queue.run_once(prefetch_city, when=i * step, data={"city": city, "min_ttl": step})
+
+
+async def prefetch_city(context: ContextTypes.DEFAULT_TYPE):
+    weather = context.application.bot_data['weather']
+    try:
+        await weather.prefetch(context.job.data["city"], min_ttl=context.job.data["min_ttl"])
+    except Exception as e:
+        logger.debug(f"Прогрев погоды для «{context.job.data['city']}» не удался: {e}")
+
+
+# --- Утренняя сводка погоды ---
+# Подписчики группируются по нормализованному городу: погода каждого города
+# запрашивается один раз, текст на каждом языке собирается один раз, а
+# отправка идёт через общую очередь с приоритетом рассылок.
+WEATHER_DIGEST_TIME = os.getenv("WEATHER_DIGEST_TIME", "08:00")
+WEATHER_DIGEST_TZ = os.getenv("WEATHER_DIGEST_TZ", "Europe/Moscow")
+WEATHER_DIGEST_FETCH_CONCURRENCY = int(os.getenv("WEATHER_DIGEST_FETCH_CONCURRENCY", 5))
+WEATHER_DIGEST_SEND_CHUNK = 500
+
+
+async def cmd_digest(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    user = update.effective_user
+    pool = context.application.bot_data['db_pool']
+    lang = await get_user_lang(pool, user.id)
+    texts = TEXTS[lang]
+
+    arg = context.args[0].lower() if context.args else None
+    if arg in ("off", "выкл", "0"):
+        await set_weather_digest(pool, user.id, False)
+        await update.message.reply_text(texts["digest_off"])
+        return
+
+    city = await get_user_city(pool, user.id)
+    if not city:
+        await update.message.reply_html(texts["digest_no_city"])
+        return
+    await set_weather_digest(pool, user.id, True)
+    await update.message.reply_html(texts["digest_on"].format(time=WEATHER_DIGEST_TIME, city=city))
+
+
+async def send_weather_digest(context: ContextTypes.DEFAULT_TYPE):
+    pool = context.application.bot_data.get('db_pool')
+    if not pool:
+        return
+    # Несколько реплик бота: сводку за день рассылает тот, кто первым её отметил.
+    # Отметка ставится до отправки — при сбое посреди рассылки повтора не будет.
+    today = datetime.now(ZoneInfo(WEATHER_DIGEST_TZ)).date()
+    if not await claim_daily_run(pool, "weather_digest", today):
+        logger.info(f"☀️ Сводка погоды за {today} уже разослана другим процессом")
+        return
+    weather = context.application.bot_data['weather']
+    outbox = context.application.bot_data['outbox']
+
+    # нормализованный город -> (как написал первый подписчик, {язык: [user_id]})
+    groups = {}
+    async with pool.acquire() as conn:
+        async with conn.transaction(readonly=True):
+            async for row in conn.cursor('''
+                SELECT id, city, COALESCE(language, 'ru') AS lang
+                FROM users
+                WHERE weather_digest AND city IS NOT NULL AND city <> ''
+            '''):
+                key = normalize_city(row["city"])
+                _, by_lang = groups.setdefault(key, (row["city"], {}))
+                by_lang.setdefault(row["lang"] if row["lang"] in TEXTS else "ru", []).append(row["id"])
+    if not groups:
+        return
+
+    semaphore = asyncio.Semaphore(WEATHER_DIGEST_FETCH_CONCURRENCY)
+
+    async def fetch(key):
+        async with semaphore:
+            try:
+                return key, await weather.get(key)
+            except Exception as e:
+                logger.warning(f"⚠️ Сводка: нет погоды для «{key}»: {e}")
+                return key, None
+
+    forecasts = dict(await asyncio.gather(*(fetch(key) for key in groups)))
+
+    sent = failed = 0
+    for key, (city, by_lang) in groups.items():
+        data = forecasts.get(key)
+        if not data:
+            continue
+        for lang, user_ids in by_lang.items():
+            texts = TEXTS[lang]
+            message = texts["digest_title"] + render_weather(data, city, texts)
+            for i in range(0, len(user_ids), WEATHER_DIGEST_SEND_CHUNK):
+                results = await asyncio.gather(*(
+                    outbox.submit("send_message", user_id, BULK, text=message, parse_mode='HTML')
+                    for user_id in user_ids[i:i + WEATHER_DIGEST_SEND_CHUNK]
+                ), return_exceptions=True)
+                errors = sum(1 for r in results if isinstance(r, Exception))
+                sent += len(results) - errors
+                failed += errors
+
+    logger.info(f"☀️ Сводка погоды: городов {len(groups)}, отправлено {sent}, ошибок {failed}")
+
+
+def _digest_time() -> dt_time:
+    hour, minute = (int(part) for part in WEATHER_DIGEST_TIME.split(":"))
+    return dt_time(hour, minute, tzinfo=ZoneInfo(WEATHER_DIGEST_TZ))
+
+
 def setup_weather_handlers(app):
     app.add_handler(CommandHandler("weather", cmd_weather))
-    app.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, handle_city_input), group=5)
\ No newline at end of file
+    app.add_handler(CommandHandler("digest", cmd_digest))
+    app.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, handle_city_input), group=5)
+    app.job_queue.run_repeating(warm_up_weather, interval=WEATHER_WARMUP_INTERVAL, first=60)
+    app.job_queue.run_daily(send_weather_digest, time=_digest_time())
\ No newline at end of file
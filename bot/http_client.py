@@ -0,0 +1,104 @@
+# bot/http_client.py
+"""
+Общий HTTP-клиент бота для внешних API (ЦБ, OpenWeatherMap).
+
+Один httpx.AsyncClient на процесс: соединения переиспользуются (keep-alive,
+HTTP/2, если установлен пакет h2), у каждого хоста свой лимит одновременных
+запросов, по каждому хосту собирается гистограмма задержек.
+Создаётся в on_post_init, доступен как bot_data['http'].
+"""
+
+import asyncio
+import importlib.util
+import os
+import time
+from bisect import bisect_left
+from urllib.parse import urlsplit
+
+import httpx
+from loguru import logger
+
+HTTP_MAX_CONNECTIONS = int(os.getenv("HTTP_MAX_CONNECTIONS", 50))
+HTTP_MAX_KEEPALIVE = int(os.getenv("HTTP_MAX_KEEPALIVE", 20))
+HTTP_PER_HOST_LIMIT = int(os.getenv("HTTP_PER_HOST_LIMIT", 10))
+HTTP_CONNECT_TIMEOUT = float(os.getenv("HTTP_CONNECT_TIMEOUT", 3))
+HTTP_READ_TIMEOUT = float(os.getenv("HTTP_READ_TIMEOUT", 8))
+HTTP_POOL_TIMEOUT = float(os.getenv("HTTP_POOL_TIMEOUT", 2))
+HTTP_HTTP2 = os.getenv("HTTP_HTTP2", "1") == "1"
+
+# Границы корзин гистограммы задержек, мс (последняя корзина — всё, что дольше)
+LATENCY_BUCKETS_MS = (50, 100, 250, 500, 1000, 2500, 5000, 10000)
+
+
+class HttpClient:
+    def __init__(self, per_host_limit: int = HTTP_PER_HOST_LIMIT):
+        http2 = HTTP_HTTP2 and importlib.util.find_spec("h2") is not None
+        self._client = httpx.AsyncClient(
+            http2=http2,
+            limits=httpx.Limits(
+                max_connections=HTTP_MAX_CONNECTIONS,
+                max_keepalive_connections=HTTP_MAX_KEEPALIVE,
+                keepalive_expiry=30,
+            ),
+            timeout=httpx.Timeout(
+                connect=HTTP_CONNECT_TIMEOUT,
+                read=HTTP_READ_TIMEOUT,
+                write=HTTP_READ_TIMEOUT,
+                pool=HTTP_POOL_TIMEOUT,
+            ),
+        )
+        self.per_host_limit = per_host_limit
+        self._semaphores = {}  # хост -> asyncio.Semaphore
+        self._hosts = {}  # хост -> метрики
+        logger.info(f"🌐 HTTP-клиент создан (HTTP/2: {'да' if http2 else 'нет'})")
+
+    def _host_metrics(self, host: str) -> dict:
+        metrics = self._hosts.get(host)
+        if metrics is None:
+            metrics = self._hosts[host] = {
+                "requests": 0, "errors": 0, "total_ms": 0.0,
+                "histogram": [0] * (len(LATENCY_BUCKETS_MS) + 1),
+            }
+        return metrics
+
+    async def request(self, method: str, url: str, **kwargs) -> httpx.Response:
+        host = urlsplit(url).netloc
+        semaphore = self._semaphores.get(host)
+        if semaphore is None:
+            semaphore = self._semaphores[host] = asyncio.Semaphore(self.per_host_limit)
+        metrics = self._host_metrics(host)
+
+        async with semaphore:
+            started = time.perf_counter()
+            try:
+                return await self._client.request(method, url, **kwargs)
+            except Exception:
+                metrics["errors"] += 1
+                raise
+            finally:
+                elapsed_ms = (time.perf_counter() - started) * 1000
+                metrics["requests"] += 1
+                metrics["total_ms"] += elapsed_ms
+                metrics["histogram"][bisect_left(LATENCY_BUCKETS_MS, elapsed_ms)] += 1
+
+    async def get(self, url: str, **kwargs) -> httpx.Response:
+        return await self.request("GET", url, **kwargs)
+
+    async def aclose(self):
+        await self._client.aclose()
+
+    def stats(self) -> dict:
+        """
+        Метрики по хостам: число запросов, ошибок, средняя задержка и гистограмма
+        {"<=50": n, ..., ">10000": n}.
+        """
+        labels = [f"<={edge}" for edge in LATENCY_BUCKETS_MS] + [f">{LATENCY_BUCKETS_MS[-1]}"]
+        return {
+            host: {
+                "requests": m["requests"],
+                "errors": m["errors"],
+                "avg_ms": round(m["total_ms"] / m["requests"], 1) if m["requests"] else 0.0,
+                "histogram": dict(zip(labels, m["histogram"])),
+            }
+            for host, m in self._hosts.items()
+        }
@@ -10,16 +10,27 @@ if root_path not in sys.path:
 
 # Теперь можно импортировать из корня
 from bot.instance import application as global_app, bot as global_bot
+from bot.context import BotContext
+from bot.outbox import Outbox
+from bot.http_client import HttpClient
+from bot.rates import RatesService
+from bot.weather_service import WeatherService
 from database import (
     create_db_pool,
     init_db,
-    add_or_update_user,
+    touch_user,
+    flush_seen_users,
+    SEEN_USERS_FLUSH_INTERVAL,
     delete_inactive_users,
     log_command_usage,
+    enable_usage_sink,
+    flush_command_usage,
+    get_usage_sink_stats,
+    USAGE_FLUSH_INTERVAL,
+    rollup_usage_daily,
     get_user_role,
     register_referral,
     cleanup_support_tickets,
-    ensure_support_table_exists,
     get_db_pool,
     get_user_lang,  # ✅ Добавлен: нужен для локализации напоминаний и подписок
 )
@@ -33,9 +44,11 @@ from features.premium import setup_premium_handlers
 from features.help import setup as help_setup
 from features.help import handle_support_message  # ✅ Обработчик сообщений поддержки
 from features.currency import setup_currency_handlers
+from features.alerts import setup_alert_handlers
 from features.reminders import setup_reminder_handlers
 from features.subscriptions import setup_subscription_handlers
 from features.weather import setup_weather_handlers  # ✅ Добавлен: погода
+from features.broadcast import setup_broadcast_handlers
 
 # Telegram
 from telegram import Update, InlineKeyboardMarkup, InlineKeyboardButton, MenuButtonWebApp, WebAppInfo
@@ -90,9 +103,9 @@ async def debug_all_messages(update: Update, context: ContextTypes.DEFAULT_TYPE)
 async def track_user_activity(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user = update.effective_user
     if user:
-        await add_or_update_user(db_pool, user)
+        await touch_user(db_pool, user)
 
-    # Логируем команды
+    # Логируем команды (в буфер, запись в БД — пачками в фоне)
     if update.message and update.message.text and update.message.text.startswith('/'):
         command = update.message.text.split()[0]
         await log_command_usage(db_pool, user.id, command)
@@ -107,7 +120,7 @@ def get_start_keyboard():
 # --- Обработчик /start ---
 async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user = update.effective_user
-    await add_or_update_user(db_pool, user)
+    await touch_user(db_pool, user)
 
     # Обработка реферальной ссылки
     if context.args and context.args[0].startswith("ref"):
@@ -132,6 +145,24 @@ async def cleanup_task(context: ContextTypes.DEFAULT_TYPE):
     await delete_inactive_users(db_pool, days=90)
     await cleanup_support_tickets(db_pool, days=7)
 
+# --- Фоновая задача: сброс буфера статистики команд ---
+async def usage_flush_task(context: ContextTypes.DEFAULT_TYPE):
+    if not db_pool:
+        return
+    await flush_command_usage(db_pool)
+
+# --- Фоновая задача: пакетное обновление пользователей ---
+async def seen_users_flush_task(context: ContextTypes.DEFAULT_TYPE):
+    if not db_pool:
+        return
+    await flush_seen_users(db_pool)
+
+# --- Фоновая задача: дневные агрегаты статистики ---
+async def usage_rollup_task(context: ContextTypes.DEFAULT_TYPE):
+    if not db_pool:
+        return
+    await rollup_usage_daily(db_pool)
+
 # --- Инициализация после запуска ---
 async def on_post_init(app: Application):
     global db_pool
@@ -140,8 +171,23 @@ async def on_post_init(app: Application):
     await init_db(db_pool)
     logger.info("✅ База данных инициализирована")
 
-    await ensure_support_table_exists()
     app.bot_data['db_pool'] = db_pool
+    enable_usage_sink()
+
+    # Общая очередь исходящих сообщений
+    outbox = Outbox(app.bot)
+    await outbox.start()
+    app.bot_data['outbox'] = outbox
+
+    # Общий HTTP-клиент для внешних API
+    http = HttpClient()
+    app.bot_data['http'] = http
+
+    # Курсы валют: снимок с диска, дальше — плановое обновление
+    rates = RatesService(client=http)
+    rates.load_snapshot()
+    app.bot_data['rates'] = rates
+    app.bot_data['weather'] = WeatherService(client=http)
 
     # Сохраняем в bot.instance
     global_app = app
@@ -172,12 +218,48 @@ async def on_post_init(app: Application):
     app.job_queue.run_repeating(cleanup_task, interval=24 * 3600, first=10)
     logger.info("⏰ Фоновая задача: очистка — запущена")
 
+    app.job_queue.run_repeating(usage_flush_task, interval=USAGE_FLUSH_INTERVAL, first=USAGE_FLUSH_INTERVAL)
+    logger.info("⏰ Фоновая задача: сброс статистики команд — запущена")
+
+    app.job_queue.run_repeating(seen_users_flush_task, interval=SEEN_USERS_FLUSH_INTERVAL, first=SEEN_USERS_FLUSH_INTERVAL)
+    logger.info("⏰ Фоновая задача: обновление пользователей — запущена")
+
+    app.job_queue.run_repeating(usage_rollup_task, interval=3600, first=60)
+    logger.info("⏰ Фоновая задача: агрегаты usage_daily — запущена")
+
+# --- Завершение работы ---
+async def on_post_stop(app: Application):
+    # Бот ещё может отправлять — дожидаемся очереди исходящих
+    outbox = app.bot_data.get('outbox')
+    if outbox:
+        await outbox.stop()
+        logger.info(f"📤 Очередь отправки остановлена: {outbox.stats()}")
+
+async def on_post_shutdown(app: Application):
+    for service in ('rates', 'weather'):
+        if app.bot_data.get(service):
+            await app.bot_data[service].close()
+    if app.bot_data.get('http'):
+        await app.bot_data['http'].aclose()
+    if not db_pool:
+        return
+    # Дописываем отложенные обновления пользователей и статистику
+    await flush_seen_users(db_pool)
+    flushed = await flush_command_usage(db_pool)
+    stats = get_usage_sink_stats()
+    logger.info(f"📊 Буфер статистики сброшен при остановке: {flushed} записей, осталось {stats['queue_depth']}")
+    await db_pool.close()
+    logger.info("🔌 Пул подключений к БД закрыт")
+
 # --- Главная функция запуска ---
 def main():
     app = (
         Application.builder()
         .token(os.getenv("BOT_TOKEN"))
         .post_init(on_post_init)
+        .post_stop(on_post_stop)
+        .post_shutdown(on_post_shutdown)
+        .context_types(ContextTypes(context=BotContext))
         .build()
     )
 
@@ -195,9 +277,11 @@ def main():
     setup_referral_handlers(app)
     setup_premium_handlers(app)
     setup_currency_handlers(app)
+    setup_alert_handlers(app)
     setup_reminder_handlers(app)
     setup_subscription_handlers(app)
     setup_weather_handlers(app)  # ✅ Добавлено
+    setup_broadcast_handlers(app)
 
     # Команда /start
     app.add_handler(CommandHandler("start", start), group=0)
@@ -0,0 +1,202 @@
+# bot/outbox.py
+"""
+Единая очередь исходящих сообщений в Telegram.
+
+Все отправки идут через общий лимит (ведро токенов на процесс), с темпом на
+каждый чат и приоритетами: ответы пользователю раньше уведомлений, уведомления
+раньше рассылок. RetryAfter приостанавливает всю очередь и повторяет отправку.
+"""
+
+import asyncio
+import itertools
+import os
+import time
+from collections import deque
+from typing import Optional
+
+from loguru import logger
+from telegram.error import RetryAfter
+
+from bot.ratelimit import TokenBucket
+
+# Приоритеты (меньше — важнее)
+INTERACTIVE = 0
+NOTIFY = 1
+BULK = 2
+LANES = {INTERACTIVE: "interactive", NOTIFY: "notify", BULK: "bulk"}
+
+OUTBOX_GLOBAL_RATE = float(os.getenv("OUTBOX_GLOBAL_RATE", 25))
+OUTBOX_CHAT_RATE = float(os.getenv("OUTBOX_CHAT_RATE", 1))
+OUTBOX_CHAT_BURST = float(os.getenv("OUTBOX_CHAT_BURST", 10))
+OUTBOX_WORKERS = int(os.getenv("OUTBOX_WORKERS", 4))
+OUTBOX_MAX_RETRIES = int(os.getenv("OUTBOX_MAX_RETRIES", 3))
+
+
+class _Item:
+    __slots__ = ("method", "chat_id", "kwargs", "future", "enqueued_at", "attempts", "lane")
+
+    def __init__(self, method, chat_id, kwargs, future, lane):
+        self.method = method
+        self.chat_id = chat_id
+        self.kwargs = kwargs
+        self.future = future
+        self.enqueued_at = time.monotonic()
+        self.attempts = 0
+        self.lane = lane
+
+
+class Outbox:
+    def __init__(self, bot, global_rate: float = OUTBOX_GLOBAL_RATE, workers: int = OUTBOX_WORKERS):
+        self.bot = bot
+        self.bucket = TokenBucket(global_rate)
+        self.workers = workers
+        self._queue = asyncio.PriorityQueue()
+        self._seq = itertools.count()
+        self._chats = {}  # chat_id -> [токены, время обновления]
+        self._tasks = []
+        self._delayed = 0
+        self._depth = {lane: 0 for lane in LANES}
+        self._latencies = deque(maxlen=1000)
+        self._metrics = {"sent": 0, "failed": 0, "retried": 0}
+
+    # --- Жизненный цикл ---
+    async def start(self):
+        self._tasks = [asyncio.create_task(self._worker()) for _ in range(self.workers)]
+        logger.info(f"📤 Очередь отправки запущена ({self.workers} воркеров)")
+
+    async def stop(self, timeout: float = 10):
+        """
+        Дожидается отправки накопленного (не дольше timeout) и останавливает воркеры.
+        """
+        deadline = time.monotonic() + timeout
+        try:
+            while True:
+                await asyncio.wait_for(self._queue.join(), max(0.0, deadline - time.monotonic()))
+                if not self._delayed:
+                    break
+                # Отложенные (темп чата, RetryAfter) ещё вернутся в очередь
+                await asyncio.sleep(0.1)
+        except asyncio.TimeoutError:
+            logger.warning(f"⚠️ Очередь отправки остановлена, не отправлено: {self._queue.qsize() + self._delayed}")
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+
+    # --- Постановка в очередь ---
+    def submit(self, method: str, chat_id: int, priority: int = NOTIFY, **kwargs) -> asyncio.Future:
+        """
+        Ставит вызов метода бота в очередь. Результат — future с ответом Telegram.
+        """
+        future = asyncio.get_running_loop().create_future()
+        self._put(priority, next(self._seq), _Item(method, chat_id, kwargs, future, priority))
+        return future
+
+    async def send_message(self, chat_id: int, text: str, priority: int = INTERACTIVE, **kwargs):
+        return await self.submit("send_message", chat_id, priority, text=text, **kwargs)
+
+    def enqueue_message(self, chat_id: int, text: str, priority: int = NOTIFY, **kwargs):
+        """
+        Отправка без ожидания результата: ошибки только логируются.
+        """
+        future = self.submit("send_message", chat_id, priority, text=text, **kwargs)
+        future.add_done_callback(_log_failure)
+
+    def _put(self, priority, seq, item):
+        self._depth[item.lane] += 1
+        self._queue.put_nowait((priority, seq, item))
+
+    def _put_later(self, delay, priority, seq, item):
+        self._delayed += 1
+
+        def put():
+            self._delayed -= 1
+            self._put(priority, seq, item)
+
+        asyncio.get_running_loop().call_later(delay, put)
+
+    # --- Темп на чат ---
+    def _chat_wait(self, chat_id: int) -> float:
+        """
+        Сколько секунд чату ещё «остывать». Если 0 — токен чата уже списан.
+        """
+        now = time.monotonic()
+        state = self._chats.get(chat_id)
+        if state is None:
+            if len(self._chats) > 10000:
+                self._prune_chats(now)
+            state = self._chats[chat_id] = [OUTBOX_CHAT_BURST, now]
+        state[0] = min(OUTBOX_CHAT_BURST, state[0] + (now - state[1]) * OUTBOX_CHAT_RATE)
+        state[1] = now
+        if state[0] >= 1:
+            state[0] -= 1
+            return 0.0
+        return (1 - state[0]) / OUTBOX_CHAT_RATE
+
+    def _prune_chats(self, now: float):
+        idle = (OUTBOX_CHAT_BURST / OUTBOX_CHAT_RATE)
+        for chat_id in [c for c, (_, updated) in self._chats.items() if now - updated > idle]:
+            del self._chats[chat_id]
+
+    # --- Воркеры ---
+    async def _worker(self):
+        while True:
+            priority, seq, item = await self._queue.get()
+            self._depth[item.lane] -= 1
+            try:
+                await self._process(priority, seq, item)
+            except Exception as e:
+                logger.exception(f"❌ Сбой воркера очереди отправки: {e}")
+            finally:
+                self._queue.task_done()
+
+    async def _process(self, priority, seq, item: _Item):
+        if item.future.done():
+            return
+        wait = self._chat_wait(item.chat_id)
+        if wait > 0:
+            # Не держим воркер: вернём сообщение в очередь, когда чат «остынет»
+            self._put_later(wait, priority, seq, item)
+            return
+
+        await self.bucket.acquire()
+        item.attempts += 1
+        try:
+            result = await getattr(self.bot, item.method)(chat_id=item.chat_id, **item.kwargs)
+        except RetryAfter as e:
+            self.bucket.pause(e.retry_after)
+            if item.attempts <= OUTBOX_MAX_RETRIES:
+                self._metrics["retried"] += 1
+                self._put_later(e.retry_after, priority, seq, item)
+            else:
+                self._metrics["failed"] += 1
+                item.future.set_exception(e)
+        except Exception as e:
+            self._metrics["failed"] += 1
+            item.future.set_exception(e)
+        else:
+            self._metrics["sent"] += 1
+            self._latencies.append(time.monotonic() - item.enqueued_at)
+            item.future.set_result(result)
+
+    # --- Метрики ---
+    def stats(self) -> dict:
+        latencies = sorted(self._latencies)
+        p95 = latencies[int(len(latencies) * 0.95) - 1] if latencies else 0.0
+        avg = sum(latencies) / len(latencies) if latencies else 0.0
+        return {
+            "depth": {LANES[lane]: count for lane, count in self._depth.items()},
+            "delayed": self._delayed,
+            **self._metrics,
+            "latency_avg_ms": round(avg * 1000, 1),
+            "latency_p95_ms": round(p95 * 1000, 1),
+        }
+
+
+def _log_failure(future: asyncio.Future):
+    if not future.cancelled() and future.exception() is not None:
+        logger.warning(f"⚠️ Сообщение из очереди не отправлено: {future.exception()}")
+
+
+def get_outbox(application) -> Optional[Outbox]:
+    return application.bot_data.get('outbox')
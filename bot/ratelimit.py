@@ -0,0 +1,39 @@
+# bot/ratelimit.py
+"""
+Ограничение частоты исходящих запросов к Telegram.
+"""
+
+import asyncio
+import time
+
+
+class TokenBucket:
+    """
+    Асинхронное ведро токенов: в среднем `rate` операций в секунду,
+    не более `capacity` подряд. pause() останавливает выдачу (например, по RetryAfter).
+    """
+
+    def __init__(self, rate: float, capacity: float = None):
+        self.rate = rate
+        self.capacity = capacity or rate
+        self._tokens = self.capacity
+        self._updated = time.monotonic()
+        self._paused_until = 0.0
+        self._lock = asyncio.Lock()
+
+    def pause(self, seconds: float):
+        self._paused_until = max(self._paused_until, time.monotonic() + seconds)
+
+    async def acquire(self):
+        async with self._lock:
+            while True:
+                now = time.monotonic()
+                if now < self._paused_until:
+                    await asyncio.sleep(self._paused_until - now)
+                    continue
+                self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+                self._updated = now
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    return
+                await asyncio.sleep((1 - self._tokens) / self.rate)
@@ -0,0 +1,228 @@
+# bot/rates.py
+"""
+Курсы валют ЦБ РФ из памяти.
+
+Данные обновляются по расписанию (см. setup_currency_handlers) и отдаются
+из памяти; устаревшие отдаются сразу, а обновление идёт в фоне
+(stale-while-revalidate). Одновременные промахи делают один запрос к API.
+Последний удачный ответ сохраняется на диск — после перезапуска бот
+отвечает сразу, ещё до первого запроса к ЦБ.
+
+URL задаётся через CURRENCY_API_URL, поэтому сервис можно проверить
+на локальной заглушке. Запросы идут через CircuitBreaker: пока ЦБ недоступен,
+обновление сразу отказывает, а пользователи получают последние удачные курсы.
+"""
+
+import asyncio
+import json
+import os
+import time
+from array import array
+from typing import Optional
+
+import httpx
+from loguru import logger
+
+from bot.breaker import CircuitBreaker
+
+CURRENCY_API = os.getenv("CURRENCY_API_URL", "https://www.cbr-xml-daily.ru/latest.js")
+RATES_TTL = int(os.getenv("RATES_TTL", 3600))
+RATES_TIMEOUT = float(os.getenv("RATES_TIMEOUT", 10))
+RATES_SNAPSHOT = os.getenv(
+    "RATES_SNAPSHOT",
+    os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "data", "rates.json")
+)
+
+
+class RateTable:
+    """
+    Кросс-курсы всех валют из ответа ЦБ, посчитанные один раз на обновление.
+
+    В latest.js курсы даны как «единиц валюты за 1 рубль». Матрица хранится
+    плоским массивом n×n: matrix[i * n + j] — сколько единиц j стоит одна
+    единица i, поэтому любая конвертация — одно умножение.
+    """
+
+    def __init__(self, data: dict):
+        self.date = data["date"]
+        rates = {"RUB": 1.0}
+        rates.update((code, float(value)) for code, value in data["rates"].items() if value)
+        self.codes = tuple(sorted(rates))
+        self.index = {code: i for i, code in enumerate(self.codes)}
+        # Рублей за единицу валюты
+        self.rub = array("d", (1.0 / rates[code] for code in self.codes))
+        n = len(self.codes)
+        self.matrix = array("d", (self.rub[i] / self.rub[j] for i in range(n) for j in range(n)))
+
+    def __contains__(self, code: str) -> bool:
+        return code in self.index
+
+    def rate(self, from_code: str, to_code: str = "RUB") -> float:
+        return self.matrix[self.index[from_code] * len(self.codes) + self.index[to_code]]
+
+    def convert(self, amount: float, from_code: str, to_code: str = "RUB") -> float:
+        return amount * self.rate(from_code, to_code)
+
+
+class RatesService:
+    def __init__(self, url: str = CURRENCY_API, ttl: int = RATES_TTL,
+                 snapshot_path: Optional[str] = RATES_SNAPSHOT, client=None):
+        self.url = url
+        self.ttl = ttl
+        self.snapshot_path = snapshot_path
+        self._client = client or httpx.AsyncClient(timeout=RATES_TIMEOUT)
+        self._own_client = client is None
+        self._data: Optional[dict] = None
+        self.table: Optional[RateTable] = None
+        self._fetched_at = 0.0
+        self._refresh_task: Optional[asyncio.Task] = None
+        self.breaker = CircuitBreaker("cbr")
+        self.last_error: Optional[str] = None
+        self._listeners = []
+        self._metrics = {"hits": 0, "stale_hits": 0, "misses": 0, "upstream_calls": 0, "upstream_errors": 0}
+
+    # --- Чтение ---
+    async def get(self) -> Optional[dict]:
+        """
+        Текущие данные {"date": ..., "rates": {...}} или None, если их нет совсем
+        (холодный старт без снимка и ЦБ недоступен).
+        """
+        if self._data is None:
+            self._metrics["misses"] += 1
+            try:
+                await self.refresh()
+            except Exception as e:
+                logger.error(f"❌ Не удалось получить курсы: {e}")
+            return self._data
+
+        if self.is_stale():
+            self._metrics["stale_hits"] += 1
+            self._refresh_in_background()
+        else:
+            self._metrics["hits"] += 1
+        return self._data
+
+    def is_stale(self) -> bool:
+        return time.monotonic() - self._fetched_at > self.ttl
+
+    def serving_stale(self) -> bool:
+        """
+        Отдаются устаревшие данные, потому что последнее обновление не удалось.
+        """
+        return self.last_error is not None and self.is_stale()
+
+    # --- Обновление ---
+    async def refresh(self) -> dict:
+        """
+        Запрашивает свежие курсы. Одновременные вызовы ждут один и тот же запрос.
+        """
+        if self._refresh_task is None or self._refresh_task.done():
+            self._refresh_task = asyncio.create_task(self._fetch())
+        return await asyncio.shield(self._refresh_task)
+
+    def _refresh_in_background(self):
+        if self._refresh_task is not None and not self._refresh_task.done():
+            return
+        self._refresh_task = asyncio.create_task(self._fetch())
+        self._refresh_task.add_done_callback(_log_refresh_error)
+
+    async def _fetch(self) -> dict:
+        self._metrics["upstream_calls"] += 1
+        try:
+            data = await self.breaker.call(self._request)
+        except Exception as e:
+            self._metrics["upstream_errors"] += 1
+            self.last_error = str(e) or type(e).__name__
+            raise
+
+        self.last_error = None
+        self._set_data(data)
+        self._fetched_at = time.monotonic()
+        await asyncio.to_thread(self._save_snapshot, data)
+        self._notify(self.table)
+        return data
+
+    # --- Подписчики на обновления ---
+    def add_listener(self, callback):
+        """
+        callback(table) вызывается отдельной задачей после каждого удачного обновления.
+        """
+        self._listeners.append(callback)
+
+    def _notify(self, table: RateTable):
+        for callback in self._listeners:
+            asyncio.create_task(callback(table)).add_done_callback(_log_listener_error)
+
+    def _set_data(self, data: dict):
+        self.table = RateTable(data)
+        self._data = data
+
+    async def get_table(self) -> Optional[RateTable]:
+        """
+        Таблица кросс-курсов для текущих данных (см. get()).
+        """
+        await self.get()
+        return self.table
+
+    async def _request(self) -> dict:
+        response = await self._client.get(self.url)
+        response.raise_for_status()
+        data = response.json()
+        if not isinstance(data.get("rates"), dict) or "date" not in data:
+            raise ValueError("в ответе нет rates/date")
+        return data
+
+    # --- Снимок на диске ---
+    def load_snapshot(self):
+        """
+        Загружает последний сохранённый ответ. Возраст снимка берётся из времени
+        изменения файла и переводится на часы monotonic: снимок старше ttl
+        устарел, и первое же обращение запустит обновление в фоне.
+        """
+        if not self.snapshot_path or not os.path.exists(self.snapshot_path):
+            return
+        try:
+            with open(self.snapshot_path, "r", encoding="utf-8") as f:
+                self._set_data(json.load(f))
+            age = max(0.0, time.time() - os.path.getmtime(self.snapshot_path))
+            self._fetched_at = time.monotonic() - age
+            logger.info(f"💱 Курсы загружены из снимка за {self._data.get('date')}")
+        except Exception as e:
+            logger.warning(f"⚠️ Не удалось прочитать снимок курсов: {e}")
+
+    def _save_snapshot(self, data: dict):
+        if not self.snapshot_path:
+            return
+        try:
+            os.makedirs(os.path.dirname(self.snapshot_path), exist_ok=True)
+            tmp_path = f"{self.snapshot_path}.tmp"
+            with open(tmp_path, "w", encoding="utf-8") as f:
+                json.dump(data, f, ensure_ascii=False)
+            os.replace(tmp_path, self.snapshot_path)
+        except Exception as e:
+            logger.warning(f"⚠️ Не удалось сохранить снимок курсов: {e}")
+
+    async def close(self):
+        if self._refresh_task is not None and not self._refresh_task.done():
+            self._refresh_task.cancel()
+        if self._own_client:
+            await self._client.aclose()
+
+    def stats(self) -> dict:
+        age = time.monotonic() - self._fetched_at if self._data is not None else None
+        return {
+            **self._metrics,
+            "breaker": self.breaker.state,
+            "date": self._data.get("date") if self._data else None,
+            "age_seconds": round(age) if age is not None else None,
+        }
+
+
+def _log_listener_error(task: asyncio.Task):
+    if not task.cancelled() and task.exception() is not None:
+        logger.exception(f"❌ Ошибка обработчика обновления курсов: {task.exception()}")
+
+
+def _log_refresh_error(task: asyncio.Task):
+    if not task.cancelled() and task.exception() is not None:
+        logger.warning(f"⚠️ Фоновое обновление курсов не удалось: {task.exception()}")
@@ -0,0 +1,164 @@
+# bot/weather_service.py
+"""
+Погода OpenWeatherMap с кэшем по городу.
+
+Ключ — название города без учёта регистра и лишних пробелов. Данные живут
+WEATHER_TTL секунд (OpenWeatherMap обновляет их примерно раз в 10 минут).
+Одновременные запросы одного города ждут один запрос к API. Города, которых
+API не знает (404), кэшируются отдельно, чтобы опечатки не расходовали квоту.
+
+Запросы идут через CircuitBreaker. Если API недоступен, а город уже
+запрашивали, отдаётся последний удачный ответ с пометкой "stale": True.
+"""
+
+import asyncio
+import os
+import time
+from collections import OrderedDict
+from typing import Optional
+
+import httpx
+from loguru import logger
+
+from bot.breaker import CircuitBreaker
+
+WEATHER_API_KEY = os.getenv("WEATHER_API_KEY")
+WEATHER_URL = os.getenv("WEATHER_API_URL", "http://api.openweathermap.org/data/2.5/weather")
+WEATHER_TTL = int(os.getenv("WEATHER_TTL", 600))
+WEATHER_CACHE_MAX = int(os.getenv("WEATHER_CACHE_MAX", 2000))
+WEATHER_NEGATIVE_TTL = int(os.getenv("WEATHER_NEGATIVE_TTL", 3600))
+WEATHER_NEGATIVE_MAX = int(os.getenv("WEATHER_NEGATIVE_MAX", 1000))
+WEATHER_TIMEOUT = float(os.getenv("WEATHER_TIMEOUT", 10))
+
+
+def normalize_city(city: str) -> str:
+    return " ".join(city.split()).casefold()
+
+
+class WeatherService:
+    def __init__(self, api_key: Optional[str] = WEATHER_API_KEY, url: str = WEATHER_URL,
+                 ttl: int = WEATHER_TTL, client=None):
+        self.api_key = api_key
+        self.url = url
+        self.ttl = ttl
+        self._client = client or httpx.AsyncClient(timeout=WEATHER_TIMEOUT)
+        self._own_client = client is None
+        self._cache = OrderedDict()  # город -> (expires_at, payload)
+        self._not_found = OrderedDict()  # город -> expires_at
+        self._in_flight = {}  # город -> asyncio.Task
+        self.breaker = CircuitBreaker("openweathermap")
+        self._metrics = {
+            "hits": 0, "misses": 0, "negative_hits": 0, "coalesced": 0,
+            "upstream_calls": 0, "upstream_errors": 0, "evictions": 0, "stale_served": 0, "prefetches": 0,
+        }
+
+    async def get(self, city: str) -> Optional[dict]:
+        """
+        Ответ OpenWeatherMap для города или None, если город не найден.
+        Ошибки API (кроме 404) пробрасываются.
+        """
+        key = normalize_city(city)
+        now = time.monotonic()
+
+        cached = self._cache.get(key)
+        if cached and cached[0] > now:
+            self._cache.move_to_end(key)
+            self._metrics["hits"] += 1
+            return cached[1]
+
+        expires_at = self._not_found.get(key)
+        if expires_at and expires_at > now:
+            self._metrics["negative_hits"] += 1
+            return None
+
+        if key in self._in_flight:
+            self._metrics["coalesced"] += 1
+        else:
+            self._metrics["misses"] += 1
+        return await self._load(key)
+
+    async def prefetch(self, city: str, min_ttl: float = 0.0) -> bool:
+        """
+        Обновляет кэш города, если запись истечёт раньше чем через min_ttl секунд.
+        Возвращает True, если был запрос к API. Города из негативного кэша
+        не запрашиваются, пока запись не истечёт.
+        """
+        key = normalize_city(city)
+        now = time.monotonic()
+        cached = self._cache.get(key)
+        if cached and cached[0] - now > min_ttl:
+            return False
+        expires_at = self._not_found.get(key)
+        if expires_at and expires_at > now:
+            return False
+        self._metrics["prefetches"] += 1
+        await self._load(key)
+        return True
+
+    async def _load(self, key: str) -> Optional[dict]:
+        task = self._in_flight.get(key)
+        if task is None:
+            task = asyncio.create_task(self._fetch(key))
+            self._in_flight[key] = task
+            task.add_done_callback(lambda _: self._in_flight.pop(key, None))
+        return await asyncio.shield(task)
+
+    async def _fetch(self, key: str) -> Optional[dict]:
+        self._metrics["upstream_calls"] += 1
+        try:
+            response = await self.breaker.call(self._request, key)
+        except Exception as e:
+            self._metrics["upstream_errors"] += 1
+            # Просроченная запись остаётся в кэше до вытеснения — отдаём её
+            cached = self._cache.get(key)
+            if cached is None:
+                raise
+            logger.warning(f"⚠️ Погода для «{key}» из кэша: API недоступен ({e or type(e).__name__})")
+            self._metrics["stale_served"] += 1
+            return {**cached[1], "stale": True}
+
+        if response.status_code == 404:
+            self._remember_not_found(key)
+            return None
+        payload = response.json()
+
+        self._cache[key] = (time.monotonic() + self.ttl, payload)
+        self._cache.move_to_end(key)
+        while len(self._cache) > WEATHER_CACHE_MAX:
+            self._cache.popitem(last=False)
+            self._metrics["evictions"] += 1
+        return payload
+
+    async def _request(self, key: str):
+        response = await self._client.get(
+            self.url,
+            params={"q": key, "appid": self.api_key, "lang": "ru", "units": "metric"},
+        )
+        if response.status_code != 404:
+            response.raise_for_status()
+        return response
+
+    def _remember_not_found(self, key: str):
+        self._not_found[key] = time.monotonic() + WEATHER_NEGATIVE_TTL
+        self._not_found.move_to_end(key)
+        while len(self._not_found) > WEATHER_NEGATIVE_MAX:
+            self._not_found.popitem(last=False)
+
+    async def close(self):
+        for task in list(self._in_flight.values()):
+            task.cancel()
+        if self._own_client:
+            await self._client.aclose()
+
+    def stats(self) -> dict:
+        total = self._metrics["hits"] + self._metrics["negative_hits"] + self._metrics["misses"] + self._metrics["coalesced"]
+        served = total - self._metrics["misses"]
+        hit_ratio = round(served / total, 3) if total else 0.0
+        return {
+            "size": len(self._cache),
+            "not_found": len(self._not_found),
+            "in_flight": len(self._in_flight),
+            "hit_ratio": hit_ratio,
+            "breaker": self.breaker.state,
+            **self._metrics,
+        }
@@ -1,6 +1,11 @@
 # database.py
+import asyncio
 import asyncpg
+import hashlib
 import os
+import time
+from collections import OrderedDict
+from datetime import datetime, timedelta, timezone
 from loguru import logger
 
 # Получаем URL базы из переменных окружения
@@ -11,175 +16,543 @@ if not DATABASE_URL:
 # Глобальный пул
 _db_pool = None
 
+# --- Настройки пула (из переменных окружения) ---
+DB_POOL_MIN_SIZE = int(os.getenv("DB_POOL_MIN_SIZE", 2))
+DB_POOL_MAX_SIZE = int(os.getenv("DB_POOL_MAX_SIZE", 10))
+DB_POOL_MAX_INACTIVE_LIFETIME = float(os.getenv("DB_POOL_MAX_INACTIVE_LIFETIME", 300))
+DB_COMMAND_TIMEOUT = float(os.getenv("DB_COMMAND_TIMEOUT", 30))
+DB_STATEMENT_CACHE_SIZE = int(os.getenv("DB_STATEMENT_CACHE_SIZE", 256))
+DB_STATEMENT_TIMEOUT_MS = int(os.getenv("DB_STATEMENT_TIMEOUT_MS", 30000))
+DB_DISABLE_JIT = os.getenv("DB_DISABLE_JIT", "1") == "1"
+
+# --- Реестр горячих запросов: имя -> SQL ---
+# Каждый запрос готовится один раз на соединение (в init пула) и дальше
+# выполняется через prepared(conn, name) без повторного разбора.
+PREPARED_QUERIES = {}
+_prepared_statements = {}  # pid серверного процесса -> {имя: PreparedStatement}
+
+
+def register_query(name: str, sql: str) -> str:
+    PREPARED_QUERIES[name] = sql
+    return name
+
+
+async def prepared(conn, name: str):
+    """
+    Возвращает подготовленный запрос из реестра для данного соединения.
+    """
+    statements = _prepared_statements.setdefault(conn.get_server_pid(), {})
+    stmt = statements.get(name)
+    if stmt is None:
+        stmt = await conn.prepare(PREPARED_QUERIES[name])
+        statements[name] = stmt
+    return stmt
+
+
+async def _init_connection(conn):
+    pid = conn.get_server_pid()
+    statements = {}
+    for name, sql in PREPARED_QUERIES.items():
+        try:
+            statements[name] = await conn.prepare(sql)
+        except asyncpg.PostgresError as e:
+            # Например, схема ещё не создана — подготовим позже, при первом вызове
+            logger.debug(f"⚠️ Запрос {name} не подготовлен при подключении: {e}")
+    _prepared_statements[pid] = statements
+
+    def _forget(_conn):
+        # pid может достаться новому соединению — удаляем только свои запросы
+        if _prepared_statements.get(pid) is statements:
+            del _prepared_statements[pid]
+
+    conn.add_termination_listener(_forget)
+
+
+class InstrumentedPool:
+    """
+    Обёртка над asyncpg.Pool: тот же интерфейс, плюс учёт ожидания соединений.
+    """
+
+    def __init__(self, pool):
+        self._pool = pool
+        self.waiting = 0
+        self.acquires = 0
+        self.wait_total = 0.0
+        self.wait_max = 0.0
+
+    def __getattr__(self, name):
+        return getattr(self._pool, name)
+
+    def acquire(self, *, timeout=None):
+        return _TimedAcquire(self, timeout)
+
+    async def _acquire(self, timeout=None):
+        self.waiting += 1
+        started = time.perf_counter()
+        try:
+            return await self._pool.acquire(timeout=timeout)
+        finally:
+            waited = time.perf_counter() - started
+            self.waiting -= 1
+            self.acquires += 1
+            self.wait_total += waited
+            self.wait_max = max(self.wait_max, waited)
+
+    async def execute(self, query, *args, timeout=None):
+        async with self.acquire() as conn:
+            return await conn.execute(query, *args, timeout=timeout)
+
+    async def executemany(self, command, args, *, timeout=None):
+        async with self.acquire() as conn:
+            return await conn.executemany(command, args, timeout=timeout)
+
+    async def fetch(self, query, *args, timeout=None, record_class=None):
+        async with self.acquire() as conn:
+            return await conn.fetch(query, *args, timeout=timeout, record_class=record_class)
+
+    async def fetchval(self, query, *args, column=0, timeout=None):
+        async with self.acquire() as conn:
+            return await conn.fetchval(query, *args, column=column, timeout=timeout)
+
+    async def fetchrow(self, query, *args, timeout=None, record_class=None):
+        async with self.acquire() as conn:
+            return await conn.fetchrow(query, *args, timeout=timeout, record_class=record_class)
+
+    def stats(self) -> dict:
+        size = self._pool.get_size()
+        idle = self._pool.get_idle_size()
+        return {
+            "size": size,
+            "in_use": size - idle,
+            "idle": idle,
+            "min_size": self._pool.get_min_size(),
+            "max_size": self._pool.get_max_size(),
+            "waiting": self.waiting,
+            "acquires": self.acquires,
+            "acquire_wait_avg_ms": round(self.wait_total / self.acquires * 1000, 3) if self.acquires else 0.0,
+            "acquire_wait_max_ms": round(self.wait_max * 1000, 3),
+        }
+
+
+class _TimedAcquire:
+    # Поддерживает оба варианта: `async with pool.acquire()` и `await pool.acquire()`
+    def __init__(self, owner: InstrumentedPool, timeout):
+        self._owner = owner
+        self._timeout = timeout
+        self._conn = None
+
+    async def __aenter__(self):
+        self._conn = await self._owner._acquire(self._timeout)
+        return self._conn
+
+    async def __aexit__(self, *exc):
+        conn, self._conn = self._conn, None
+        await self._owner._pool.release(conn)
+
+    def __await__(self):
+        return self._owner._acquire(self._timeout).__await__()
+
 
 async def create_db_pool():
     """
-    Создаёт пул подключений к PostgreSQL.
+    Создаёт пул подключений к PostgreSQL с настройками из окружения.
     """
     global _db_pool
+    server_settings = {"statement_timeout": str(DB_STATEMENT_TIMEOUT_MS)}
+    if DB_DISABLE_JIT:
+        server_settings["jit"] = "off"
     try:
-        _db_pool = await asyncpg.create_pool(DATABASE_URL)
-        logger.info("✅ Пул подключений к БД создан")
+        pool = await asyncpg.create_pool(
+            DATABASE_URL,
+            min_size=DB_POOL_MIN_SIZE,
+            max_size=DB_POOL_MAX_SIZE,
+            max_inactive_connection_lifetime=DB_POOL_MAX_INACTIVE_LIFETIME,
+            command_timeout=DB_COMMAND_TIMEOUT,
+            statement_cache_size=DB_STATEMENT_CACHE_SIZE,
+            server_settings=server_settings,
+            init=_init_connection,
+        )
+        _db_pool = InstrumentedPool(pool)
+        logger.info(f"✅ Пул подключений к БД создан (min={DB_POOL_MIN_SIZE}, max={DB_POOL_MAX_SIZE})")
         return _db_pool
     except Exception as e:
         logger.critical(f"❌ Не удалось создать пул БД: {e}")
         raise
 
 
-async def init_db(pool):
+def get_pool_stats(pool=None) -> dict:
     """
-    Инициализирует все таблицы и применяет миграции.
+    Текущее состояние пула: занятые, свободные, ожидающие, время ожидания.
     """
-    async with pool.acquire() as conn:
+    pool = pool or _db_pool
+    if pool is None:
+        return {}
+    return pool.stats()
+
+
+# --- Миграции схемы ---
+# Каждая миграция применяется ровно один раз, её номер записывается в schema_version.
+# Менять уже выпущенные миграции нельзя — только добавлять новые в конец списка.
+# Необязательный четвёртый элемент — индексы на больших таблицах: (имя, CREATE INDEX
+# CONCURRENTLY ...). Они строятся вне транзакции миграции и не блокируют запись.
+MIGRATIONS = [
+    (1, "Базовая схема", [
         # --- Таблица пользователей ---
-        await conn.execute('''
-            CREATE TABLE IF NOT EXISTS users (
-                id BIGINT PRIMARY KEY,
-                username TEXT,
-                first_name TEXT,
-                last_name TEXT,
-                language_code TEXT,
-                is_bot BOOLEAN,
-                role TEXT NOT NULL DEFAULT 'user',
-                created_at TIMESTAMPTZ DEFAULT NOW(),
-                last_seen TIMESTAMPTZ DEFAULT NOW(),
-                premium_expires TIMESTAMPTZ,
-                theme TEXT DEFAULT 'light',
-                language TEXT DEFAULT 'ru'
-            );
-        ''')
-        # --- Безопасное обновление CHECK-ограничения для role ---
-        await conn.execute("""
-            ALTER TABLE users ADD COLUMN IF NOT EXISTS role TEXT NOT NULL DEFAULT 'user';
-            UPDATE users SET role = 'user' WHERE role IS NULL;
-            ALTER TABLE users DROP CONSTRAINT IF EXISTS role_check;
-            ALTER TABLE users ADD CONSTRAINT role_check 
-            CHECK (role IN ('user', 'premium', 'moderator', 'admin'));
-        """)
+        '''
+        CREATE TABLE IF NOT EXISTS users (
+            id BIGINT PRIMARY KEY,
+            username TEXT,
+            first_name TEXT,
+            last_name TEXT,
+            language_code TEXT,
+            is_bot BOOLEAN,
+            role TEXT NOT NULL DEFAULT 'user',
+            created_at TIMESTAMPTZ DEFAULT NOW(),
+            last_seen TIMESTAMPTZ DEFAULT NOW(),
+            premium_expires TIMESTAMPTZ,
+            theme TEXT DEFAULT 'light',
+            language TEXT DEFAULT 'ru'
+        )
+        ''',
+        # Колонки, появившиеся после первых версий
+        "ALTER TABLE users ADD COLUMN IF NOT EXISTS role TEXT NOT NULL DEFAULT 'user'",
+        "ALTER TABLE users ADD COLUMN IF NOT EXISTS theme TEXT DEFAULT 'light'",
+        "ALTER TABLE users ADD COLUMN IF NOT EXISTS language TEXT DEFAULT 'ru'",
+        "ALTER TABLE users ADD COLUMN IF NOT EXISTS last_name TEXT",
+        "ALTER TABLE users ADD COLUMN IF NOT EXISTS is_bot BOOLEAN",
+        "ALTER TABLE users ADD COLUMN IF NOT EXISTS last_seen TIMESTAMPTZ DEFAULT NOW()",
+        "ALTER TABLE users ADD COLUMN IF NOT EXISTS premium_expires TIMESTAMPTZ",
+        "ALTER TABLE users ADD COLUMN IF NOT EXISTS city TEXT",
+        # CHECK-ограничение для role
+        "UPDATE users SET role = 'user' WHERE role IS NULL",
+        "ALTER TABLE users DROP CONSTRAINT IF EXISTS role_check",
+        "ALTER TABLE users ADD CONSTRAINT role_check CHECK (role IN ('user', 'premium', 'moderator', 'admin'))",
 
         # --- Таблица напоминаний ---
-        await conn.execute('''
-            CREATE TABLE IF NOT EXISTS reminders (
-                id SERIAL PRIMARY KEY,
-                user_id BIGINT NOT NULL,
-                text TEXT NOT NULL,
-                created_at TIMESTAMPTZ DEFAULT NOW(),
-                FOREIGN KEY (user_id) REFERENCES users (id) ON DELETE CASCADE
-            );
-        ''')
-        # Гарантируем наличие колонки `time`
-        await conn.execute("ALTER TABLE reminders ADD COLUMN IF NOT EXISTS time TIMESTAMPTZ;")
-        # Устанавливаем NOT NULL, если нужно (только если все строки уже имеют значение)
-        await conn.execute("UPDATE reminders SET time = created_at WHERE time IS NULL;")
-        await conn.execute("ALTER TABLE reminders ALTER COLUMN time SET NOT NULL;")
-        # Создаём индекс
-        await conn.execute('CREATE INDEX IF NOT EXISTS idx_reminders_time ON reminders (time);')
+        '''
+        CREATE TABLE IF NOT EXISTS reminders (
+            id SERIAL PRIMARY KEY,
+            user_id BIGINT NOT NULL,
+            text TEXT NOT NULL,
+            created_at TIMESTAMPTZ DEFAULT NOW(),
+            FOREIGN KEY (user_id) REFERENCES users (id) ON DELETE CASCADE
+        )
+        ''',
+        "ALTER TABLE reminders ADD COLUMN IF NOT EXISTS time TIMESTAMPTZ",
+        "UPDATE reminders SET time = created_at WHERE time IS NULL",
+        "ALTER TABLE reminders ALTER COLUMN time SET NOT NULL",
+        "CREATE INDEX IF NOT EXISTS idx_reminders_time ON reminders (time)",
 
         # --- Таблица подписок ---
-        await conn.execute('''
-            CREATE TABLE IF NOT EXISTS subscriptions (
-                id SERIAL PRIMARY KEY,
-                user_id BIGINT NOT NULL,
-                name TEXT NOT NULL,
-                amount DECIMAL(10, 2) NOT NULL,
-                currency TEXT DEFAULT '₽',
-                billing_cycle INTERVAL NOT NULL,
-                next_payment TIMESTAMPTZ NOT NULL,
-                created_at TIMESTAMPTZ DEFAULT NOW(),
-                FOREIGN KEY (user_id) REFERENCES users (id) ON DELETE CASCADE
-            );
-        ''')
-        await conn.execute('CREATE INDEX IF NOT EXISTS idx_subscriptions_next ON subscriptions (next_payment);')
+        '''
+        CREATE TABLE IF NOT EXISTS subscriptions (
+            id SERIAL PRIMARY KEY,
+            user_id BIGINT NOT NULL,
+            name TEXT NOT NULL,
+            amount DECIMAL(10, 2) NOT NULL,
+            currency TEXT DEFAULT '₽',
+            billing_cycle INTERVAL NOT NULL,
+            next_payment TIMESTAMPTZ NOT NULL,
+            created_at TIMESTAMPTZ DEFAULT NOW(),
+            FOREIGN KEY (user_id) REFERENCES users (id) ON DELETE CASCADE
+        )
+        ''',
+        "CREATE INDEX IF NOT EXISTS idx_subscriptions_next ON subscriptions (next_payment)",
 
         # --- Таблица рефералов ---
-        await conn.execute('''
-            CREATE TABLE IF NOT EXISTS referrals (
-                id SERIAL PRIMARY KEY,
-                referrer_id BIGINT NOT NULL REFERENCES users(id) ON DELETE CASCADE,
-                referred_id BIGINT NOT NULL UNIQUE REFERENCES users(id) ON DELETE CASCADE,
-                created_at TIMESTAMPTZ DEFAULT NOW()
-            );
-        ''')
+        '''
+        CREATE TABLE IF NOT EXISTS referrals (
+            id SERIAL PRIMARY KEY,
+            referrer_id BIGINT NOT NULL REFERENCES users(id) ON DELETE CASCADE,
+            referred_id BIGINT NOT NULL UNIQUE REFERENCES users(id) ON DELETE CASCADE,
+            created_at TIMESTAMPTZ DEFAULT NOW()
+        )
+        ''',
+        "CREATE INDEX IF NOT EXISTS idx_referrals_referrer ON referrals(referrer_id)",
 
         # --- Таблица статистики использования команд ---
-        await conn.execute('''
-            CREATE TABLE IF NOT EXISTS usage_stats (
-                id SERIAL PRIMARY KEY,
-                user_id BIGINT REFERENCES users(id) ON DELETE CASCADE,
-                command TEXT NOT NULL,
-                timestamp TIMESTAMPTZ DEFAULT NOW()
-            );
-        ''')
+        '''
+        CREATE TABLE IF NOT EXISTS usage_stats (
+            id SERIAL PRIMARY KEY,
+            user_id BIGINT REFERENCES users(id) ON DELETE CASCADE,
+            command TEXT NOT NULL,
+            timestamp TIMESTAMPTZ DEFAULT NOW()
+        )
+        ''',
 
         # --- Таблица отзывов ---
-        await conn.execute('''
-            CREATE TABLE IF NOT EXISTS reviews (
-                id SERIAL PRIMARY KEY,
-                user_id BIGINT NOT NULL REFERENCES users(id) ON DELETE CASCADE,
-                text TEXT NOT NULL,
-                rating INT CHECK (rating >= 1 AND rating <= 5),
-                created_at TIMESTAMPTZ DEFAULT NOW(),
-                is_approved BOOLEAN DEFAULT TRUE
-            );
-        ''')
+        '''
+        CREATE TABLE IF NOT EXISTS reviews (
+            id SERIAL PRIMARY KEY,
+            user_id BIGINT NOT NULL REFERENCES users(id) ON DELETE CASCADE,
+            text TEXT NOT NULL,
+            rating INT CHECK (rating >= 1 AND rating <= 5),
+            created_at TIMESTAMPTZ DEFAULT NOW(),
+            is_approved BOOLEAN DEFAULT TRUE
+        )
+        ''',
 
         # --- Таблица: обращения в техподдержку ---
-        await conn.execute('''
-            CREATE TABLE IF NOT EXISTS support_tickets (
-                id SERIAL PRIMARY KEY,
-                user_id BIGINT NOT NULL REFERENCES users(id) ON DELETE CASCADE,
-                username TEXT,
-                first_name TEXT,
-                message TEXT NOT NULL,
-                status TEXT NOT NULL DEFAULT 'open',
-                created_at TIMESTAMPTZ DEFAULT NOW(),
-                updated_at TIMESTAMPTZ DEFAULT NOW(),
-                ticket_id TEXT UNIQUE
-            );
-        ''')
-        # Индексы (IF NOT EXISTS)
-        await conn.execute('CREATE INDEX IF NOT EXISTS idx_support_user ON support_tickets(user_id);')
-        await conn.execute('CREATE INDEX IF NOT EXISTS idx_support_status ON support_tickets(status);')
-        await conn.execute('CREATE INDEX IF NOT EXISTS idx_support_ticket_id ON support_tickets(ticket_id);')
+        '''
+        CREATE TABLE IF NOT EXISTS support_tickets (
+            id SERIAL PRIMARY KEY,
+            user_id BIGINT NOT NULL REFERENCES users(id) ON DELETE CASCADE,
+            username TEXT,
+            first_name TEXT,
+            message TEXT NOT NULL,
+            status TEXT NOT NULL DEFAULT 'open',
+            created_at TIMESTAMPTZ DEFAULT NOW(),
+            updated_at TIMESTAMPTZ DEFAULT NOW(),
+            ticket_id TEXT UNIQUE
+        )
+        ''',
+        "CREATE INDEX IF NOT EXISTS idx_support_user ON support_tickets(user_id)",
+        "CREATE INDEX IF NOT EXISTS idx_support_status ON support_tickets(status)",
+        "CREATE INDEX IF NOT EXISTS idx_support_ticket_id ON support_tickets(ticket_id)",
 
         # --- Таблица финансовых операций ---
-        await conn.execute('''
-            CREATE TABLE IF NOT EXISTS finance_operations (
-                id SERIAL PRIMARY KEY,
-                user_id BIGINT NOT NULL REFERENCES users(id) ON DELETE CASCADE,
-                amount DECIMAL(12, 2) NOT NULL,
-                type TEXT NOT NULL CHECK (type IN ('income', 'expense')),
-                category TEXT,
-                comment TEXT,
-                created_at TIMESTAMPTZ DEFAULT NOW()
-            );
-        ''')
-        await conn.execute('CREATE INDEX IF NOT EXISTS idx_finance_user ON finance_operations(user_id);')
-        await conn.execute('CREATE INDEX IF NOT EXISTS idx_finance_type ON finance_operations(type);')
-        await conn.execute('CREATE INDEX IF NOT EXISTS idx_finance_date ON finance_operations(created_at);')
-
-        # --- Миграции — расширения (только добавление колонок) ---
-        migrations = [
-            ('theme', "TEXT DEFAULT 'light'"),
-            ('language', "TEXT DEFAULT 'ru'"),
-            ('last_name', 'TEXT'),
-            ('is_bot', 'BOOLEAN'),
-            ('last_seen', 'TIMESTAMPTZ DEFAULT NOW()'),
-            ('premium_expires', 'TIMESTAMPTZ'),
-            ('city', 'TEXT'),
-        ]
-
-        for column, type_def in migrations:
-            try:
-                await conn.execute(f'''
-                    ALTER TABLE users 
-                    ADD COLUMN IF NOT EXISTS {column} {type_def};
-                ''')
-                logger.info(f"✅ Колонка {column} добавлена (если отсутствовала)")
-            except Exception as e:
-                logger.warning(f"⚠️ Ошибка при добавлении колонки {column}: {e}")
-
-        logger.info("✅ Все таблицы и миграции применены")
+        '''
+        CREATE TABLE IF NOT EXISTS finance_operations (
+            id SERIAL PRIMARY KEY,
+            user_id BIGINT NOT NULL REFERENCES users(id) ON DELETE CASCADE,
+            amount DECIMAL(12, 2) NOT NULL,
+            type TEXT NOT NULL CHECK (type IN ('income', 'expense')),
+            category TEXT,
+            comment TEXT,
+            created_at TIMESTAMPTZ DEFAULT NOW()
+        )
+        ''',
+        "CREATE INDEX IF NOT EXISTS idx_finance_user ON finance_operations(user_id)",
+        "CREATE INDEX IF NOT EXISTS idx_finance_type ON finance_operations(type)",
+        "CREATE INDEX IF NOT EXISTS idx_finance_date ON finance_operations(created_at)",
+    ]),
+    (2, "Дневные агрегаты usage_stats", [
+        "CREATE INDEX IF NOT EXISTS idx_usage_stats_timestamp ON usage_stats (timestamp)",
+        '''
+        CREATE TABLE IF NOT EXISTS usage_daily (
+            day DATE NOT NULL,
+            command TEXT NOT NULL,
+            count BIGINT NOT NULL,
+            PRIMARY KEY (day, command)
+        )
+        ''',
+        # Водяные знаки фоновых агрегаций: до какого дня включительно всё посчитано
+        '''
+        CREATE TABLE IF NOT EXISTS rollup_state (
+            name TEXT PRIMARY KEY,
+            watermark DATE NOT NULL,
+            updated_at TIMESTAMPTZ DEFAULT NOW()
+        )
+        ''',
+    ]),
+    (3, "Диспетчер напоминаний", [
+        # Аренда напоминания репликой бота: пока не истекла, другие его не берут
+        "ALTER TABLE reminders ADD COLUMN IF NOT EXISTS claimed_until TIMESTAMPTZ",
+        "CREATE INDEX IF NOT EXISTS idx_reminders_user ON reminders (user_id)",
+    ]),
+    (4, "Рассылки", [
+        '''
+        CREATE TABLE IF NOT EXISTS broadcasts (
+            id SERIAL PRIMARY KEY,
+            admin_id BIGINT NOT NULL,
+            text TEXT NOT NULL,
+            status TEXT NOT NULL DEFAULT 'running'
+                CHECK (status IN ('running', 'done', 'cancelled')),
+            last_user_id BIGINT NOT NULL DEFAULT 0,
+            total INT NOT NULL DEFAULT 0,
+            sent INT NOT NULL DEFAULT 0,
+            failed INT NOT NULL DEFAULT 0,
+            created_at TIMESTAMPTZ DEFAULT NOW(),
+            updated_at TIMESTAMPTZ DEFAULT NOW(),
+            finished_at TIMESTAMPTZ
+        )
+        ''',
+        '''
+        CREATE TABLE IF NOT EXISTS broadcast_failures (
+            broadcast_id INT NOT NULL REFERENCES broadcasts(id) ON DELETE CASCADE,
+            user_id BIGINT NOT NULL,
+            reason TEXT NOT NULL,
+            created_at TIMESTAMPTZ DEFAULT NOW(),
+            PRIMARY KEY (broadcast_id, user_id)
+        )
+        ''',
+    ]),
+    (5, "Утренняя сводка погоды", [
+        'ALTER TABLE users ADD COLUMN IF NOT EXISTS weather_digest BOOLEAN NOT NULL DEFAULT FALSE',
+        'CREATE INDEX IF NOT EXISTS idx_users_weather_digest ON users (city) WHERE weather_digest',
+    ]),
+    (6, "Уведомления о курсах валют", [
+        '''
+        CREATE TABLE IF NOT EXISTS currency_alerts (
+            id SERIAL PRIMARY KEY,
+            user_id BIGINT NOT NULL REFERENCES users(id) ON DELETE CASCADE,
+            code TEXT NOT NULL,
+            op TEXT NOT NULL CHECK (op IN ('>', '<', '%')),
+            threshold DOUBLE PRECISION NOT NULL,
+            base DOUBLE PRECISION,
+            active BOOLEAN NOT NULL DEFAULT TRUE,
+            created_at TIMESTAMPTZ DEFAULT NOW(),
+            triggered_at TIMESTAMPTZ
+        )
+        ''',
+        'CREATE INDEX IF NOT EXISTS idx_currency_alerts_user ON currency_alerts (user_id) WHERE active',
+    ]),
+    (7, "История курсов валют", [
+        '''
+        CREATE TABLE IF NOT EXISTS currency_rates (
+            code TEXT NOT NULL,
+            date DATE NOT NULL,
+            value DOUBLE PRECISION NOT NULL,
+            PRIMARY KEY (code, date)
+        )
+        ''',
+    ]),
+    (8, "Время смены роли (отзыв веб-сессий)", [
+        'ALTER TABLE users ADD COLUMN IF NOT EXISTS role_updated_at TIMESTAMPTZ',
+        'CREATE INDEX IF NOT EXISTS idx_users_role_updated ON users (role_updated_at) WHERE role_updated_at IS NOT NULL',
+        '''
+        CREATE OR REPLACE FUNCTION touch_role_updated_at() RETURNS trigger AS $$
+        BEGIN
+            NEW.role_updated_at := NOW();
+            RETURN NEW;
+        END;
+        $$ LANGUAGE plpgsql
+        ''',
+        'DROP TRIGGER IF EXISTS trg_users_role_updated ON users',
+        '''
+        CREATE TRIGGER trg_users_role_updated
+        BEFORE UPDATE OF role ON users
+        FOR EACH ROW WHEN (OLD.role IS DISTINCT FROM NEW.role)
+        EXECUTE FUNCTION touch_role_updated_at()
+        ''',
+    ]),
+    (9, "Индексы для списка и поиска пользователей в админке", [
+        # Новые строки всегда получают last_seen = NOW(); NOT NULL не ставим —
+        # это полное сканирование users под эксклюзивной блокировкой
+        "UPDATE users SET last_seen = COALESCE(created_at, NOW()) WHERE last_seen IS NULL",
+        # pg_trgm может быть недоступен без прав суперпользователя — тогда поиск работает без индекса
+        '''
+        DO $$
+        BEGIN
+            CREATE EXTENSION IF NOT EXISTS pg_trgm;
+        EXCEPTION WHEN insufficient_privilege OR undefined_file THEN
+            RAISE NOTICE 'pg_trgm недоступен, индекс для поиска по username не создан';
+        END
+        $$
+        ''',
+    ], [
+        ("idx_users_last_seen",
+         'CREATE INDEX CONCURRENTLY IF NOT EXISTS idx_users_last_seen ON users (last_seen DESC, id DESC)'),
+        ("idx_users_role_last_seen",
+         'CREATE INDEX CONCURRENTLY IF NOT EXISTS idx_users_role_last_seen ON users (role, last_seen DESC, id DESC)'),
+        ("idx_users_username_trgm",
+         'CREATE INDEX CONCURRENTLY IF NOT EXISTS idx_users_username_trgm ON users USING gin (username gin_trgm_ops)'),
+    ]),
+    (10, "Квота GigaChat (вместо data/usage.json)", [
+        '''
+        CREATE TABLE IF NOT EXISTS gigachat_quota (
+            id BOOLEAN PRIMARY KEY DEFAULT TRUE CHECK (id),
+            total_limit INT NOT NULL DEFAULT 100,
+            last_reset TIMESTAMPTZ NOT NULL DEFAULT NOW()
+        )
+        ''',
+        '''
+        CREATE TABLE IF NOT EXISTS gigachat_usage (
+            user_id BIGINT PRIMARY KEY,
+            requests INT NOT NULL DEFAULT 0,
+            updated_at TIMESTAMPTZ DEFAULT NOW()
+        )
+        ''',
+    ]),
+    (11, "Отметки о ежедневных рассылках (одна реплика на день)", [
+        '''
+        CREATE TABLE IF NOT EXISTS daily_runs (
+            name TEXT NOT NULL,
+            day DATE NOT NULL,
+            started_at TIMESTAMPTZ DEFAULT NOW(),
+            PRIMARY KEY (name, day)
+        )
+        ''',
+    ]),
+    (12, "Аренда рассылки вместо advisory-блокировки", [
+        'ALTER TABLE broadcasts ADD COLUMN IF NOT EXISTS claim_token TEXT',
+        'ALTER TABLE broadcasts ADD COLUMN IF NOT EXISTS claimed_until TIMESTAMPTZ',
+    ]),
+]
+
+# Ключ advisory-блокировки: миграции применяет только один процесс (бот или веб)
+SCHEMA_LOCK_KEY = 741_000_001
+
+
+async def _get_schema_version(conn) -> int:
+    if not await conn.fetchval("SELECT to_regclass('schema_version') IS NOT NULL"):
+        return 0
+    return await conn.fetchval("SELECT COALESCE(MAX(version), 0) FROM schema_version")
+
+
+async def _create_index_concurrently(conn, name: str, sql: str):
+    # Прерванная сборка оставляет невалидный индекс, который IF NOT EXISTS пропустит
+    invalid = await conn.fetchval(
+        "SELECT NOT indisvalid FROM pg_index WHERE indexrelid = to_regclass($1)", name
+    )
+    if invalid:
+        await conn.execute(f"DROP INDEX CONCURRENTLY IF EXISTS {name}")
+    try:
+        await conn.execute(sql)
+    except asyncpg.UndefinedObjectError as e:
+        # Например, нет класса операторов из недоступного расширения
+        logger.warning(f"⚠️ Индекс {name} не создан: {e}")
+
+
+async def init_db(pool):
+    """
+    Применяет недостающие миграции. Если схема актуальна — только проверка версии.
+    """
+    latest = MIGRATIONS[-1][0]
+    async with pool.acquire() as conn:
+        current = await _get_schema_version(conn)
+        if current >= latest:
+            logger.info(f"✅ Схема БД актуальна (версия {current})")
+            return
+
+        await conn.execute("SELECT pg_advisory_lock($1)", SCHEMA_LOCK_KEY)
+        try:
+            await conn.execute('''
+                CREATE TABLE IF NOT EXISTS schema_version (
+                    version INT PRIMARY KEY,
+                    description TEXT NOT NULL,
+                    applied_at TIMESTAMPTZ DEFAULT NOW()
+                )
+            ''')
+            # Пока ждали блокировку, миграции мог применить другой процесс
+            current = await _get_schema_version(conn)
+            for version, description, statements, *rest in MIGRATIONS:
+                if version <= current:
+                    continue
+                indexes = rest[0] if rest else []
+                started = time.perf_counter()
+                async with conn.transaction():
+                    for sql in statements:
+                        await conn.execute(sql)
+                    if not indexes:
+                        await conn.execute(
+                            "INSERT INTO schema_version (version, description) VALUES ($1, $2)",
+                            version, description
+                        )
+                if indexes:
+                    # Версия записывается после индексов: при сбое миграция повторится целиком,
+                    # её операторы должны быть идемпотентны
+                    for name, sql in indexes:
+                        await _create_index_concurrently(conn, name, sql)
+                    await conn.execute(
+                        "INSERT INTO schema_version (version, description) VALUES ($1, $2)",
+                        version, description
+                    )
+                logger.info(f"✅ Миграция {version} применена: {description} ({time.perf_counter() - started:.2f} с)")
+        finally:
+            await conn.execute("SELECT pg_advisory_unlock($1)", SCHEMA_LOCK_KEY)
+
+    logger.info(f"✅ Схема БД обновлена до версии {latest}")
 
 
 # --- Работа с пользователями ---
@@ -209,10 +582,181 @@ async def add_or_update_user(pool, user):
     logger.info(f"👤 Пользователь {user.id} добавлен/обновлён")
 
 
-async def get_user_role(pool, user_id: int) -> str:
+# --- Кэш «уже видели»: не переписываем строку users на каждый апдейт ---
+# Храним отпечаток профиля и момент последней записи last_seen. Если ничего не
+# изменилось и last_seen свежий (LAST_SEEN_WINDOW) — запись пропускается,
+# остальные изменения копятся в _pending_users и пишутся одним UNNEST-upsert.
+SEEN_USERS_MAX = int(os.getenv("SEEN_USERS_MAX", 100000))
+LAST_SEEN_WINDOW = int(os.getenv("LAST_SEEN_WINDOW", 300))
+SEEN_USERS_FLUSH_INTERVAL = float(os.getenv("SEEN_USERS_FLUSH_INTERVAL", 30))
+
+_seen_users = OrderedDict()  # user_id -> (отпечаток, time.monotonic() последней записи)
+_pending_users = {}  # user_id -> (id, username, first_name, last_name, language_code, is_bot)
+_seen_metrics = {"skipped": 0, "queued": 0, "direct": 0, "flushed": 0}
+
+
+def _user_fingerprint(user) -> tuple:
+    return (user.username, user.first_name, user.last_name, user.language_code, user.is_bot)
+
+
+def _remember_seen(user_id: int, fingerprint: tuple, persisted_at: float):
+    _seen_users[user_id] = (fingerprint, persisted_at)
+    _seen_users.move_to_end(user_id)
+    while len(_seen_users) > SEEN_USERS_MAX:
+        _seen_users.popitem(last=False)
+
+
+async def touch_user(pool, user) -> bool:
+    """
+    Отмечает активность пользователя.
+    Незнакомых (в этом процессе) пишет сразу — на users ссылаются внешние ключи,
+    знакомых — только при изменении профиля или устаревшем last_seen, отложенно.
+    Возвращает True, если запись была выполнена или поставлена в очередь.
+    """
+    fingerprint = _user_fingerprint(user)
+    now = time.monotonic()
+    seen = _seen_users.get(user.id)
+
+    if seen is None:
+        await add_or_update_user(pool, user)
+        _remember_seen(user.id, fingerprint, now)
+        _seen_metrics["direct"] += 1
+        return True
+
+    if seen[0] == fingerprint and now - seen[1] < LAST_SEEN_WINDOW:
+        _seen_users.move_to_end(user.id)
+        _seen_metrics["skipped"] += 1
+        return False
+
+    _pending_users[user.id] = (user.id, *fingerprint)
+    _remember_seen(user.id, fingerprint, now)
+    _seen_metrics["queued"] += 1
+    return True
+
+
+async def flush_seen_users(pool) -> int:
+    """
+    Записывает накопленные изменения пользователей одним upsert через UNNEST.
+    """
+    if not _pending_users:
+        return 0
+    batch = list(_pending_users.values())
+    _pending_users.clear()
+    columns = list(zip(*batch))
+
+    try:
+        async with pool.acquire() as conn:
+            await conn.execute('''
+                INSERT INTO users (
+                    id, username, first_name, last_name, language_code, is_bot, last_seen, created_at, language
+                )
+                SELECT u.id, u.username, u.first_name, u.last_name, u.language_code, u.is_bot,
+                       NOW(), NOW(), u.language_code
+                FROM UNNEST($1::bigint[], $2::text[], $3::text[], $4::text[], $5::text[], $6::boolean[])
+                    AS u(id, username, first_name, last_name, language_code, is_bot)
+                ON CONFLICT (id)
+                DO UPDATE SET
+                    username = EXCLUDED.username,
+                    first_name = EXCLUDED.first_name,
+                    last_name = EXCLUDED.last_name,
+                    language_code = EXCLUDED.language_code,
+                    is_bot = EXCLUDED.is_bot,
+                    last_seen = NOW();
+            ''', *[list(col) for col in columns])
+    except Exception as e:
+        # Не затираем более свежие изменения, пришедшие во время записи
+        for row in batch:
+            _pending_users.setdefault(row[0], row)
+        logger.error(f"❌ Не удалось обновить пользователей ({len(batch)}): {e}")
+        return 0
+
+    _seen_metrics["flushed"] += len(batch)
+    logger.debug(f"👤 Обновлено пользователей пачкой: {len(batch)}")
+    return len(batch)
+
+
+def get_seen_users_stats() -> dict:
+    return {"tracked": len(_seen_users), "pending": len(_pending_users), **_seen_metrics}
+
+
+# --- Кэш профилей: role, language, theme, premium_expires, city ---
+# Эти поля читаются почти каждым обработчиком, а меняются редко. Кэш — LRU с TTL
+# и ограничением на число записей; все функции, меняющие поля, сбрасывают запись.
+PROFILE_CACHE_MAX = int(os.getenv("PROFILE_CACHE_MAX", 50000))
+PROFILE_CACHE_TTL = float(os.getenv("PROFILE_CACHE_TTL", 60))
+
+_profile_cache = OrderedDict()  # user_id -> (expires_at, profile)
+_profile_metrics = {"hits": 0, "misses": 0, "evictions": 0, "invalidations": 0}
+
+DEFAULT_PROFILE = {
+    "role": "user",
+    "language": "ru",
+    "theme": "light",
+    "premium_expires": None,
+    "city": None,
+}
+
+
+def _profile_from_row(row) -> dict:
+    return {
+        "role": row["role"] or "user",
+        "language": row["language"] or "ru",
+        "theme": row["theme"] or "light",
+        "premium_expires": row["premium_expires"],
+        "city": row["city"],
+    }
+
+
+def cache_user_profile(user_id: int, profile: dict):
+    _profile_cache[user_id] = (time.monotonic() + PROFILE_CACHE_TTL, profile)
+    _profile_cache.move_to_end(user_id)
+    while len(_profile_cache) > PROFILE_CACHE_MAX:
+        _profile_cache.popitem(last=False)
+        _profile_metrics["evictions"] += 1
+
+
+def invalidate_user_profile(user_id: int):
+    if _profile_cache.pop(user_id, None) is not None:
+        _profile_metrics["invalidations"] += 1
+
+
+Q_USER_PROFILE = register_query(
+    "user_profile",
+    'SELECT role, language, theme, premium_expires, city FROM users WHERE id = $1'
+)
+
+
+async def get_user_profile(pool, user_id: int) -> dict:
+    """
+    Возвращает профиль пользователя из кэша или одним запросом из БД.
+    Результат только для чтения. Для несуществующих пользователей — значения по умолчанию (не кэшируются).
+    """
+    cached = _profile_cache.get(user_id)
+    if cached and cached[0] > time.monotonic():
+        _profile_cache.move_to_end(user_id)
+        _profile_metrics["hits"] += 1
+        return cached[1]
+
+    _profile_metrics["misses"] += 1
     async with pool.acquire() as conn:
-        role = await conn.fetchval('SELECT role FROM users WHERE id = $1', user_id)
-        return role or 'user'
+        stmt = await prepared(conn, Q_USER_PROFILE)
+        row = await stmt.fetchrow(user_id)
+    if not row:
+        return dict(DEFAULT_PROFILE)
+    profile = _profile_from_row(row)
+    cache_user_profile(user_id, profile)
+    return profile
+
+
+def get_profile_cache_stats() -> dict:
+    total = _profile_metrics["hits"] + _profile_metrics["misses"]
+    hit_ratio = round(_profile_metrics["hits"] / total, 3) if total else 0.0
+    return {"size": len(_profile_cache), "hit_ratio": hit_ratio, **_profile_metrics}
+
+
+async def get_user_role(pool, user_id: int) -> str:
+    profile = await get_user_profile(pool, user_id)
+    return profile["role"]
 
 
 async def set_user_role(pool, user_id: int, role: str):
@@ -221,9 +765,21 @@ async def set_user_role(pool, user_id: int, role: str):
         raise ValueError(f"Роль должна быть одной из: {valid_roles}")
     async with pool.acquire() as conn:
         await conn.execute('UPDATE users SET role = $1 WHERE id = $2', role, user_id)
+    invalidate_user_profile(user_id)
     logger.info(f"🔐 Пользователю {user_id} установлена роль: {role}")
 
 
+async def get_role_changes(pool, since: datetime) -> list:
+    """
+    Пользователи, у которых роль менялась после `since` (для отзыва веб-сессий).
+    """
+    return await pool.fetch('''
+        SELECT id, role_updated_at FROM users
+        WHERE role_updated_at > $1
+        ORDER BY role_updated_at
+    ''', since)
+
+
 async def is_admin(pool, user_id: int) -> bool:
     role = await get_user_role(pool, user_id)
     return role == 'admin'
@@ -236,17 +792,12 @@ async def is_premium_or_admin(pool, user_id: int) -> bool:
 
 # --- Работа с настройками интерфейса ---
 async def get_user_settings(pool, user_id: int) -> dict:
-    async with pool.acquire() as conn:
-        row = await conn.fetchrow('''
-            SELECT theme, language, premium_expires FROM users WHERE id = $1
-        ''', user_id)
-        if row:
-            return {
-                "theme": row["theme"] or "light",
-                "language": row["language"] or "ru",
-                "premium_expires": row["premium_expires"]
-            }
-        return {"theme": "light", "language": "ru", "premium_expires": None}
+    profile = await get_user_profile(pool, user_id)
+    return {
+        "theme": profile["theme"],
+        "language": profile["language"],
+        "premium_expires": profile["premium_expires"]
+    }
 
 
 async def update_user_theme(pool, user_id: int, theme: str):
@@ -254,6 +805,7 @@ async def update_user_theme(pool, user_id: int, theme: str):
         raise ValueError("Тема должна быть 'light' или 'dark'")
     async with pool.acquire() as conn:
         await conn.execute('UPDATE users SET theme = $1 WHERE id = $2', theme, user_id)
+    invalidate_user_profile(user_id)
     logger.info(f"🎨 Пользователь {user_id} сменил тему: {theme}")
 
 
@@ -262,9 +814,112 @@ async def update_user_language(pool, user_id: int, lang: str):
         raise ValueError("Язык должен быть 'ru' или 'en'")
     async with pool.acquire() as conn:
         await conn.execute('UPDATE users SET language = $1 WHERE id = $2', lang, user_id)
+    invalidate_user_profile(user_id)
     logger.info(f"🌐 Пользователь {user_id} сменил язык: {lang}")
 
 
+# --- Город для погоды ---
+async def get_user_city(pool, user_id: int):
+    profile = await get_user_profile(pool, user_id)
+    return profile["city"]
+
+
+async def set_user_city(pool, user_id: int, city: str):
+    async with pool.acquire() as conn:
+        await conn.execute('UPDATE users SET city = $1 WHERE id = $2', city, user_id)
+    invalidate_user_profile(user_id)
+    logger.debug(f"🏙 Пользователь {user_id} сохранил город: {city}")
+
+
+async def set_weather_digest(pool, user_id: int, enabled: bool):
+    async with pool.acquire() as conn:
+        await conn.execute('UPDATE users SET weather_digest = $1 WHERE id = $2', enabled, user_id)
+
+
+async def claim_daily_run(pool, name: str, day) -> bool:
+    """
+    Отмечает ежедневную задачу как запущенную. False — за этот день её уже
+    запустил другой процесс (вторая реплика, перекрытие при деплое).
+    """
+    return await pool.fetchval('''
+        INSERT INTO daily_runs (name, day) VALUES ($1, $2)
+        ON CONFLICT (name, day) DO NOTHING
+        RETURNING TRUE
+    ''', name, day) is not None
+
+
+# --- Контекст пользователя: профиль, рефералы и финансы одним запросом ---
+Q_USER_CONTEXT = register_query("user_context", '''
+        SELECT
+            u.id, u.first_name, u.last_name, u.username, u.language_code,
+            u.role, u.language, u.theme, u.premium_expires, u.city,
+            r.referrals, f.income, f.expense
+        FROM users u
+        CROSS JOIN LATERAL (
+            SELECT COUNT(*) AS referrals FROM referrals WHERE referrer_id = u.id
+        ) r
+        CROSS JOIN LATERAL (
+            SELECT
+                COALESCE(SUM(amount) FILTER (WHERE type = 'income'), 0) AS income,
+                COALESCE(SUM(amount) FILTER (WHERE type = 'expense'), 0) AS expense
+            FROM finance_operations
+            WHERE user_id = u.id
+        ) f
+        WHERE u.id = $1
+    ''')
+
+
+async def load_user_context(pool, user_id: int):
+    """
+    Загружает всё, что нужно меню и кабинету, одним SQL-запросом.
+    Заодно прогревает кэш профилей. Возвращает None, если пользователя нет.
+    """
+    async with pool.acquire() as conn:
+        stmt = await prepared(conn, Q_USER_CONTEXT)
+        row = await stmt.fetchrow(user_id)
+    if not row:
+        return None
+
+    profile = _profile_from_row(row)
+    cache_user_profile(user_id, profile)
+
+    income = row["income"] or 0
+    expense = row["expense"] or 0
+    return {
+        "id": row["id"],
+        "first_name": row["first_name"],
+        "last_name": row["last_name"],
+        "username": row["username"],
+        "language_code": row["language_code"],
+        **profile,
+        "referrals": row["referrals"] or 0,
+        "stats": {
+            "income": round(float(income), 2),
+            "expense": round(float(expense), 2),
+            "balance": round(float(income - expense), 2)
+        }
+    }
+
+
+class UserContext:
+    """
+    Ленивый контекст пользователя: запрос к БД выполняется при первом load(),
+    повторные обращения в рамках одного апдейта/запроса берут готовый результат.
+    """
+
+    def __init__(self, pool, user_id: int):
+        self.pool = pool
+        self.user_id = user_id
+        self._data = None
+        self._loaded = False
+
+    async def load(self):
+        if not self._loaded:
+            self._data = await load_user_context(self.pool, self.user_id)
+            self._loaded = True
+        return self._data
+
+
 # --- Рефералы ---
 async def register_referral(pool, referrer_id: int, referred_id: int):
     async with pool.acquire() as conn:
@@ -288,12 +943,393 @@ async def get_referral_stats(pool, user_id: int) -> int:
 
 
 # --- Статистика ---
+# Буфер команд: (user_id, command, timestamp). Сбрасывается пачкой через COPY
+# по достижении USAGE_FLUSH_SIZE или по таймеру (flush_command_usage из job_queue).
+USAGE_FLUSH_SIZE = int(os.getenv("USAGE_FLUSH_SIZE", 500))
+USAGE_FLUSH_INTERVAL = float(os.getenv("USAGE_FLUSH_INTERVAL", 5))
+USAGE_BUFFER_LIMIT = int(os.getenv("USAGE_BUFFER_LIMIT", 50000))
+
+_usage_buffer = []
+_usage_sink_enabled = False
+_usage_flush_lock = asyncio.Lock()
+_usage_flush_task = None
+_usage_metrics = {
+    "flushed": 0,
+    "dropped": 0,
+    "flushes": 0,
+    "last_flush_ms": 0.0,
+    "max_flush_ms": 0.0,
+    "last_flush_at": None,
+}
+
+
+def enable_usage_sink():
+    """
+    Включает буферизацию: log_command_usage перестаёт писать в БД напрямую.
+    Вызывается ботом при старте, веб-процесс пишет как раньше.
+    """
+    global _usage_sink_enabled
+    _usage_sink_enabled = True
+    logger.info(f"📊 Буфер статистики включён (size={USAGE_FLUSH_SIZE}, interval={USAGE_FLUSH_INTERVAL}s)")
+
+
 async def log_command_usage(pool, user_id: int, command: str):
+    if not _usage_sink_enabled:
+        async with pool.acquire() as conn:
+            await conn.execute('''
+                INSERT INTO usage_stats (user_id, command) VALUES ($1, $2)
+            ''', user_id, command)
+        logger.debug(f"📊 Команда: {command} от {user_id}")
+        return
+
+    global _usage_flush_task
+    if len(_usage_buffer) >= USAGE_BUFFER_LIMIT:
+        # БД недоступна слишком долго — не растим память бесконечно
+        _usage_metrics["dropped"] += 1
+        return
+    _usage_buffer.append((user_id, command, datetime.now(timezone.utc)))
+
+    if len(_usage_buffer) >= USAGE_FLUSH_SIZE and (_usage_flush_task is None or _usage_flush_task.done()):
+        _usage_flush_task = asyncio.create_task(flush_command_usage(pool))
+
+
+async def flush_command_usage(pool) -> int:
+    """
+    Записывает накопленную статистику одной операцией COPY.
+    При ошибке записи возвращает пачку в начало буфера.
+    """
+    async with _usage_flush_lock:
+        if not _usage_buffer:
+            return 0
+        # Сначала отложенные upsert-ы users: на них ссылается внешний ключ usage_stats
+        await flush_seen_users(pool)
+        batch = _usage_buffer[:]
+        del _usage_buffer[:len(batch)]
+
+        started = time.perf_counter()
+        try:
+            async with pool.acquire() as conn:
+                await conn.copy_records_to_table(
+                    'usage_stats',
+                    records=batch,
+                    columns=['user_id', 'command', 'timestamp'],
+                )
+        except Exception as e:
+            _usage_buffer[:0] = batch
+            logger.error(f"❌ Не удалось записать статистику ({len(batch)} записей): {e}")
+            return 0
+
+        elapsed_ms = (time.perf_counter() - started) * 1000
+        _usage_metrics["flushed"] += len(batch)
+        _usage_metrics["flushes"] += 1
+        _usage_metrics["last_flush_ms"] = round(elapsed_ms, 2)
+        _usage_metrics["max_flush_ms"] = round(max(_usage_metrics["max_flush_ms"], elapsed_ms), 2)
+        _usage_metrics["last_flush_at"] = datetime.now(timezone.utc)
+        logger.debug(f"📊 Записано {len(batch)} команд за {elapsed_ms:.1f} мс (в очереди: {len(_usage_buffer)})")
+        return len(batch)
+
+
+def get_usage_sink_stats() -> dict:
+    """
+    Глубина очереди и задержка последних сбросов статистики.
+    """
+    return {"queue_depth": len(_usage_buffer), **_usage_metrics}
+
+
+# --- Дневные агрегаты статистики (usage_daily) ---
+# Фоновая задача сворачивает завершённые дни usage_stats в usage_daily и двигает
+# водяной знак. Графики читают агрегаты, а «живьём» считают только дни после него.
+USAGE_ROLLUP_GRACE = int(os.getenv("USAGE_ROLLUP_GRACE", 900))
+USAGE_ROLLUP_CHUNK_DAYS = 31
+USAGE_ROLLUP_LOCK_KEY = 741_000_002
+
+
+async def rollup_usage_daily(pool) -> int:
+    """
+    Досчитывает usage_daily до вчерашнего дня (с запасом USAGE_ROLLUP_GRACE секунд
+    на запоздавшие записи буфера). Возвращает число свёрнутых дней.
+    """
+    rolled = 0
     async with pool.acquire() as conn:
-        await conn.execute('''
-            INSERT INTO usage_stats (user_id, command) VALUES ($1, $2)
-        ''', user_id, command)
-    logger.debug(f"📊 Команда: {command} от {user_id}")
+        while True:
+            async with conn.transaction():
+                # Несколько реплик бота: считает тот, кто взял блокировку
+                if not await conn.fetchval("SELECT pg_try_advisory_xact_lock($1)", USAGE_ROLLUP_LOCK_KEY):
+                    return rolled
+
+                watermark = await conn.fetchval("SELECT watermark FROM rollup_state WHERE name = 'usage_daily'")
+                if watermark is None:
+                    watermark = await conn.fetchval("SELECT MIN(timestamp)::date - 1 FROM usage_stats")
+                    if watermark is None:
+                        return rolled
+
+                target = await conn.fetchval(
+                    "SELECT (NOW() - $1 * INTERVAL '1 second')::date - 1", USAGE_ROLLUP_GRACE
+                )
+                if target <= watermark:
+                    return rolled
+                chunk_end = min(target, watermark + timedelta(days=USAGE_ROLLUP_CHUNK_DAYS))
+
+                await conn.execute('''
+                    INSERT INTO usage_daily (day, command, count)
+                    SELECT timestamp::date, command, COUNT(*)
+                    FROM usage_stats
+                    WHERE timestamp >= $1::date AND timestamp < $2::date
+                    GROUP BY 1, 2
+                    ON CONFLICT (day, command) DO UPDATE SET count = EXCLUDED.count
+                ''', watermark + timedelta(days=1), chunk_end + timedelta(days=1))
+                await conn.execute('''
+                    INSERT INTO rollup_state (name, watermark) VALUES ('usage_daily', $1)
+                    ON CONFLICT (name) DO UPDATE SET watermark = EXCLUDED.watermark, updated_at = NOW()
+                ''', chunk_end)
+
+            rolled += (chunk_end - watermark).days
+            logger.info(f"📈 usage_daily: свёрнуто по {chunk_end.isoformat()} включительно")
+
+
+async def get_activity_by_day(pool, days: int = 30) -> list:
+    """
+    Количество команд по дням за последние `days` дней: агрегаты + живой хвост.
+    """
+    return await pool.fetch('''
+        WITH wm AS (
+            SELECT COALESCE(
+                (SELECT watermark FROM rollup_state WHERE name = 'usage_daily'),
+                CURRENT_DATE - $1::int
+            ) AS day
+        )
+        SELECT day, SUM(count)::BIGINT AS count
+        FROM (
+            SELECT d.day, d.count
+            FROM usage_daily d, wm
+            WHERE d.day > CURRENT_DATE - $1::int AND d.day <= wm.day
+            UNION ALL
+            SELECT s.timestamp::date AS day, COUNT(*) AS count
+            FROM usage_stats s, wm
+            WHERE s.timestamp >= GREATEST(wm.day + 1, CURRENT_DATE - $1::int + 1)
+            GROUP BY 1
+        ) t
+        GROUP BY day
+        ORDER BY day
+    ''', days)
+
+
+async def get_top_commands(pool, limit: int = 10) -> list:
+    """
+    Самые популярные команды за всё время: агрегаты + живой хвост.
+    """
+    return await pool.fetch('''
+        WITH wm AS (
+            SELECT (SELECT watermark FROM rollup_state WHERE name = 'usage_daily') AS day
+        )
+        SELECT command, SUM(count)::BIGINT AS count
+        FROM (
+            SELECT command, count FROM usage_daily
+            UNION ALL
+            SELECT s.command, COUNT(*) AS count
+            FROM usage_stats s, wm
+            WHERE wm.day IS NULL OR s.timestamp >= wm.day + 1
+            GROUP BY s.command
+        ) t
+        GROUP BY command
+        ORDER BY count DESC
+        LIMIT $1
+    ''', limit)
+
+
+# --- История курсов валют (currency_rates, рублей за единицу) ---
+async def save_currency_rates(pool, day, values: dict):
+    codes = list(values)
+    await pool.execute('''
+        INSERT INTO currency_rates (code, date, value)
+        SELECT r.code, $1, r.value
+        FROM UNNEST($2::text[], $3::float8[]) AS r(code, value)
+        ON CONFLICT (code, date) DO UPDATE SET value = EXCLUDED.value
+    ''', day, codes, [values[code] for code in codes])
+
+
+async def copy_currency_rates(pool, records: list) -> int:
+    """
+    Массовая загрузка (code, date, value) через COPY во временную таблицу
+    и один INSERT ... ON CONFLICT — повторная загрузка архива безопасна.
+    """
+    async with pool.acquire() as conn:
+        async with conn.transaction():
+            await conn.execute('''
+                CREATE TEMP TABLE currency_rates_import (LIKE currency_rates) ON COMMIT DROP
+            ''')
+            await conn.copy_records_to_table(
+                'currency_rates_import', records=records, columns=['code', 'date', 'value']
+            )
+            result = await conn.execute('''
+                INSERT INTO currency_rates (code, date, value)
+                SELECT DISTINCT ON (code, date) code, date, value FROM currency_rates_import
+                ON CONFLICT (code, date) DO UPDATE SET value = EXCLUDED.value
+            ''')
+    return int(result.split()[-1])
+
+
+async def get_currency_series(pool, code: str, period: str = 'week', days: int = 365) -> list:
+    """
+    Минимум, максимум и среднее курса по неделям или месяцам за последние `days` дней.
+    """
+    if period not in ('week', 'month'):
+        raise ValueError("period: week или month")
+    return await pool.fetch('''
+        SELECT date_trunc($2, date)::date AS period,
+               MIN(value) AS min, MAX(value) AS max, AVG(value) AS avg,
+               (ARRAY_AGG(value ORDER BY date DESC))[1] AS last
+        FROM currency_rates
+        WHERE code = $1 AND date > CURRENT_DATE - $3::int
+        GROUP BY 1
+        ORDER BY 1
+    ''', code, period, days)
+
+
+async def get_currency_history(pool, code: str, days: int = 30) -> list:
+    return await pool.fetch('''
+        SELECT date, value FROM currency_rates
+        WHERE code = $1 AND date > CURRENT_DATE - $2::int
+        ORDER BY date
+    ''', code, days)
+
+
+# --- Квота GigaChat ---
+async def load_gigachat_quota(pool):
+    """
+    → (настройки квоты или None, {user_id: запросов})
+    """
+    settings = await pool.fetchrow("SELECT total_limit, last_reset FROM gigachat_quota")
+    rows = await pool.fetch("SELECT user_id, requests FROM gigachat_usage")
+    return settings, {row["user_id"]: row["requests"] for row in rows}
+
+
+async def save_gigachat_quota(pool, total_limit: int, last_reset):
+    await pool.execute('''
+        INSERT INTO gigachat_quota (id, total_limit, last_reset) VALUES (TRUE, $1, $2)
+        ON CONFLICT (id) DO UPDATE SET total_limit = EXCLUDED.total_limit, last_reset = EXCLUDED.last_reset
+    ''', total_limit, last_reset)
+
+
+async def save_gigachat_usage(pool, counts: dict):
+    """
+    Записывает счётчики пользователей (абсолютные значения) одним upsert через UNNEST.
+    """
+    user_ids = list(counts)
+    await pool.execute('''
+        INSERT INTO gigachat_usage (user_id, requests, updated_at)
+        SELECT u.user_id, u.requests, NOW()
+        FROM UNNEST($1::bigint[], $2::int[]) AS u(user_id, requests)
+        ON CONFLICT (user_id) DO UPDATE SET requests = EXCLUDED.requests, updated_at = NOW()
+    ''', user_ids, [counts[user_id] for user_id in user_ids])
+
+
+async def reset_gigachat_usage(pool, last_reset):
+    async with pool.acquire() as conn:
+        async with conn.transaction():
+            await conn.execute("UPDATE gigachat_usage SET requests = 0, updated_at = NOW() WHERE requests <> 0")
+            await conn.execute("UPDATE gigachat_quota SET last_reset = $1", last_reset)
+
+
+# --- Список пользователей для админки ---
+# Постраничный вывод по ключу (last_seen, id): следующая страница начинается
+# сразу после последней строки предыдущей, без OFFSET, поэтому стоимость
+# страницы не зависит от её номера (индексы из миграции 9).
+ADMIN_USERS_COLUMNS = '''
+    id, first_name, username, role, language_code AS language,
+    premium_expires, last_seen
+'''
+
+
+async def list_users(
+    pool,
+    limit: int = 100,
+    after: tuple = None,
+    role: str = None,
+    language: str = None,
+    premium: bool = None,
+    search: str = None,
+) -> list:
+    """
+    :param after: (last_seen, id) последней строки предыдущей страницы
+    :param search: подстрока username без учёта регистра
+    """
+    conditions, args = [], []
+
+    def arg(value) -> str:
+        args.append(value)
+        return f"${len(args)}"
+
+    if after:
+        conditions.append(f"(last_seen, id) < ({arg(after[0])}, {arg(after[1])})")
+    if role:
+        conditions.append(f"role = {arg(role)}")
+    if language:
+        conditions.append(f"language_code = {arg(language)}")
+    if premium is True:
+        conditions.append("premium_expires > NOW()")
+    elif premium is False:
+        conditions.append("(premium_expires IS NULL OR premium_expires <= NOW())")
+    if search:
+        escaped = search.replace("\\", "\\\\").replace("%", "\\%").replace("_", "\\_")
+        conditions.append(f"username ILIKE {arg('%' + escaped + '%')}")
+
+    where = f"WHERE {' AND '.join(conditions)}" if conditions else ""
+    return await pool.fetch(f'''
+        SELECT {ADMIN_USERS_COLUMNS}
+        FROM users
+        {where}
+        ORDER BY last_seen DESC, id DESC
+        LIMIT {arg(limit)}
+    ''', *args)
+
+
+# --- Снимок статистики для админки (веб и бот) ---
+# Счётчики считаются параллельно (каждый запрос на своём соединении) не чаще
+# раза в ADMIN_STATS_TTL секунд; одновременные запросы ждут один пересчёт.
+# ETag меняется только при изменении цифр, Last-Modified — время этого изменения.
+ADMIN_STATS_TTL = int(os.getenv("ADMIN_STATS_TTL", 60))
+
+_admin_stats = {"stats": None, "etag": None, "last_modified": None, "computed_at": 0.0}
+_admin_stats_lock = asyncio.Lock()
+
+
+async def compute_admin_stats(pool) -> dict:
+    total, premium, active_24h, active_today, referrals = await asyncio.gather(
+        pool.fetchval("SELECT COUNT(*) FROM users"),
+        pool.fetchval("SELECT COUNT(*) FROM users WHERE role = 'premium'"),
+        pool.fetchval("SELECT COUNT(*) FROM users WHERE last_seen > NOW() - INTERVAL '24 hours'"),
+        pool.fetchval("SELECT COUNT(*) FROM usage_stats WHERE timestamp >= CURRENT_DATE"),
+        pool.fetchval("SELECT COUNT(*) FROM referrals"),
+    )
+    return {
+        "total_users": total or 0,
+        "premium_users": premium or 0,
+        "active_24h": active_24h or 0,
+        "active_today": active_today or 0,
+        "referrals_count": referrals or 0,
+    }
+
+
+async def refresh_admin_stats(pool) -> dict:
+    async with _admin_stats_lock:
+        if time.monotonic() - _admin_stats["computed_at"] < 1:
+            return _admin_stats  # пересчитали, пока ждали блокировку
+        stats = await compute_admin_stats(pool)
+        etag = hashlib.sha1(repr(sorted(stats.items())).encode()).hexdigest()[:16]
+        if etag != _admin_stats["etag"]:
+            _admin_stats.update(stats=stats, etag=etag, last_modified=datetime.now(timezone.utc))
+        _admin_stats["computed_at"] = time.monotonic()
+        return _admin_stats
+
+
+async def get_admin_stats_snapshot(pool) -> dict:
+    """
+    {"stats", "etag", "last_modified"} — из памяти, если снимок свежее ADMIN_STATS_TTL.
+    """
+    if _admin_stats["stats"] is None or time.monotonic() - _admin_stats["computed_at"] > ADMIN_STATS_TTL:
+        await refresh_admin_stats(pool)
+    return _admin_stats
 
 
 # --- Финансовые операции ---
@@ -377,44 +1413,15 @@ async def cleanup_support_tickets(pool, days=7):
         return count or 0
 
 
-async def ensure_support_table_exists():
-    """
-    Гарантирует, что таблица support_tickets существует.
-    Вызывается при старте бота.
-    """
-    pool = await get_db_pool()
-    async with pool.acquire() as conn:
-        try:
-            await conn.execute('''
-                CREATE TABLE IF NOT EXISTS support_tickets (
-                    id SERIAL PRIMARY KEY,
-                    user_id BIGINT NOT NULL REFERENCES users(id) ON DELETE CASCADE,
-                    username TEXT,
-                    first_name TEXT,
-                    message TEXT NOT NULL,
-                    status TEXT NOT NULL DEFAULT 'open',
-                    created_at TIMESTAMPTZ DEFAULT NOW(),
-                    updated_at TIMESTAMPTZ DEFAULT NOW(),
-                    ticket_id TEXT UNIQUE
-                )
-            ''')
-            await conn.execute('CREATE INDEX IF NOT EXISTS idx_support_user ON support_tickets(user_id);')
-            await conn.execute('CREATE INDEX IF NOT EXISTS idx_support_status ON support_tickets(status);')
-            await conn.execute('CREATE INDEX IF NOT EXISTS idx_support_ticket_id ON support_tickets(ticket_id);')
-            logger.info("✅ Таблица support_tickets проверена и готова")
-        except Exception as e:
-            logger.error(f"❌ Ошибка при создании таблицы support_tickets: {e}")
-
-
 # --- Получение языка пользователя ---
 async def get_user_lang(pool, user_id: int) -> str:
     """
     Возвращает язык интерфейса пользователя ('ru' или 'en').
     Если не установлен — возвращает 'ru'.
     """
-    async with pool.acquire() as conn:
-        lang = await conn.fetchval("SELECT language FROM users WHERE id = $1", user_id)
-        return lang if lang in ["ru", "en"] else "ru"
+    profile = await get_user_profile(pool, user_id)
+    lang = profile["language"]
+    return lang if lang in ["ru", "en"] else "ru"
 
 
 # === Глобальный пул подключений ===
@@ -0,0 +1,68 @@
+# tests/test_alerts.py
+import asyncio
+
+from bot.features.alerts import AlertIndex
+from bot.rates import RateTable
+
+
+def table(**rub_per_unit) -> RateTable:
+    # latest.js хранит «единиц валюты за рубль»
+    return RateTable({"date": "2024-01-09", "rates": {code: 1 / value for code, value in rub_per_unit.items()}})
+
+
+class FakePool:
+    def __init__(self, rows):
+        self.rows = rows
+
+    async def fetch(self, query, *args):
+        return self.rows
+
+
+def test_evaluate_above_and_below():
+    index = AlertIndex()
+    index.add(1, "USD", ">", 100, 90)
+    index.add(2, "USD", ">", 110, 90)
+    index.add(3, "USD", "<", 80, 90)
+    index.add(4, "EUR", "<", 95, 99)
+    assert len(index) == 4
+
+    assert index.evaluate(table(USD=105, EUR=99)) == {1}
+    assert index.evaluate(table(USD=105, EUR=99)) == set()  # снято с индекса
+    assert index.evaluate(table(USD=79, EUR=94)) == {3, 4}
+    assert len(index) == 1
+    assert index.evaluate(table(USD=110, EUR=94)) == set()  # «выше» — строго
+    assert index.evaluate(table(USD=111, EUR=94)) == {2}
+    assert len(index) == 0
+
+
+def test_percent_rule_removes_both_bounds():
+    index = AlertIndex()
+    index.add(7, "CNY", "%", 10, 12.0)  # границы 13.2 и 10.8
+    assert index.evaluate(table(CNY=13.0)) == set()
+    assert index.evaluate(table(CNY=10.5)) == {7}
+    # Вторая граница тоже снята: обратное движение не даёт повторного срабатывания
+    assert index.evaluate(table(CNY=14.0)) == set()
+    assert len(index) == 0
+
+
+def test_remove_and_missing_codes():
+    index = AlertIndex()
+    index.add(1, "USD", ">", 100, 90)
+    index.add(2, "GBP", "<", 100, 120)
+    index.remove(1, "USD")
+    index.remove(1, "USD")  # повторное удаление — без ошибок
+    assert len(index) == 1
+    assert index.evaluate(table(USD=200)) == set()  # GBP нет в таблице
+    assert index.evaluate(table(GBP=99)) == {2}
+
+
+def test_load_replaces_index():
+    index = AlertIndex()
+    index.add(99, "USD", ">", 1, 0.5)
+    rows = [
+        {"id": 1, "code": "USD", "op": ">", "threshold": 100.0, "base": 90.0},
+        {"id": 2, "code": "EUR", "op": "%", "threshold": 5.0, "base": 100.0},
+    ]
+    asyncio.run(index.load(FakePool(rows)))
+    assert len(index) == 2
+    assert index.evaluate(table(USD=101, EUR=106)) == {1, 2}
@@ -0,0 +1,36 @@
+# tests/test_parsing.py
+from bot.features.alerts import parse_alert
+from bot.features.currency import parse_conversion
+
+
+def test_parse_conversion():
+    assert parse_conversion(["100", "usd", "eur"]) == (100.0, "USD", "EUR")
+    assert parse_conversion(["1,5", "usd", "в", "eur"]) == (1.5, "USD", "EUR")
+    assert parse_conversion(["usd"]) == (1.0, "USD", "RUB")
+    assert parse_conversion(["10", "cny", "->", "jpy"]) == (10.0, "CNY", "JPY")
+
+
+def test_parse_conversion_rejects_non_codes():
+    assert parse_conversion([]) is None
+    assert parse_conversion(["100"]) is None
+    assert parse_conversion(["1", "usd", "eur", "gbp"]) is None
+    # Сырые токены уходят в reply_html — допускаются только три латинские буквы
+    assert parse_conversion(["a<b"]) is None
+    assert parse_conversion(["1", "<x>"]) is None
+    assert parse_conversion(["1", "usd", "&amp"]) is None
+    assert parse_conversion(["dollars"]) is None
+
+
+def test_parse_alert():
+    assert parse_alert(["USD", ">", "100"]) == ("USD", ">", 100.0)
+    assert parse_alert(["usd>100"]) == ("USD", ">", 100.0)
+    assert parse_alert(["EUR", "<", "90,5"]) == ("EUR", "<", 90.5)
+    assert parse_alert(["CNY", "2%"]) == ("CNY", "%", 2.0)
+
+
+def test_parse_alert_rejects():
+    assert parse_alert([]) is None
+    assert parse_alert(["USD"]) is None
+    assert parse_alert(["USD", "0%"]) is None
+    assert parse_alert(["US", ">", "1"]) is None
+    assert parse_alert(["<b>", ">", "1"]) is None
@@ -0,0 +1,83 @@
+# tests/test_quota.py
+import asyncio
+
+import pytest
+
+from web import quota as quota_module
+from web.quota import QuotaService
+
+
+class FakeDb:
+    def __init__(self):
+        self.saved = {}
+        self.fail = False
+
+    async def get_db_pool(self):
+        return None
+
+    async def save_gigachat_usage(self, pool, counts):
+        if self.fail:
+            raise RuntimeError("db down")
+        self.saved.update(counts)
+
+    async def reset_gigachat_usage(self, pool, last_reset):
+        if self.fail:
+            raise RuntimeError("db down")
+        self.saved = dict.fromkeys(self.saved, 0)
+
+
+@pytest.fixture
+def db(monkeypatch):
+    fake = FakeDb()
+    for name in ("get_db_pool", "save_gigachat_usage", "reset_gigachat_usage"):
+        monkeypatch.setattr(quota_module, name, getattr(fake, name))
+    return fake
+
+
+def service() -> QuotaService:
+    quota = QuotaService()
+    quota.limit = 5
+    quota._loaded = True
+    return quota
+
+
+def test_consume_respects_limit():
+    quota = service()
+    assert quota.consume(1, 3)
+    assert not quota.consume(2, 3)  # запрос не учтён целиком
+    assert quota.consume(2, 2)
+    assert quota.is_over() and quota.remaining() == 0
+    assert quota.top_users(1) == [(1, 3)]
+
+
+def test_flush_keeps_changes_on_failure(db):
+    async def scenario():
+        quota = service()
+        quota.consume(1)
+        db.fail = True
+        with pytest.raises(RuntimeError):
+            await quota.flush()
+        db.fail = False
+        quota.consume(1)
+        assert await quota.flush() == 1
+        assert await quota.flush() == 0
+
+    asyncio.run(scenario())
+    assert db.saved == {1: 2}
+
+
+def test_reset_restores_counts_on_failure(db):
+    async def scenario():
+        quota = service()
+        quota.consume(1, 2)
+        db.fail = True
+        with pytest.raises(RuntimeError):
+            await quota.reset()
+        assert quota.counts() == {1: 2} and quota.total == 2
+
+        db.fail = False
+        await quota.reset()
+        assert quota.counts() == {1: 0} and quota.total == 0
+        assert quota.consume(1, 5)
+
+    asyncio.run(scenario())
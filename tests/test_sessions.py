@@ -0,0 +1,64 @@
+# tests/test_sessions.py
+import time
+from datetime import datetime, timedelta, timezone
+
+import pytest
+
+from web import utils
+from web.utils import apply_role_changes, issue_session_token, revoke_user_sessions, verify_session_token
+
+
+@pytest.fixture(autouse=True)
+def clean_revocations():
+    utils._revoked_before.clear()
+    yield
+    utils._revoked_before.clear()
+
+
+def test_token_roundtrip_and_tampering():
+    token = issue_session_token(42, "admin")
+    assert verify_session_token(token) == {"user_id": 42, "role": "admin"}
+
+    body, signature = token.split(".")
+    assert verify_session_token(f"{body}.{signature[:-2]}xx") is None
+    assert verify_session_token(f"{body}x.{signature}") is None
+    assert verify_session_token("garbage") is None
+
+
+def test_expired_token():
+    assert verify_session_token(issue_session_token(42, "admin", ttl=-1)) is None
+
+
+def test_revoke_invalidates_only_older_tokens():
+    old = issue_session_token(42, "admin")
+    other = issue_session_token(7, "admin")
+    time.sleep(0.002)
+    revoke_user_sessions(42)
+    time.sleep(0.002)
+    new = issue_session_token(42, "user")
+
+    assert verify_session_token(old) is None
+    assert verify_session_token(new) == {"user_id": 42, "role": "user"}
+    assert verify_session_token(other) is not None
+
+
+def test_apply_role_changes_revokes_and_keeps_latest(monkeypatch):
+    invalidated = []
+    monkeypatch.setattr(utils, "invalidate_user_profile", invalidated.append)
+
+    token = issue_session_token(42, "admin")
+    time.sleep(0.002)
+    changed = datetime.now(timezone.utc)
+    earlier = changed - timedelta(seconds=30)
+    since = changed - timedelta(hours=1)
+
+    since = apply_role_changes([{"id": 42, "role_updated_at": changed}], since)
+    assert since == changed
+    assert verify_session_token(token) is None
+    assert invalidated == [42]
+
+    # Строка из окна перекрытия (более ранняя) не сдвигает ни курсор, ни отзыв назад
+    since = apply_role_changes([{"id": 42, "role_updated_at": earlier}], since)
+    assert since == changed
+    assert utils._revoked_before[42] == changed.timestamp()
+    assert verify_session_token(token) is None
@@ -0,0 +1,115 @@
+# tests/test_store.py
+import asyncio
+import threading
+
+import yaml
+
+from web.store import UsersStore
+
+USERS = [
+    {"id": 123, "username": "Leo"},
+    {"id": 2, "username": "bobby"},
+]
+
+
+def make_store(tmp_path, users=USERS) -> UsersStore:
+    path = tmp_path / "users.yml"
+    path.write_text(yaml.dump(users, allow_unicode=True), encoding="utf-8")
+    return UsersStore(str(path), flush_delay=0.01)
+
+
+def test_find_exact_and_substring(tmp_path):
+    async def scenario():
+        store = make_store(tmp_path)
+        await store.load()
+        assert store.find("123")["username"] == "Leo"
+        assert store.find("@leo")["id"] == 123
+        # Как в исходном get_user: подстрока id или username
+        assert store.find("12")["id"] == 123
+        assert store.find("BOB")["id"] == 2
+        assert store.find("@bob")["id"] == 2
+        assert store.find("nobody") is None
+
+    asyncio.run(scenario())
+
+
+def test_update_is_written_atomically(tmp_path):
+    async def scenario():
+        store = make_store(tmp_path)
+        await store.load()
+        assert store.update(2, {"blocked": True}, remove=("username",))
+        assert store.update(999, {"blocked": True}) is None
+        assert store.find("bobby") is None
+        await store.close()
+
+    asyncio.run(scenario())
+    saved = yaml.safe_load((tmp_path / "users.yml").read_text(encoding="utf-8"))
+    assert saved[1] == {"id": 2, "blocked": True}
+    assert not (tmp_path / "users.yml.tmp").exists()
+
+
+class SlowWriteStore(UsersStore):
+    # Запись на диск ждёт сигнала — имитирует медленный поток во время reload()
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.write_started = threading.Event()
+        self.release_write = threading.Event()
+
+    def _write(self, users):
+        self.write_started.set()
+        self.release_write.wait(5)
+        super()._write(users)
+
+
+def test_update_during_reload_flush_is_kept(tmp_path):
+    path = tmp_path / "users.yml"
+    path.write_text(yaml.dump(USERS), encoding="utf-8")
+
+    async def scenario():
+        store = SlowWriteStore(str(path), flush_delay=0.2)
+        await store.load()
+        store.update(123, {"premium": True})  # есть несохранённое — reload начнёт с записи
+
+        reload_task = asyncio.create_task(store.reload())
+        await asyncio.to_thread(store.write_started.wait, 5)
+        store.update(2, {"blocked": True})  # приходит, пока поток пишет файл
+        store.release_write.set()
+        await reload_task
+
+        assert store.get(123)["premium"] is True
+        assert store.get(2)["blocked"] is True
+        await store.close()
+
+    asyncio.run(scenario())
+    saved = {u["id"]: u for u in yaml.safe_load(path.read_text(encoding="utf-8"))}
+    assert saved[123]["premium"] is True
+    assert saved[2]["blocked"] is True
+
+
+def test_update_during_reload_read_is_kept(tmp_path):
+    path = tmp_path / "users.yml"
+    path.write_text(yaml.dump(USERS), encoding="utf-8")
+    read_started, release_read = threading.Event(), threading.Event()
+
+    class SlowReadStore(UsersStore):
+        def _read(self):
+            users = super()._read()
+            if self._loaded:
+                read_started.set()
+                release_read.wait(5)
+            return users
+
+    async def scenario():
+        store = SlowReadStore(str(path), flush_delay=0.01)
+        await store.load()
+        reload_task = asyncio.create_task(store.reload())
+        await asyncio.to_thread(read_started.wait, 5)
+        store.update(2, {"blocked": True})
+        release_read.set()
+        await reload_task
+        assert store.get(2)["blocked"] is True
+        await store.close()
+
+    asyncio.run(scenario())
+    saved = {u["id"]: u for u in yaml.safe_load(path.read_text(encoding="utf-8"))}
+    assert saved[2]["blocked"] is True
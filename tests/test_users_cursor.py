@@ -0,0 +1,21 @@
+# tests/test_users_cursor.py
+from datetime import datetime, timezone
+
+import pytest
+from fastapi import HTTPException
+
+from web.api import decode_users_cursor, encode_users_cursor
+
+
+def test_cursor_roundtrip():
+    last_seen = datetime(2024, 1, 9, 12, 30, 15, 123456, tzinfo=timezone.utc)
+    cursor = encode_users_cursor({"last_seen": last_seen, "id": 1234567890})
+    assert "=" not in cursor
+    assert decode_users_cursor(cursor) == (last_seen, 1234567890)
+
+
+@pytest.mark.parametrize("cursor", ["", "not-base64!", "bm9waXBl", "MjAyNC0wMS0wOXx4"])
+def test_invalid_cursor(cursor):
+    with pytest.raises(HTTPException) as exc:
+        decode_users_cursor(cursor)
+    assert exc.value.status_code == 400
@@ -1,19 +1,34 @@
 # web/api.py
 
+import asyncio
+import base64
 import sys
 import os
-from typing import Dict, Any
+from datetime import datetime
+from typing import Dict, Any, Optional
 
 # Добавляем путь к папке bot
 sys.path.append(os.path.join(os.path.dirname(__file__), ".."))  # Добавляем корень: /app
 
-from fastapi import APIRouter, HTTPException, Body, Query, Depends
+from email.utils import format_datetime, parsedate_to_datetime
+
+from fastapi import APIRouter, HTTPException, Body, Query, Depends, Header, Request, Response
 from loguru import logger
 from database import (
     get_db_pool,
-    ensure_support_table_exists,
+    invalidate_user_profile,
+    load_user_context,
+    get_pool_stats,
+    get_activity_by_day as db_activity_by_day,
+    get_top_commands as db_top_commands,
+    get_currency_series,
+    get_currency_history,
+    get_user_role,
+    get_admin_stats_snapshot,
+    list_users,
 )
 from bot.instance import bot as global_bot  # Импортируем переменную bot
+from bot.outbox import Outbox
 
 import asyncpg
 from telegram.ext import Application
@@ -27,64 +42,136 @@ if not DATABASE_URL:
 print(f"✅ DATABASE_URL: {DATABASE_URL[:30]}...")
 
 # --- Импорт утилит ---
-from .utils import verify_cabinet_link  # ✅ Используем проверку из utils
+from .utils import (
+    verify_cabinet_link,
+    issue_session_token,
+    verify_session_token,
+    revoke_user_sessions,
+    SESSION_TTL,
+)
+
+
+# === Отправка сообщений из веб-процесса ===
+# Бот и очередь создаются один раз на процесс. Лимит у веб-процесса свой и
+# заметно ниже, чем у бота: общий с ботом лимит Telegram делят оба процесса.
+OUTBOX_WEB_RATE = float(os.getenv("OUTBOX_WEB_RATE", 5))
+_support_outbox: Optional[Outbox] = None
+_support_outbox_lock = asyncio.Lock()
+
+
+async def get_support_outbox() -> Outbox:
+    global _support_outbox
+    from bot.instance import application as bot_application
+    if bot_application is not None and bot_application.bot_data.get('outbox'):
+        return bot_application.bot_data['outbox']
+
+    async with _support_outbox_lock:
+        if _support_outbox is None:
+            token = os.getenv("BOT_TOKEN")
+            if not token:
+                raise RuntimeError("BOT_TOKEN не задан")
+            bot = Application.builder().token(token).build().bot
+            await bot.initialize()
+            outbox = Outbox(bot, global_rate=OUTBOX_WEB_RATE, workers=1)
+            await outbox.start()
+            _support_outbox = outbox
+            logger.info("🤖 Бот для ответов поддержки инициализирован")
+    return _support_outbox
+
+
+async def close_support_outbox():
+    global _support_outbox
+    if _support_outbox is not None:
+        await _support_outbox.stop()
+        await _support_outbox.bot.shutdown()
+        _support_outbox = None
 
 
 # === Зависимости: проверка ролей ===
-async def require_admin(user_id: int = Query(...), hash: str = Query(...)):
+# Основной путь — заголовок «Authorization: Bearer <токен>» (см. POST /api/session):
+# проверка в памяти, без БД. Подпись ссылки (user_id + hash) остаётся для старых
+# клиентов и каждый раз проверяет роль в БД.
+ROLE_ACCESS = {
+    "admin": {"admin"},
+    "moderator": {"moderator", "admin"},
+}
+
+
+async def _require_role(required_role: str, authorization: str, user_id: int, hash: str) -> int:
+    if authorization and authorization.startswith("Bearer "):
+        session = verify_session_token(authorization[len("Bearer "):])
+        if session and session["role"] in ROLE_ACCESS[required_role]:
+            return session["user_id"]
+        raise HTTPException(status_code=403, detail="Доступ запрещён")
+
+    if user_id is None or not hash or not await verify_cabinet_link(user_id, hash, required_role=required_role):
+        raise HTTPException(status_code=403, detail="Доступ запрещён")
+    return user_id
+
+
+async def require_admin(
+    authorization: str = Header(None),
+    user_id: int = Query(None),
+    hash: str = Query(None)
+):
     """
     Доступ только для админов.
     """
-    if not await verify_cabinet_link(user_id, hash, required_role="admin"):
-        raise HTTPException(status_code=403, detail="Доступ запрещён")
-    return user_id
+    return await _require_role("admin", authorization, user_id, hash)
 
 
-async def require_moderator(user_id: int = Query(...), hash: str = Query(...)):
+async def require_moderator(
+    authorization: str = Header(None),
+    user_id: int = Query(None),
+    hash: str = Query(None)
+):
     """
     Доступ для модераторов и админов.
     """
-    if not await verify_cabinet_link(user_id, hash, required_role="moderator"):
-        raise HTTPException(status_code=403, detail="Доступ запрещён")
-    return user_id
+    return await _require_role("moderator", authorization, user_id, hash)
+
+
+async def create_session(user_id: int) -> str:
+    pool = await get_db_pool()
+    invalidate_user_profile(user_id)  # роль — из БД, а не из кэша профиля
+    return issue_session_token(user_id, await get_user_role(pool, user_id))
+
+
+# === 🔑 Сессия: обмен подписанной ссылки на токен ===
+@router.post("/session")
+async def api_create_session(user_id: int = Body(...), hash: str = Body(...)):
+    if not await verify_cabinet_link(user_id, hash):
+        raise HTTPException(status_code=403, detail="Неверная подпись")
+    return {"token": await create_session(user_id), "expires_in": SESSION_TTL}
 
 
 # === 🔍 Получение данных пользователя ===
+def format_user_data(user_ctx: Dict[str, Any]) -> Dict[str, Any]:
+    """
+    Приводит результат load_user_context к формату шаблонов и API.
+    """
+    return {
+        "id": user_ctx["id"],
+        "first_name": user_ctx["first_name"] or "Пользователь",
+        "username": user_ctx["username"] or "unknown",
+        "language": user_ctx["language_code"] or "ru",
+        "role": user_ctx["role"],
+        "premium_expires": user_ctx["premium_expires"].isoformat() if user_ctx["premium_expires"] else None,
+        "is_premium": user_ctx["role"] == "premium",
+        "referrals": user_ctx["referrals"],
+        "theme": user_ctx["theme"]
+    }
+
+
 async def get_user_data(user_id: int) -> Dict[str, Any]:
     print(f"🔍 Запрос данных для user_id = {user_id}")
     try:
         pool = await get_db_pool()
-        async with pool.acquire() as conn:
-            row = await conn.fetchrow("""
-                SELECT 
-                    id, first_name, username, language_code, 
-                    role, premium_expires, theme
-                FROM users 
-                WHERE id = $1
-            """, user_id)
-
-            print(f"📄 Результат из БД: {row}")
-
-            if not row:
-                print("⚠️ Пользователь не найден в БД")
-                return None
-
-            referrals = await conn.fetchval("""
-                SELECT COUNT(*) FROM referrals WHERE referrer_id = $1
-            """, user_id)
-            print(f"👥 Рефералов: {referrals}")
-
-            return {
-                "id": row["id"],
-                "first_name": row["first_name"] or "Пользователь",
-                "username": row["username"] or "unknown",
-                "language": row["language_code"] or "ru",
-                "role": row["role"] or "user",
-                "premium_expires": row["premium_expires"].isoformat() if row["premium_expires"] else None,
-                "is_premium": row["role"] == "premium",
-                "referrals": referrals or 0,
-                "theme": row["theme"] or "light"
-            }
+        user_ctx = await load_user_context(pool, user_id)
+        if not user_ctx:
+            print("⚠️ Пользователь не найден в БД")
+            return None
+        return format_user_data(user_ctx)
     except Exception as e:
         logger.error(f"❌ Ошибка в get_user_data: {e}")
         return None
@@ -141,6 +228,7 @@ async def set_user_theme(user_id: int, theme: str = Body(...), hash: str = Body(
         pool = await get_db_pool()
         async with pool.acquire() as conn:
             await conn.execute("UPDATE users SET theme = $1 WHERE id = $2", theme, user_id)
+        invalidate_user_profile(user_id)
         return {"status": "success", "theme": theme}
     except Exception as e:
         logger.error(f"❌ Ошибка обновления темы: {e}")
@@ -149,37 +237,86 @@ async def set_user_theme(user_id: int, theme: str = Body(...), hash: str = Body(
 
 # === 🔐 АДМИН-ПАНЕЛЬ: Статистика ===
 @router.get("/admin/stats")
-async def get_admin_stats(user_id: int = Depends(require_admin)):
+async def get_admin_stats(request: Request, response: Response, user_id: int = Depends(require_admin)):
+    # Снимок обновляется в фоне (web.utils.poll_admin_stats), здесь — только чтение из памяти
+    snapshot = await get_admin_stats_snapshot(await get_db_pool())
+    headers = {
+        "ETag": f'"{snapshot["etag"]}"',
+        "Last-Modified": format_datetime(snapshot["last_modified"], usegmt=True),
+        "Cache-Control": "private, no-cache",
+    }
+
+    if_none_match = request.headers.get("if-none-match")
+    if_modified_since = request.headers.get("if-modified-since")
+    not_modified = False
+    if if_none_match:
+        not_modified = headers["ETag"] in [tag.strip().removeprefix("W/") for tag in if_none_match.split(",")]
+    elif if_modified_since:
+        try:
+            not_modified = snapshot["last_modified"].replace(microsecond=0) <= parsedate_to_datetime(if_modified_since)
+        except (TypeError, ValueError):
+            pass
+    if not_modified:
+        return Response(status_code=304, headers=headers)
+
+    response.headers.update(headers)
+    return snapshot["stats"]
+
+
+@router.get("/admin/db-pool")
+async def get_db_pool_stats(user_id: int = Depends(require_admin)):
+    await get_db_pool()
+    return get_pool_stats()
+
+
+# Курсор страницы — (last_seen, id) последней строки, непрозрачный для клиента
+def encode_users_cursor(row) -> str:
+    raw = f"{row['last_seen'].isoformat()}|{row['id']}"
+    return base64.urlsafe_b64encode(raw.encode()).decode().rstrip("=")
+
+
+def decode_users_cursor(cursor: str) -> tuple:
+    try:
+        raw = base64.urlsafe_b64decode(cursor + "=" * (-len(cursor) % 4)).decode()
+        last_seen, user_id = raw.rsplit("|", 1)
+        return datetime.fromisoformat(last_seen), int(user_id)
+    except (ValueError, UnicodeDecodeError):
+        raise HTTPException(status_code=400, detail="Invalid cursor")
+
+
+async def fetch_users_page(limit: int, cursor: Optional[str], **filters) -> Dict[str, Any]:
     pool = await get_db_pool()
-    async with pool.acquire() as conn:
-        total = await conn.fetchval("SELECT COUNT(*) FROM users")
-        premium = await conn.fetchval("SELECT COUNT(*) FROM users WHERE role = 'premium'")
-        active_today = await conn.fetchval("""
-            SELECT COUNT(*) FROM usage_stats 
-            WHERE timestamp >= CURRENT_DATE
-        """)
-        referrals_count = await conn.fetchval("SELECT COUNT(*) FROM referrals")
+    after = decode_users_cursor(cursor) if cursor else None
+    # Берём на одну строку больше, чтобы понять, есть ли следующая страница
+    rows = await list_users(pool, limit=limit + 1, after=after, **filters)
+    has_more = len(rows) > limit
+    rows = rows[:limit]
     return {
-        "total_users": total or 0,
-        "premium_users": premium or 0,
-        "active_today": active_today or 0,
-        "referrals_count": referrals_count or 0
+        "users": [dict(row) for row in rows],
+        "next_cursor": encode_users_cursor(rows[-1]) if has_more else None,
     }
 
 
 @router.get("/admin/users")
-async def get_all_users(user_id: int = Depends(require_admin)):
-    pool = await get_db_pool()
-    async with pool.acquire() as conn:
-        rows = await conn.fetch("""
-            SELECT 
-                id, first_name, username, role, language_code as language, 
-                premium_expires, last_seen
-            FROM users
-            ORDER BY last_seen DESC
-            LIMIT 100
-        """)
-    return [dict(row) for row in rows]
+async def get_all_users(
+    limit: int = Query(100, ge=1, le=500),
+    cursor: Optional[str] = None,
+    role: Optional[str] = None,
+    language: Optional[str] = None,
+    premium: Optional[bool] = None,
+    user_id: int = Depends(require_admin),
+):
+    return await fetch_users_page(limit, cursor, role=role, language=language, premium=premium)
+
+
+@router.get("/admin/users/search")
+async def search_users(
+    q: str = Query(..., min_length=2),
+    limit: int = Query(50, ge=1, le=500),
+    cursor: Optional[str] = None,
+    user_id: int = Depends(require_admin),
+):
+    return await fetch_users_page(limit, cursor, search=q.strip().lstrip("@"))
 
 
 @router.get("/admin/user")
@@ -210,6 +347,8 @@ async def api_grant_premium(user_id: int = Body(..., embed=True), admin_id: int
         """, user_id)
         if result == "UPDATE 0":
             raise HTTPException(status_code=404, detail="User not found")
+    invalidate_user_profile(user_id)
+    revoke_user_sessions(user_id)
     return {"status": "success", "message": f"Премиум выдан пользователю {user_id}"}
 
 
@@ -223,6 +362,8 @@ async def api_revoke_premium(user_id: int = Body(..., embed=True), admin_id: int
                 role = CASE WHEN role = 'admin' THEN 'admin' ELSE 'user' END
             WHERE id = $1
         """, user_id)
+    invalidate_user_profile(user_id)
+    revoke_user_sessions(user_id)
     return {"status": "success", "message": f"Премиум снят с {user_id}"}
 
 
@@ -230,16 +371,7 @@ async def api_revoke_premium(user_id: int = Body(..., embed=True), admin_id: int
 @router.get("/admin/activity-by-day")
 async def get_activity_by_day(user_id: int = Depends(require_admin)):
     pool = await get_db_pool()
-    async with pool.acquire() as conn:
-        rows = await conn.fetch("""
-            SELECT 
-                DATE(timestamp) as day,
-                COUNT(*) as count
-            FROM usage_stats
-            WHERE timestamp > NOW() - INTERVAL '30 days'
-            GROUP BY day
-            ORDER BY day
-        """)
+    rows = await db_activity_by_day(pool, days=30)
     return {
         "dates": [r["day"].isoformat() for r in rows],
         "counts": [r["count"] for r in rows]
@@ -249,20 +381,44 @@ async def get_activity_by_day(user_id: int = Depends(require_admin)):
 @router.get("/admin/top-commands")
 async def get_top_commands(user_id: int = Depends(require_admin)):
     pool = await get_db_pool()
-    async with pool.acquire() as conn:
-        rows = await conn.fetch("""
-            SELECT command, COUNT(*) as count
-            FROM usage_stats
-            GROUP BY command
-            ORDER BY count DESC
-            LIMIT 10
-        """)
+    rows = await db_top_commands(pool, limit=10)
     return {
         "commands": [r["command"] for r in rows],
         "counts": [r["count"] for r in rows]
     }
 
 
+# === История курсов валют ===
+@router.get("/currency/{code}/history")
+async def currency_history(code: str, days: int = Query(30, ge=1, le=3650)):
+    pool = await get_db_pool()
+    rows = await get_currency_history(pool, code.upper(), days)
+    return {
+        "code": code.upper(),
+        "dates": [r["date"].isoformat() for r in rows],
+        "values": [r["value"] for r in rows]
+    }
+
+
+@router.get("/currency/{code}/series")
+async def currency_series(
+    code: str,
+    period: str = Query("week", pattern="^(week|month)$"),
+    days: int = Query(365, ge=1, le=3650)
+):
+    pool = await get_db_pool()
+    rows = await get_currency_series(pool, code.upper(), period, days)
+    return {
+        "code": code.upper(),
+        "period": period,
+        "periods": [r["period"].isoformat() for r in rows],
+        "min": [r["min"] for r in rows],
+        "max": [r["max"] for r in rows],
+        "avg": [round(r["avg"], 4) for r in rows],
+        "last": [r["last"] for r in rows]
+    }
+
+
 # === Отзывы ===
 @router.get("/admin/reviews")
 async def get_reviews(user_id: int = Depends(require_admin)):
@@ -331,38 +487,15 @@ async def reply_support(
         if not ticket:
             raise HTTPException(status_code=404, detail="Тикет не найден")
 
-      # Пытаемся получить бот из bot.instance
-    bot = None
     try:
-        from bot.instance import bot as global_bot
-        if global_bot is not None:
-            bot = global_bot
-            logger.info("✅ Бот получен из bot.instance")
-    except ImportError:
-        logger.warning("⚠️ Модуль bot.instance не найден — будем использовать временный бот")
+        outbox = await get_support_outbox()
     except Exception as e:
-        logger.error(f"❌ Ошибка импорта bot.instance: {e}")
-
-    # Если бот не из instance — создаём временный
-    if bot is None:
-        token = os.getenv("BOT_TOKEN")
-        if not token:
-            logger.error("❌ BOT_TOKEN не задан в переменных окружения")
-            raise HTTPException(status_code=500, detail="BOT_TOKEN не задан")
-
-        try:
-            from telegram.ext import Application
-            application = Application.builder().token(token).build()
-            bot = application.bot
-            await bot.initialize()  # ← ВАЖНО: инициализация
-            logger.info("🤖 Временный бот инициализирован для ответа")
-        except Exception as e:
-            logger.error(f"❌ Не удалось создать временного бота: {e}")
-            raise HTTPException(status_code=500, detail="Не удалось инициализировать бота")
+        logger.error(f"❌ Не удалось инициализировать бота: {e}")
+        raise HTTPException(status_code=500, detail="Не удалось инициализировать бота")
 
     # Отправляем ответ
     try:
-        await bot.send_message(
+        await outbox.send_message(
             ticket["user_id"],
             f"📬 Ответ от поддержки:\n\n{reply_text}\n\nСпасибо за обращение! ✅"
         )
@@ -1,14 +1,15 @@
+import asyncio
 import sys
 import os
-import yaml
-import json
 from datetime import datetime
 from fastapi.staticfiles import StaticFiles
-from fastapi import FastAPI, HTTPException, Request, APIRouter
+from fastapi import FastAPI, HTTPException, Request, APIRouter, Depends
 from fastapi.responses import JSONResponse, HTMLResponse
 from fastapi.templating import Jinja2Templates
 from loguru import logger
-from database import get_db_pool, ensure_support_table_exists
+from database import get_db_pool, init_db
+from web.store import UsersStore
+from web.quota import QuotaService
 
 # Добавляем путь
 sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
@@ -23,32 +24,12 @@ DATA_DIR = "data"
 os.makedirs(DATA_DIR, exist_ok=True)
 
 USERS_YML = "users.yml"
-USAGE_JSON = os.path.join(DATA_DIR, "usage.json")
 
-if not os.path.exists(USAGE_JSON):
-    with open(USAGE_JSON, "w", encoding="utf-8") as f:
-        json.dump({"gigachat": {"total": 0, "limit": 100, "users": {}}, "last_reset": str(datetime.now())}, f, ensure_ascii=False, indent=2)
+# Квота GigaChat: счётчики в памяти, периодически пишутся в Postgres
+quota = QuotaService()
 
-# --- Загрузка данных ---
-def load_usage():
-    if os.path.exists(USAGE_JSON):
-        with open(USAGE_JSON, "r", encoding="utf-8") as f:
-            return json.load(f)
-    return {"gigachat": {"total": 0, "limit": 100, "users": {}}, "last_reset": str(datetime.now())}
-
-def save_usage(data):
-    with open(USAGE_JSON, "w", encoding="utf-8") as f:
-        json.dump(data, f, ensure_ascii=False, indent=2)
-
-def load_users_yml():
-    if not os.path.exists(USERS_YML):
-        return []
-    with open(USERS_YML, "r", encoding="utf-8") as f:
-        return yaml.safe_load(f) or []
-
-def save_users_yml(users):
-    with open(USERS_YML, "w", encoding="utf-8") as f:
-        yaml.dump(users, f, ensure_ascii=False, default_flow_style=False)
+# users.yml: читается один раз, поиск по индексам в памяти, запись пачками
+users_store = UsersStore(USERS_YML)
 
 # --- Админ API ---
 admin_api = APIRouter(prefix="/api/admin", tags=["admin"])
@@ -56,10 +37,11 @@ admin_api = APIRouter(prefix="/api/admin", tags=["admin"])
 # Статистика
 @admin_api.get("/stats")
 async def get_admin_stats():
-    usage = load_usage()
-    total_users = len(usage["gigachat"]["users"])
-    active_today = sum(1 for count in usage["gigachat"]["users"].values() if count > 0)
-    premium = sum(1 for count in usage["gigachat"]["users"].values() if count > 5)
+    await quota.load()
+    counts = quota.counts()
+    total_users = len(counts)
+    active_today = sum(1 for count in counts.values() if count > 0)
+    premium = sum(1 for count in counts.values() if count > 5)
     return {
         "total_users": total_users,
         "active_today": active_today,
@@ -71,22 +53,20 @@ async def get_admin_stats():
             {"feature": "Погода", "requests": 621, "growth": "+3%"},
             {"feature": "Игры", "requests": 304, "growth": "-2%"},
         ],
-        "api_usage": usage["gigachat"]
+        "api_usage": {"total": quota.total, "limit": quota.limit, "users": counts}
     }
 
 # Использование API
 @admin_api.get("/api-usage")
 async def get_api_usage():
-    usage = load_usage()
-    gigachat = usage["gigachat"]
-    top_users = sorted(gigachat["users"].items(), key=lambda x: x[1], reverse=True)[:5]
+    await quota.load()
     return {
         "gigachat": {
-            "used": gigachat["total"],
-            "limit": gigachat["limit"],
-            "remaining": max(0, gigachat["limit"] - gigachat["total"]),
-            "is_over": gigachat["total"] >= gigachat["limit"],
-            "top_users": [{"user_id": uid, "requests": count} for uid, count in top_users]
+            "used": quota.total,
+            "limit": quota.limit,
+            "remaining": quota.remaining(),
+            "is_over": quota.is_over(),
+            "top_users": [{"user_id": uid, "requests": count} for uid, count in quota.top_users(5)]
         }
     }
 
@@ -96,71 +76,54 @@ async def update_api_limit(data: dict):
     new_limit = data.get("limit", 100)
     if new_limit < 1:
         raise HTTPException(status_code=400, detail="Лимит должен быть > 0")
-    usage = load_usage()
-    usage["gigachat"]["limit"] = new_limit
-    save_usage(usage)
+    await quota.load()
+    await quota.set_limit(new_limit)
     logger.info(f"Лимит GigaChat обновлён: {new_limit}")
     return {"status": "ok", "limit": new_limit}
 
 # Поиск пользователя
 @admin_api.get("/user")
 async def get_user(query: str):
-    users = load_users_yml()
-    for u in users:
-        if str(query) in str(u.get("id")) or query.lower() in u.get("username", "").lower():
-            return u
-    return None
+    await users_store.load()
+    return users_store.find(query)
 
 # Выдать премиум
 @admin_api.post("/grant-premium")
 async def grant_premium(data: dict):
     user_id = str(data.get("user_id"))
-    users = load_users_yml()
-    for u in users:
-        if str(u.get("id")) == user_id:
-            u["premium"] = True
-            u["premium_expires"] = (datetime.now().timestamp() + 30 * 86400)
-            save_users_yml(users)
-            logger.info(f"Премиум выдан: {user_id}")
-            return {"status": "ok"}
+    await users_store.load()
+    if users_store.update(user_id, {"premium": True, "premium_expires": datetime.now().timestamp() + 30 * 86400}):
+        logger.info(f"Премиум выдан: {user_id}")
+        return {"status": "ok"}
     raise HTTPException(status_code=404, detail="Пользователь не найден")
 
 # Снять премиум
 @admin_api.post("/revoke-premium")
 async def revoke_premium(data: dict):
     user_id = str(data.get("user_id"))
-    users = load_users_yml()
-    for u in users:
-        if str(u.get("id")) == user_id:
-            u.pop("premium", None)
-            u.pop("premium_expires", None)
-            save_users_yml(users)
-            logger.info(f"Премиум снят: {user_id}")
-            return {"status": "ok"}
+    await users_store.load()
+    if users_store.update(user_id, remove=("premium", "premium_expires")):
+        logger.info(f"Премиум снят: {user_id}")
+        return {"status": "ok"}
     raise HTTPException(status_code=404, detail="Пользователь не найден")
 
 # Заблокировать
 @admin_api.post("/block-user")
 async def block_user(data: dict):
     user_id = str(data.get("user_id"))
-    users = load_users_yml()
-    for u in users:
-        if str(u.get("id")) == user_id:
-            u["blocked"] = True
-            save_users_yml(users)
-            logger.info(f"Пользователь заблокирован: {user_id}")
-            return {"status": "ok"}
+    await users_store.load()
+    if users_store.update(user_id, {"blocked": True}):
+        logger.info(f"Пользователь заблокирован: {user_id}")
+        return {"status": "ok"}
     raise HTTPException(status_code=404, detail="Пользователь не найден")
 
 # Сброс статистики пользователя
 @admin_api.post("/reset-user")
 async def reset_user(data: dict):
     user_id = str(data.get("user_id"))
-    usage = load_usage()
-    if user_id in usage["gigachat"]["users"]:
-        usage["gigachat"]["users"][user_id] = 0
-        usage["gigachat"]["total"] = sum(usage["gigachat"]["users"].values())
-        save_usage(usage)
+    await quota.load()
+    if user_id.isdigit() and quota.reset_user(int(user_id)):
+        await quota.flush()
         logger.info(f"Статистика сброшена: {user_id}")
         return {"status": "ok"}
     raise HTTPException(status_code=404, detail="Пользователь не найден")
@@ -171,16 +134,13 @@ async def patch_users_from_yml():
     if not os.path.exists(USERS_YML):
         raise HTTPException(status_code=404, detail="Файл users.yml не найден")
     try:
-        with open(USERS_YML, "r", encoding="utf-8") as f:
-            data = yaml.safe_load(f) or []
-        usage = load_usage()
-        for item in data:
-            user_id = str(item.get("id"))
-            if user_id not in usage["gigachat"]["users"]:
-                usage["gigachat"]["users"][user_id] = 0
-        save_usage(usage)
-        logger.info(f"users.yml загружен: {len(data)} пользователей")
-        return {"status": "success", "message": "Пользователи обновлены", "count": len(data)}
+        # Файл правят вручную — перечитываем его в хранилище
+        count = await users_store.reload()
+        await quota.load()
+        quota.add_users(int(user_id) for user_id in users_store.ids() if user_id.isdigit())
+        await quota.flush()
+        logger.info(f"users.yml загружен: {count} пользователей")
+        return {"status": "success", "message": "Пользователи обновлены", "count": count}
     except Exception as e:
         logger.error(f"Ошибка при обработке users.yml: {e}")
         raise HTTPException(status_code=500, detail="Ошибка при чтении файла")
@@ -188,11 +148,8 @@ async def patch_users_from_yml():
 # Сброс всех счётчиков
 @admin_api.post("/reset-usage")
 async def reset_usage_counters():
-    usage = load_usage()
-    usage["gigachat"]["total"] = 0
-    usage["gigachat"]["users"] = {uid: 0 for uid in usage["gigachat"]["users"]}
-    usage["last_reset"] = str(datetime.now())
-    save_usage(usage)
+    await quota.load()
+    await quota.reset()
     logger.info("Счётчики GigaChat сброшены администратором")
     return {"status": "success", "message": "Счётчики GigaChat сброшены"}
 
@@ -214,7 +171,11 @@ print(f"✅ Статика доступна из: {static_dir}")
 templates = Jinja2Templates(directory=templates_dir)
 
 # --- Подключаем утилиты ---
-from web.utils import verify_cabinet_link
+from web.utils import verify_cabinet_link, poll_role_changes, poll_admin_stats
+
+role_changes_task = None
+admin_stats_task = None
+quota_task = None
 
 # --- Подключаем веб-роуты ---
 try:
@@ -226,9 +187,13 @@ except Exception as e:
 
 # --- Подключаем API ---
 try:
-    from .api import router as api_router
+    from .api import router as api_router, require_admin
     app.include_router(api_router, prefix="/api")
     logger.info("✅ API-роуты подключены: /api/...")
+    # Файловый админ-API (users.yml, квота GigaChat) — после основного: совпадающие
+    # пути (/stats, /user, /grant-premium, /revoke-premium) обслуживает web/api.py
+    app.include_router(admin_api, dependencies=[Depends(require_admin)])
+    logger.info("✅ Файловый админ-API подключён: /api/admin/...")
 except Exception as e:
     logger.error(f"❌ Ошибка импорта API: {e}")
 
@@ -248,7 +213,39 @@ async def startup_event():
     logger.info("✨ Доступные роуты: /, /cabinet, /finance, /admin, /tickets, /api/admin/stats")
     
     try:
-        await ensure_support_table_exists()
-        logger.info("✅ Таблица support_tickets проверена/создана")
+        await init_db(await get_db_pool())
+    except Exception as e:
+        logger.error(f"❌ Ошибка при проверке схемы БД: {e}")
+
+    # Отзыв токенов сессий при смене роли
+    global role_changes_task
+    role_changes_task = asyncio.create_task(poll_role_changes())
+
+    # Снимок статистики для /api/admin/stats
+    global admin_stats_task
+    admin_stats_task = asyncio.create_task(poll_admin_stats())
+
+    # Сброс счётчиков GigaChat в БД и обнуление по расписанию
+    global quota_task
+    quota_task = asyncio.create_task(quota.run())
+
+    try:
+        await users_store.load()
     except Exception as e:
-        logger.error(f"❌ Ошибка при создании таблицы support_tickets: {e}")
\ No newline at end of file
+        logger.error(f"❌ Ошибка загрузки {USERS_YML}: {e}")
+
+
+@app.on_event("shutdown")
+async def shutdown_event():
+    from .api import close_support_outbox
+    await close_support_outbox()
+    if role_changes_task:
+        role_changes_task.cancel()
+    if admin_stats_task:
+        admin_stats_task.cancel()
+    await users_store.close()
+    if quota_task:
+        # Дожидаемся отмены: прерванный flush вернёт счётчики в очередь записи
+        quota_task.cancel()
+        await asyncio.gather(quota_task, return_exceptions=True)
+    await quota.close()
@@ -0,0 +1,181 @@
+# web/quota.py
+# Квота GigaChat: счётчики запросов в памяти, периодический сброс в Postgres
+#
+# Проверка лимита и учёт запроса — O(1) без обращения к БД. Изменившиеся
+# счётчики раз в QUOTA_FLUSH_INTERVAL секунд пишутся одним UNNEST-upsert,
+# общий счётчик обнуляется по расписанию (QUOTA_RESET_PERIOD от last_reset).
+# Прежний data/usage.json импортируется один раз, если в БД квоты ещё нет.
+#
+# Фоновая задача run() запускается при старте веб-процесса (web/main.py).
+# consume() пока не вызывается: клиента GigaChat в проекте ещё нет, и счётчики
+# меняются только через админ-API. Запрос к GigaChat должен вызывать consume()
+# в том же процессе, что и run(), иначе учтённое не попадёт в БД.
+
+import asyncio
+import heapq
+import json
+import os
+from datetime import datetime, timedelta, timezone
+from operator import itemgetter
+
+from loguru import logger
+
+from database import (
+    get_db_pool,
+    load_gigachat_quota,
+    save_gigachat_quota,
+    save_gigachat_usage,
+    reset_gigachat_usage,
+)
+
+QUOTA_DEFAULT_LIMIT = int(os.getenv("GIGACHAT_LIMIT", 100))
+QUOTA_FLUSH_INTERVAL = float(os.getenv("QUOTA_FLUSH_INTERVAL", 10))
+QUOTA_RESET_PERIOD = int(os.getenv("QUOTA_RESET_PERIOD", 86400))
+LEGACY_USAGE_JSON = os.path.join("data", "usage.json")
+
+
+class QuotaService:
+    def __init__(self, flush_interval: float = QUOTA_FLUSH_INTERVAL, reset_period: int = QUOTA_RESET_PERIOD):
+        self.flush_interval = flush_interval
+        self.reset_period = timedelta(seconds=reset_period)
+        self.limit = QUOTA_DEFAULT_LIMIT
+        self.total = 0
+        self.last_reset = datetime.now(timezone.utc)
+        self._counts = {}  # user_id -> запросов с последнего сброса
+        self._dirty = set()
+        self._loaded = False
+        self._flush_lock = asyncio.Lock()
+
+    # --- Загрузка ---
+    def _read_legacy(self):
+        if not os.path.exists(LEGACY_USAGE_JSON):
+            return None
+        with open(LEGACY_USAGE_JSON, "r", encoding="utf-8") as f:
+            return json.load(f)
+
+    async def load(self):
+        if self._loaded:
+            return
+        pool = await get_db_pool()
+        settings, counts = await load_gigachat_quota(pool)
+        if settings is None:
+            await self._import_legacy(pool)
+        else:
+            self.limit, self.last_reset = settings["total_limit"], settings["last_reset"]
+            self._counts = counts
+        self.total = sum(self._counts.values())
+        self._loaded = True
+        logger.info(f"🤖 Квота GigaChat: {self.total}/{self.limit}, пользователей: {len(self._counts)}")
+
+    async def _import_legacy(self, pool):
+        try:
+            legacy = await asyncio.to_thread(self._read_legacy)
+        except Exception as e:
+            logger.warning(f"⚠️ Не удалось прочитать {LEGACY_USAGE_JSON}: {e}")
+            legacy = None
+        if legacy:
+            gigachat = legacy.get("gigachat", {})
+            self.limit = gigachat.get("limit", self.limit)
+            self._counts = {int(uid): count for uid, count in gigachat.get("users", {}).items() if str(uid).isdigit()}
+            logger.info(f"📥 Импортирован {LEGACY_USAGE_JSON}: пользователей {len(self._counts)}")
+        await save_gigachat_quota(pool, self.limit, self.last_reset)
+        if self._counts:
+            await save_gigachat_usage(pool, self._counts)
+
+    # --- Учёт ---
+    def remaining(self) -> int:
+        return max(0, self.limit - self.total)
+
+    def is_over(self) -> bool:
+        return self.total >= self.limit
+
+    def consume(self, user_id: int, requests: int = 1) -> bool:
+        """
+        Учитывает запрос пользователя. False — общий лимит исчерпан, запрос не учтён.
+        """
+        if self.total + requests > self.limit:
+            return False
+        self._counts[user_id] = self._counts.get(user_id, 0) + requests
+        self.total += requests
+        self._dirty.add(user_id)
+        return True
+
+    def counts(self) -> dict:
+        return self._counts
+
+    def top_users(self, n: int = 5) -> list:
+        return heapq.nlargest(n, self._counts.items(), key=itemgetter(1))
+
+    def add_users(self, user_ids) -> int:
+        added = 0
+        for user_id in user_ids:
+            if user_id not in self._counts:
+                self._counts[user_id] = 0
+                self._dirty.add(user_id)
+                added += 1
+        return added
+
+    def reset_user(self, user_id: int) -> bool:
+        if user_id not in self._counts:
+            return False
+        self.total -= self._counts[user_id]
+        self._counts[user_id] = 0
+        self._dirty.add(user_id)
+        return True
+
+    async def set_limit(self, limit: int):
+        self.limit = limit
+        await save_gigachat_quota(await get_db_pool(), self.limit, self.last_reset)
+
+    async def reset(self):
+        # Под блокировкой сброса в БД: иначе flush, собранный из старых значений,
+        # может записать их уже после обнуления
+        async with self._flush_lock:
+            counts, total, last_reset = self._counts, self.total, self.last_reset
+            # Сначала память: запросы, учтённые после этой строки, переживут сброс в БД
+            self._counts = dict.fromkeys(counts, 0)
+            self.total = 0
+            self.last_reset = datetime.now(timezone.utc)
+            try:
+                await reset_gigachat_usage(await get_db_pool(), self.last_reset)
+            except (Exception, asyncio.CancelledError):
+                # БД не обнулена — возвращаем прежние значения вместе с новыми запросами
+                for user_id, count in counts.items():
+                    self._counts[user_id] = self._counts.get(user_id, 0) + count
+                self.total += total
+                self.last_reset = last_reset
+                raise
+        logger.info("🔄 Счётчики GigaChat сброшены")
+
+    # --- Запись в БД ---
+    async def flush(self) -> int:
+        async with self._flush_lock:
+            if not self._dirty:
+                return 0
+            batch = {user_id: self._counts.get(user_id, 0) for user_id in self._dirty}
+            self._dirty.clear()
+            try:
+                await save_gigachat_usage(await get_db_pool(), batch)
+            except (Exception, asyncio.CancelledError):
+                # Не потерять изменения: запишем при следующем сбросе
+                self._dirty.update(batch)
+                raise
+            return len(batch)
+
+    async def run(self):
+        """
+        Фоновая задача веб-процесса: сброс счётчиков в БД и обнуление по расписанию.
+        """
+        while True:
+            await asyncio.sleep(self.flush_interval)
+            try:
+                await self.load()
+                if datetime.now(timezone.utc) >= self.last_reset + self.reset_period:
+                    await self.reset()
+                await self.flush()
+            except Exception as e:
+                logger.warning(f"⚠️ Не удалось сохранить счётчики GigaChat: {e}")
+
+    async def close(self):
+        if self._loaded:
+            await self.flush()
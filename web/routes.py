@@ -4,8 +4,8 @@ from fastapi.templating import Jinja2Templates
 import urllib.parse
 import os
 from .utils import verify_webapp_data, verify_cabinet_link
-from .api import get_user_data
-from database import get_db_pool, get_user_stats, get_referral_stats
+from .api import get_user_data, format_user_data, create_session
+from database import get_db_pool, load_user_context
 
 # ✅ Исправлено: Путь к шаблонам теперь правильно указывает на web/templates
 templates = Jinja2Templates(directory=os.path.join(os.path.dirname(__file__), "templates"))
@@ -116,8 +116,13 @@ async def cabinet(request: Request):
     if not verify_cabinet_link(user_id, hash_param):
         raise HTTPException(status_code=403, detail="Invalid signature")
 
-    user_data = await get_user_data(user_id)
-    if not user_data:
+    # Профиль, рефералы и финансы — одним запросом
+    pool = await get_db_pool()
+    user_ctx = await load_user_context(pool, user_id)
+    if user_ctx:
+        user_data = format_user_data(user_ctx)
+        stats = user_ctx["stats"]
+    else:
         user_data = {
             "id": user_id,
             "first_name": "Пользователь",
@@ -126,13 +131,10 @@ async def cabinet(request: Request):
             "premium_expires": None,
             "is_premium": False,
             "language": "ru",
-            "theme": "light"
+            "theme": "light",
+            "referrals": 0
         }
-
-    pool = await get_db_pool()
-    stats = await get_user_stats(pool, user_id)
-    referrals_count = await get_referral_stats(pool, user_id)
-    user_data["referrals"] = referrals_count
+        stats = {"income": 0.0, "expense": 0.0, "balance": 0.0}
 
     theme = request.cookies.get("theme", user_data.get("theme", "light"))
 
@@ -203,7 +205,7 @@ async def admin_page(request: Request):
     except ValueError:
         raise HTTPException(status_code=400, detail="Invalid user_id")
 
-    if not verify_cabinet_link(user_id, hash_param):
+    if not await verify_cabinet_link(user_id, hash_param):
         raise HTTPException(status_code=403, detail="Invalid signature")
 
     user_data = await get_user_data(user_id)
@@ -221,6 +223,7 @@ async def admin_page(request: Request):
             "request": request,
             "user": user_data,
             "title": "Админ-панель",
-            "theme": theme
+            "theme": theme,
+            "session_token": await create_session(user_id)
         }
     )
\ No newline at end of file
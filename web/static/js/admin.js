@@ -2,8 +2,40 @@
 
 let statsData = {};
 let usersList = [];
+let usersNextCursor = null;
 let currentChart = null;
 
+// === Запросы к API с токеном сессии (выдаётся страницей /admin) ===
+// Токен живёт SESSION_TTL: на 401/403 получаем новый по подписанной ссылке
+// страницы и повторяем запрос один раз; если не вышло — перезагружаем страницу.
+function withToken(options) {
+  const headers = { ...(options.headers || {}), 'Authorization': `Bearer ${window.ADMIN_TOKEN}` };
+  return { ...options, headers };
+}
+
+async function refreshSession() {
+  const params = new URLSearchParams(window.location.search);
+  const res = await fetch('/api/session', {
+    method: 'POST',
+    headers: { 'Content-Type': 'application/json' },
+    body: JSON.stringify({ user_id: Number(params.get('user_id')), hash: params.get('hash') })
+  });
+  if (!res.ok) return false;
+  window.ADMIN_TOKEN = (await res.json()).token;
+  return true;
+}
+
+async function apiFetch(url, options = {}) {
+  const res = await fetch(url, withToken(options));
+  if (res.status !== 401 && res.status !== 403) return res;
+  if (await refreshSession()) {
+    const retry = await fetch(url, withToken(options));
+    if (retry.status !== 401 && retry.status !== 403) return retry;
+  }
+  window.location.reload();
+  return res;
+}
+
 document.addEventListener('DOMContentLoaded', async () => {
   console.log('✅ admin.js: загружен');
   await loadStats();
@@ -14,7 +46,7 @@ document.addEventListener('DOMContentLoaded', async () => {
 // === Загрузка статистики ===
 async function loadStats() {
   try {
-    const res = await fetch('/api/admin/stats');
+    const res = await apiFetch('/api/admin/stats');
     statsData = await res.json();
     updateStatsDisplay();
   } catch (e) {
@@ -24,10 +56,16 @@ async function loadStats() {
 }
 
 // === Загрузка пользователей ===
-async function loadUsersList() {
+async function loadUsersList(more = false) {
   try {
-    const res = await fetch('/api/admin/users');
-    usersList = await res.json();
+    const params = new URLSearchParams({ limit: 100 });
+    if (more && usersNextCursor) params.set('cursor', usersNextCursor);
+    const res = await apiFetch(`/api/admin/users?${params}`);
+    const page = await res.json();
+    usersList = more ? usersList.concat(page.users) : page.users;
+    usersNextCursor = page.next_cursor;
+    const moreButton = document.getElementById('users-load-more');
+    if (moreButton) moreButton.style.display = usersNextCursor ? '' : 'none';
     const tbody = document.getElementById('users-table-body');
     if (tbody) {
       tbody.innerHTML = usersList.map(u => `
@@ -117,7 +155,7 @@ function renderStatsTable() {
 
 function renderActivityChart() {
   document.getElementById('stats-container').innerHTML = '<canvas id="activityChart"></canvas>';
-  fetch('/api/admin/activity-by-day')
+  apiFetch('/api/admin/activity-by-day')
     .then(res => res.json())
     .then(data => {
       const ctx = document.getElementById('activityChart').getContext('2d');
@@ -141,7 +179,7 @@ function renderActivityChart() {
 
 function renderCommandsChart() {
   document.getElementById('stats-container').innerHTML = '<canvas id="commandsChart"></canvas>';
-  fetch('/api/admin/top-commands')
+  apiFetch('/api/admin/top-commands')
     .then(res => res.json())
     .then(data => {
       const ctx = document.getElementById('commandsChart').getContext('2d');
@@ -165,7 +203,7 @@ async function searchUser() {
   const input = document.getElementById('search-user').value.trim();
   if (!input) return;
   try {
-    const res = await fetch(`/api/admin/user?query=${encodeURIComponent(input)}`);
+    const res = await apiFetch(`/api/admin/user?query=${encodeURIComponent(input)}`);
     const user = await res.json();
     if (user) {
       document.getElementById('found-user').textContent = `@${user.username} (ID: ${user.id})`;
@@ -182,7 +220,7 @@ async function searchUser() {
 async function grantPremium() {
   if (!window.currentFoundUser) return;
   if (confirm(`Выдать премиум ${window.currentFoundUser.first_name}?`)) {
-    await fetch('/api/admin/grant-premium', {
+    await apiFetch('/api/admin/grant-premium', {
       method: 'POST',
       headers: { 'Content-Type': 'application/json' },
       body: JSON.stringify({ user_id: window.currentFoundUser.id })
@@ -194,7 +232,7 @@ async function grantPremium() {
 async function revokePremium() {
   if (!window.currentFoundUser) return;
   if (confirm(`Снять премиум у ${window.currentFoundUser.first_name}?`)) {
-    await fetch('/api/admin/revoke-premium', {
+    await apiFetch('/api/admin/revoke-premium', {
       method: 'POST',
       headers: { 'Content-Type': 'application/json' },
       body: JSON.stringify({ user_id: window.currentFoundUser.id })
@@ -206,7 +244,7 @@ async function revokePremium() {
 async function blockUser() {
   if (!window.currentFoundUser) return;
   if (confirm(`Заблокировать ${window.currentFoundUser.first_name}?`)) {
-    await fetch('/api/admin/block-user', {
+    await apiFetch('/api/admin/block-user', {
       method: 'POST',
       headers: { 'Content-Type': 'application/json' },
       body: JSON.stringify({ user_id: window.currentFoundUser.id })
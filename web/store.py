@@ -0,0 +1,154 @@
+# web/store.py
+# Хранилище users.yml для файлового админ-API
+#
+# Файл читается один раз, дальше все обращения идут к словарям в памяти:
+# по id и по username (без учёта регистра). Изменения копятся и пишутся на
+# диск пачкой через USERS_FLUSH_DELAY секунд — во временный файл с
+# последующим os.replace, в отдельном потоке, чтобы не блокировать цикл событий.
+
+import asyncio
+import os
+from typing import Optional
+
+import yaml
+from loguru import logger
+
+USERS_FLUSH_DELAY = float(os.getenv("USERS_FLUSH_DELAY", 1.0))
+
+
+class UsersStore:
+    def __init__(self, path: str, flush_delay: float = USERS_FLUSH_DELAY):
+        self.path = path
+        self.flush_delay = flush_delay
+        self._users = []  # порядок записей как в файле
+        self._by_id = {}  # str(id) -> запись
+        self._by_username = {}  # username.lower() -> запись
+        self._loaded = False
+        self._dirty = False
+        self._replay = None  # изменения, пришедшие во время reload()
+        self._flush_task: Optional[asyncio.Task] = None
+        self._write_lock = asyncio.Lock()
+
+    def __len__(self) -> int:
+        return len(self._users)
+
+    def _read(self) -> list:
+        if not os.path.exists(self.path):
+            return []
+        with open(self.path, "r", encoding="utf-8") as f:
+            return yaml.safe_load(f) or []
+
+    def _write(self, users: list):
+        tmp_path = f"{self.path}.tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            yaml.dump(users, f, allow_unicode=True, default_flow_style=False)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, self.path)
+
+    def _index(self, users: list):
+        self._users = users
+        self._by_id = {str(u.get("id")): u for u in users}
+        self._by_username = {u["username"].lower(): u for u in users if u.get("username")}
+
+    async def load(self):
+        if not self._loaded:
+            await self.reload()
+
+    async def reload(self) -> int:
+        """
+        Перечитывает файл (например, после ручной правки). Несохранённые изменения
+        сначала записываются. Блокировка записи держится до конца индексации, а
+        изменения, пришедшие во время чтения файла, повторяются на новых записях.
+        """
+        async with self._write_lock:
+            # Запись включается до сброса на диск: он тоже уходит в поток
+            self._replay = []
+            try:
+                await self._write_dirty()
+                users = await asyncio.to_thread(self._read)
+            finally:
+                replay, self._replay = self._replay, None
+            self._index(users)
+            self._loaded = True
+            for user_id, changes, remove in replay:
+                self.update(user_id, changes, remove)
+        logger.info(f"📇 {self.path}: загружено пользователей: {len(self._users)}")
+        return len(self._users)
+
+    def ids(self) -> list:
+        return list(self._by_id)
+
+    def get(self, user_id) -> Optional[dict]:
+        return self._by_id.get(str(user_id))
+
+    def find(self, query: str) -> Optional[dict]:
+        """
+        Поиск по id или username (с «@» или без). Точное совпадение — из индексов;
+        если его нет, как и раньше, первая запись, где запрос входит в id или username.
+        """
+        query = str(query).strip()
+        user = self._by_id.get(query) or self._by_username.get(query.lstrip("@").lower())
+        if user is not None or not query:
+            return user
+        needle = query.lstrip("@").lower()
+        for u in self._users:
+            if query in str(u.get("id")) or needle in (u.get("username") or "").lower():
+                return u
+        return None
+
+    def update(self, user_id, changes: dict = None, remove: tuple = ()) -> Optional[dict]:
+        """
+        Меняет запись в памяти и планирует запись на диск. None — пользователя нет.
+        """
+        user = self.get(user_id)
+        if user is None:
+            return None
+        if self._replay is not None:
+            self._replay.append((user_id, changes, remove))
+        old_username = (user.get("username") or "").lower()
+        user.update(changes or {})
+        for key in remove:
+            user.pop(key, None)
+        new_username = (user.get("username") or "").lower()
+        if new_username != old_username:
+            self._by_username.pop(old_username, None)
+            if new_username:
+                self._by_username[new_username] = user
+        self._schedule_flush()
+        return user
+
+    def _schedule_flush(self):
+        self._dirty = True
+        if self._flush_task is None or self._flush_task.done():
+            self._flush_task = asyncio.create_task(self._delayed_flush())
+
+    async def _delayed_flush(self):
+        await asyncio.sleep(self.flush_delay)
+        try:
+            await self.flush()
+        except Exception as e:
+            logger.error(f"❌ Не удалось сохранить {self.path}: {e}")
+
+    async def flush(self):
+        async with self._write_lock:
+            await self._write_dirty()
+
+    async def _write_dirty(self):
+        # Вызывается под _write_lock
+        if not self._dirty:
+            return
+        self._dirty = False
+        # Копия: пока поток пишет файл, записи в памяти могут меняться
+        snapshot = [dict(u) for u in self._users]
+        try:
+            await asyncio.to_thread(self._write, snapshot)
+        except Exception:
+            self._dirty = True
+            raise
+
+    async def close(self):
+        # Отложенную запись не отменяем: поток мог уже начать писать файл
+        if self._flush_task and not self._flush_task.done():
+            await self._flush_task
+        await self.flush()
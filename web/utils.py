@@ -1,11 +1,25 @@
 # web/utils.py
 # Утилиты для проверки подлинности пользователей
 
+import asyncio
+import base64
 import hashlib
 import hmac
 import os
+import time
+from datetime import datetime, timedelta, timezone
 from typing import Optional
-from database import get_db_pool, get_user_role
+
+from loguru import logger
+
+from database import (
+    get_db_pool,
+    get_user_role,
+    get_role_changes,
+    invalidate_user_profile,
+    refresh_admin_stats,
+    ADMIN_STATS_TTL,
+)
 
 
 def verify_webapp_data(token: str, data_check_string: str, hash: str) -> bool:
@@ -58,4 +72,119 @@ async def verify_cabinet_link(user_id: int, hash: str, required_role: str = None
     elif required_role == "moderator":
         return user_role in ["moderator", "admin"]
     else:
-        return False
\ No newline at end of file
+        return False
+
+
+# === Сессионные токены для API ===
+# Выдаются один раз после проверки ссылки и несут user_id, роль и срок действия.
+# Проверка — HMAC в памяти ключом, выведенным из AUTH_SECRET при первом
+# обращении, без запросов к БД. При смене роли токены, выданные раньше,
+# отзываются: веб-процесс раз в SESSION_REVOCATION_POLL секунд забирает
+# изменения users.role_updated_at.
+SESSION_TTL = int(os.getenv("SESSION_TTL", 3600))
+SESSION_REVOCATION_POLL = int(os.getenv("SESSION_REVOCATION_POLL", 15))
+# role_updated_at — время начала транзакции (NOW()): смена роли может стать видна
+# позже, чем более поздние изменения. Каждый опрос перечитывает это окно заново.
+SESSION_REVOCATION_OVERLAP = int(os.getenv("SESSION_REVOCATION_OVERLAP", 60))
+
+_session_key: Optional[bytes] = None
+_revoked_before = {}  # user_id -> время смены роли (unix)
+
+
+def _get_session_key() -> bytes:
+    global _session_key
+    if _session_key is None:
+        secret = os.getenv("AUTH_SECRET")
+        if not secret:
+            raise ValueError("AUTH_SECRET не задан в переменных окружения")
+        _session_key = hmac.new(secret.encode(), b"session-token", hashlib.sha256).digest()
+    return _session_key
+
+
+def _b64(data: bytes) -> str:
+    return base64.urlsafe_b64encode(data).rstrip(b"=").decode()
+
+
+def _unb64(data: str) -> bytes:
+    return base64.urlsafe_b64decode(data + "=" * (-len(data) % 4))
+
+
+def issue_session_token(user_id: int, role: str, ttl: int = SESSION_TTL) -> str:
+    issued_at = time.time()
+    payload = f"{user_id}:{role}:{int(issued_at + ttl)}:{issued_at:.3f}"
+    body = _b64(payload.encode())
+    signature = _b64(hmac.new(_get_session_key(), body.encode(), hashlib.sha256).digest())
+    return f"{body}.{signature}"
+
+
+def verify_session_token(token: str) -> Optional[dict]:
+    """
+    Возвращает {"user_id", "role"} для действующего токена или None.
+    """
+    try:
+        body, signature = token.split(".", 1)
+        expected = _b64(hmac.new(_get_session_key(), body.encode(), hashlib.sha256).digest())
+        if not hmac.compare_digest(signature, expected):
+            return None
+        user_id, role, expires, issued_at = _unb64(body).decode().split(":")
+        user_id, expires, issued_at = int(user_id), int(expires), float(issued_at)
+    except (ValueError, UnicodeDecodeError):
+        return None
+
+    if expires < time.time():
+        return None
+    if issued_at <= _revoked_before.get(user_id, 0.0):
+        return None
+    return {"user_id": user_id, "role": role}
+
+
+def revoke_user_sessions(user_id: int):
+    _revoked_before[user_id] = time.time()
+
+
+def apply_role_changes(rows, since: datetime) -> datetime:
+    """
+    Отзывает токены, выданные до смены роли, и сбрасывает кэш профиля — вход по
+    подписанной ссылке тоже увидит новую роль. Повторно прочитанные строки безвредны.
+    """
+    for row in rows:
+        changed_at = row["role_updated_at"].timestamp()
+        _revoked_before[row["id"]] = max(_revoked_before.get(row["id"], 0.0), changed_at)
+        invalidate_user_profile(row["id"])
+        since = max(since, row["role_updated_at"])
+    return since
+
+
+async def poll_role_changes():
+    """
+    Фоновая задача веб-процесса: отзывает токены пользователей, чья роль сменилась
+    (в том числе из бота).
+    """
+    since = datetime.now(timezone.utc) - timedelta(seconds=SESSION_TTL)
+    while True:
+        try:
+            rows = await get_role_changes(
+                await get_db_pool(), since - timedelta(seconds=SESSION_REVOCATION_OVERLAP)
+            )
+            since = apply_role_changes(rows, since)
+
+            # Токены старше SESSION_TTL истекли сами — записи об отзыве не нужны
+            cutoff = time.time() - SESSION_TTL
+            for user_id in [u for u, ts in _revoked_before.items() if ts < cutoff]:
+                del _revoked_before[user_id]
+        except Exception as e:
+            logger.warning(f"⚠️ Не удалось проверить смену ролей: {e}")
+        await asyncio.sleep(SESSION_REVOCATION_POLL)
+
+
+async def poll_admin_stats():
+    """
+    Фоновая задача веб-процесса: пересчитывает снимок статистики админки,
+    чтобы /api/admin/stats отвечал из памяти.
+    """
+    while True:
+        try:
+            await refresh_admin_stats(await get_db_pool())
+        except Exception as e:
+            logger.warning(f"⚠️ Не удалось обновить статистику админки: {e}")
+        await asyncio.sleep(ADMIN_STATS_TTL)